@@ -8,9 +8,13 @@ log_message() {
 
 log_message "Backup job started."
 
+# --- 0. Delete attachment blobs nothing refers to any more (not fatal) ---
+log_message "Collecting unreferenced attachment blobs..."
+sh -c "cd /app && /usr/local/bin/python manage.py collect_attachment_blobs" || log_message "collect_attachment_blobs FAILED, continuing with the backup."
+
 # --- 1. Execute Backup Command ---
 log_message "Running Django create_wiki_backup command..."
-COMMAND_CREATE_BACKUP="cd /app && /usr/local/bin/python manage.py create_wiki_backup --output-dir /app/backups"
+COMMAND_CREATE_BACKUP="cd /app && /usr/local/bin/python manage.py create_wiki_backup --incremental --output-dir /app/backups"
 
 sh -c "${COMMAND_CREATE_BACKUP}"
 CREATE_EXIT_CODE=$?
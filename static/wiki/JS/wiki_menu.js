@@ -11,15 +11,23 @@ document.addEventListener('DOMContentLoaded', function() {
 
     const menuConfigSlug = menu.dataset.menuConfigSlug || "default-menu-config-slug"; // Get from data attribute
     let allWikiPagesData = [];
-    try {
-        const pagesDataScript = document.getElementById('allWikiPagesJsonData');
-        if (pagesDataScript) {
-            allWikiPagesData = JSON.parse(pagesDataScript.textContent);
-        } else {
-            // console.warn("allWikiPagesJsonData script tag not found.");
+    let pageIndexRequest = null;
+
+    // The page index is a separate, versioned JSON file: only fetched once the search box is used.
+    function loadPageIndex() {
+        if (!pageIndexRequest && menu.dataset.pageIndexUrl) {
+            pageIndexRequest = fetch(menu.dataset.pageIndexUrl, { credentials: 'same-origin' })
+                .then(response => {
+                    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                    return response.json();
+                })
+                .then(data => { allWikiPagesData = data; })
+                .catch(e => {
+                    console.error("Error loading the page index:", e);
+                    pageIndexRequest = null; // Try again on the next focus
+                });
         }
-    } catch (e) {
-        console.error("Error parsing allWikiPagesData:", e);
+        return pageIndexRequest || Promise.resolve();
     }
 
 
@@ -82,7 +90,17 @@ document.addEventListener('DOMContentLoaded', function() {
     const dynamicSearchResultsList = document.getElementById('dynamicSearchResultsList'); // UL for dynamic results
 
     if (searchInput && dynamicSearchResultsList && dynamicSearchResultsContainer) {
+        searchInput.addEventListener('focus', loadPageIndex);
         searchInput.addEventListener('input', function() {
+            // Results typed before the index arrived are filled in once it has loaded.
+            if (!allWikiPagesData.length) {
+                loadPageIndex().then(() => {
+                    if (allWikiPagesData.length && searchInput.value.trim() !== '') {
+                        searchInput.dispatchEvent(new Event('input'));
+                    }
+                });
+            }
+
             const searchTerm = this.value.toLowerCase().trim();
             const visiblePinnedSlugs = new Set();
 
@@ -1,6 +1,7 @@
 # wiki/admin.py
 from django.contrib import admin
-from .models import WikiPage, WikiFile, Profile
+from .models import WikiPage, WikiFile, Profile, MediaJob
+from . import fulltext
 from django.urls import reverse
 from django.utils.html import format_html
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
@@ -14,6 +15,12 @@ class WikiPageAdmin(admin.ModelAdmin):
     list_filter = ('updated_at', 'created_at', 'last_modified_by')
     readonly_fields = ('created_at', 'updated_at')
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        matches = fulltext.matching_pages(search_term, WikiPage.objects.all()).values('pk')
+        return queryset.filter(pk__in=matches), False
+
 @admin.register(WikiFile)
 class WikiFileAdmin(admin.ModelAdmin):
     list_display = ('filename_display', 'page_link', 'filename_slug', 'uploaded_at', 'uploaded_by_username')
@@ -40,6 +47,13 @@ class WikiFileAdmin(admin.ModelAdmin):
             obj.uploaded_by = request.user
         super().save_model(request, obj, form, change)
 
+@admin.register(MediaJob)
+class MediaJobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'wiki_file', 'member_path', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('member_path', 'wiki_file__file')
+    readonly_fields = ('kind', 'wiki_file', 'member_path', 'attempts', 'error', 'created_at', 'started_at', 'finished_at')
+
 class ProfileInline(admin.StackedInline):
     model = Profile
     can_delete = False
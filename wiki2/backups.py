@@ -0,0 +1,451 @@
+# wiki2/backups.py
+"""
+Backup storage used by the backup management commands.
+
+Full backups are single archives: a ZIP written in one thread, or a tar.gz whose blocks
+are compressed in a process pool (like pigz).
+
+Incremental backups use a content-addressed blob store plus one small manifest per
+snapshot. Inside the backup directory, page content and attachment bytes are stored once
+under `blobs/<ab>/<sha256>`. A snapshot (`<timestamp>.manifest.json.gz`) only lists the
+pages and the digests of their content and attachments, so a nightly backup costs about
+the size of what changed. `prune_backups` deletes blobs no remaining manifest refers to.
+"""
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from . import constants
+
+ARCHIVE_FORMATS = {'zip': '.zip', 'tar.gz': '.tar.gz'}
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024  # Compressed independently, the unit of parallel work
+GZIP_LEVEL = 6
+GZIP_SEGMENT_SIZE = 256 * 1024
+INCOMPRESSIBLE_SAMPLE_SIZE = 16 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+
+BLOB_DIRECTORY = 'blobs'
+MANIFEST_SUFFIX = '.manifest.json.gz'
+MANIFEST_FORMAT_VERSION = 1
+HASH_CACHE_FILENAME = 'hash-cache.json'
+# Unreferenced blobs younger than this are kept: a running backup may not have written
+# the manifest that refers to them yet.
+GC_GRACE_PERIOD = 60 * 60 * 24
+CHUNK_SIZE = 1024 * 1024
+
+
+# --- Archive writers ---
+# `members` yields (archive name, source) pairs, the source being bytes or a file path.
+
+def _compress_type(filename: str) -> int:
+    if os.path.splitext(filename)[1].lower() in constants.PRECOMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def write_zip_archive(path: str, members):
+    """Writes a ZIP in the calling thread. Already compressed formats are stored as-is."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for arcname, source in members:
+            if isinstance(source, bytes):
+                zf.writestr(arcname, source)
+            else:
+                zf.write(source, arcname=arcname, compress_type=_compress_type(arcname))
+
+
+def _gzip_block(block: bytes, level: int) -> bytes:
+    """
+    Gzips one block as a few gzip members. Segments that a quick sample shows to be
+    compressed already (photos, archives) are stored rather than deflated again.
+    """
+    members = []
+    for start in range(0, len(block), GZIP_SEGMENT_SIZE):
+        segment = block[start:start + GZIP_SEGMENT_SIZE]
+        sample = segment[:INCOMPRESSIBLE_SAMPLE_SIZE]
+        is_compressed = len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+        members.append(gzip.compress(segment, 0 if is_compressed else level, mtime=0))
+    return b''.join(members)
+
+
+class ParallelGzipWriter:
+    """
+    A write-only file object that cuts its input into blocks and gzips each block in a
+    process pool. Concatenated gzip members are a valid gzip file for every reader.
+    """
+
+    def __init__(self, fileobj, pool: ProcessPoolExecutor | None, jobs: int, block_size: int = GZIP_BLOCK_SIZE, level: int = GZIP_LEVEL):
+        self._fileobj = fileobj
+        self._pool = pool
+        self._block_size = block_size
+        self._level = level
+        self._max_pending = 2 * jobs  # Bounds memory use while keeping every worker busy
+        self._buffer = bytearray()
+        self._pending = deque()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        if self._pool is None:
+            self._fileobj.write(_gzip_block(block, self._level))
+            return
+        self._pending.append(self._pool.submit(_gzip_block, block, self._level))
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+def write_tar_gz_archive(path: str, members, jobs: int = 1):
+    """Writes a tar.gz, compressing it on `jobs` processes."""
+    # Spawned, not forked: the workers only compress and mustn't inherit database connections.
+    pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) if jobs > 1 else None
+    try:
+        with open(path, 'wb') as raw_file:
+            writer = ParallelGzipWriter(raw_file, pool, jobs)
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tf:
+                for arcname, source in members:
+                    if isinstance(source, bytes):
+                        tar_info = tarfile.TarInfo(arcname)
+                        tar_info.size = len(source)
+                        tar_info.mtime = int(time.time())
+                        tf.addfile(tar_info, io.BytesIO(source))
+                    else:
+                        tf.add(source, arcname=arcname, recursive=False)
+            writer.close()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def write_archive(path: str, members, archive_format: str = 'zip', jobs: int = 1):
+    if archive_format == 'tar.gz':
+        write_tar_gz_archive(path, members, jobs)
+    else:
+        write_zip_archive(path, members)
+
+
+# --- Blob store ---
+
+def is_manifest(path) -> bool:
+    return str(path).endswith(MANIFEST_SUFFIX)
+
+
+def blob_path(backup_dir: str, digest: str) -> str:
+    return os.path.join(backup_dir, BLOB_DIRECTORY, digest[:2], digest)
+
+
+def _keep_alive(path: str):
+    """Marks a reused blob as recently written, so a concurrent GC's grace period covers it."""
+    os.utime(path)
+
+
+def _commit_blob(backup_dir: str, tmp_path: str, digest: str) -> bool:
+    """Moves a fully written temp file into place. Returns whether the blob was new."""
+    final_path = blob_path(backup_dir, digest)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        _keep_alive(final_path)
+        return False
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(tmp_path, final_path)
+    return True
+
+
+def _blob_temp_file(backup_dir: str):
+    directory = os.path.join(backup_dir, BLOB_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.', suffix='.tmp', delete=False)
+
+
+def store_bytes(backup_dir: str, data: bytes) -> tuple[str, bool]:
+    """Stores `data` unless an identical blob exists. Returns (digest, was_new)."""
+    digest = hashlib.sha256(data).hexdigest()
+    existing_path = blob_path(backup_dir, digest)
+    if os.path.exists(existing_path):
+        _keep_alive(existing_path)
+        return digest, False
+    with _blob_temp_file(backup_dir) as tmp_file:
+        tmp_file.write(data)
+    return digest, _commit_blob(backup_dir, tmp_file.name, digest)
+
+
+def store_file(backup_dir: str, source_path: str) -> tuple[str, bool]:
+    """Copies a file into the store, hashing it in the same pass. Returns (digest, was_new)."""
+    sha256 = hashlib.sha256()
+    with _blob_temp_file(backup_dir) as tmp_file, open(source_path, 'rb') as source:
+        while chunk := source.read(CHUNK_SIZE):
+            sha256.update(chunk)
+            tmp_file.write(chunk)
+    return sha256.hexdigest(), _commit_blob(backup_dir, tmp_file.name, sha256.hexdigest())
+
+
+def has_blob(backup_dir: str, digest: str) -> bool:
+    path = blob_path(backup_dir, digest)
+    if not os.path.exists(path):
+        return False
+    _keep_alive(path)
+    return True
+
+
+# --- Hash cache ---
+# Maps an attachment's storage name to the (size, mtime) it had and its digest, so
+# unchanged attachments are neither read nor hashed again on the next run.
+
+def load_hash_cache(backup_dir: str) -> dict:
+    try:
+        with open(os.path.join(backup_dir, HASH_CACHE_FILENAME), encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_hash_cache(backup_dir: str, hash_cache: dict):
+    path = os.path.join(backup_dir, HASH_CACHE_FILENAME)
+    with tempfile.NamedTemporaryFile('w', dir=backup_dir, prefix='.', delete=False, encoding='utf-8') as tmp_file:
+        json.dump(hash_cache, tmp_file)
+    os.replace(tmp_file.name, path)
+
+
+# --- Manifests ---
+
+def write_manifest(manifest_path: str, pages: list[dict]):
+    """Writes a snapshot manifest under a temporary name first, so it only appears complete."""
+    directory, filename = os.path.split(manifest_path)
+    partial_path = os.path.join(directory, f".{filename}.partial")
+    manifest = {'version': MANIFEST_FORMAT_VERSION, 'created_at': time.time(), 'pages': pages}
+    with gzip.open(partial_path, 'wt', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(partial_path, manifest_path)
+
+
+def read_manifest(manifest_path: str) -> dict:
+    with gzip.open(manifest_path, 'rt', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_FORMAT_VERSION:
+        raise ValueError(f"Unsupported manifest version: {manifest.get('version')}")
+    return manifest
+
+
+def referenced_blobs(manifest: dict) -> set[str]:
+    digests = set()
+    for page in manifest['pages']:
+        digests.add(page['content'])
+        digests.update(attachment['blob'] for attachment in page['attachments'])
+    return digests
+
+
+# --- Garbage collection ---
+
+def collect_garbage(backup_dir: str, manifest_paths, dry_run: bool = False) -> tuple[int, int]:
+    """
+    Mark and sweep: deletes every blob not referenced by one of `manifest_paths` (and
+    older than the grace period). Returns the number of blobs and bytes freed.
+    """
+    live = set()
+    for manifest_path in manifest_paths:
+        live |= referenced_blobs(read_manifest(manifest_path))
+
+    blob_root = os.path.join(backup_dir, BLOB_DIRECTORY)
+    if not os.path.isdir(blob_root):
+        return 0, 0
+    cutoff = time.time() - GC_GRACE_PERIOD
+    freed_count = freed_bytes = 0
+    for directory, _subdirs, filenames in os.walk(blob_root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            stat_result = os.stat(path)
+            if filename in live or stat_result.st_mtime > cutoff:
+                continue
+            freed_count += 1
+            freed_bytes += stat_result.st_size
+            if not dry_run:
+                os.remove(path)
+    return freed_count, freed_bytes
+
+
+# --- Reading backups ---
+# Every format is read as a stream of BackupPages, straight from the archive or the blob
+# store: nothing is extracted as a whole, and unselected pages cost (almost) nothing. ZIPs
+# and manifests are read at random; a tar.gz has to be decompressed up to the last page.
+
+SPOOL_MEMORY_LIMIT = 8 * 1024 * 1024
+
+
+def _file_checksum(path: str, kind: str):
+    if kind == 'crc32':
+        crc = 0
+        with open(path, 'rb') as file_obj:
+            while chunk := file_obj.read(CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file_obj:
+        while chunk := file_obj.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class BackupAttachment:
+    """An attachment in a backup. `checksum` is a ('crc32' | 'sha256', value) pair."""
+
+    def __init__(self, name: str, size: int, open_func, checksum: tuple[str, object]):
+        self.name = name
+        self.size = size
+        self.checksum = checksum
+        self._open_func = open_func
+
+    def open(self):
+        return self._open_func()
+
+    def matches(self, path: str) -> bool:
+        """Whether the file at `path` already holds exactly these bytes."""
+        try:
+            if os.path.getsize(path) != self.size:
+                return False
+            return _file_checksum(path, self.checksum[0]) == self.checksum[1]
+        except OSError:
+            return False
+
+
+class BackupPage:
+    """A page in a backup. `content` is None when the backup lacks it, `defaults` holds fields for a new page."""
+
+    def __init__(self, slug: str, content: str | None, attachments: list[BackupAttachment], defaults: dict | None = None):
+        self.slug = slug
+        self.content = content
+        self.attachments = attachments
+        self.defaults = defaults or {}
+
+
+def _split_member_name(name: str) -> tuple[str, str | None]:
+    """Splits `slug/content.md` or `slug/attachments/<name>` into (slug, 'content' | attachment name)."""
+    slug, _, rest = name.partition('/')
+    if rest == 'content.md':
+        return slug, 'content'
+    prefix = 'attachments/'
+    if rest.startswith(prefix) and '/' not in rest[len(prefix):] and len(rest) > len(prefix):
+        return slug, rest[len(prefix):]
+    return slug, None
+
+
+def _iter_zip_pages(zf: zipfile.ZipFile, selected):
+    members = {}
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        slug, part = _split_member_name(info.filename)
+        if part is None or not selected(slug):
+            continue
+        entry = members.setdefault(slug, {'content': None, 'attachments': []})
+        if part == 'content':
+            entry['content'] = info
+        else:
+            entry['attachments'].append(info)
+
+    for slug, entry in members.items():
+        content = zf.read(entry['content']).decode('utf-8') if entry['content'] else None
+        attachments = [
+            BackupAttachment(os.path.basename(info.filename), info.file_size, partial(zf.open, info), ('crc32', info.CRC))
+            for info in entry['attachments']
+        ]
+        yield BackupPage(slug, content, attachments)
+
+
+def _spool(name: str, size: int, source) -> BackupAttachment:
+    """Copies a member out of a tar stream (which can't be revisited), hashing it on the way."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+    sha256 = hashlib.sha256()
+    while chunk := source.read(CHUNK_SIZE):
+        sha256.update(chunk)
+        spool.write(chunk)
+
+    def open_spool():
+        spool.seek(0)
+        return spool
+    return BackupAttachment(name, size, open_spool, ('sha256', sha256.hexdigest()))
+
+
+def _iter_tar_pages(tf: tarfile.TarFile, selected):
+    # Members are written page by page, so a page is complete once the next one starts.
+    page = None
+    for member in tf:
+        if not member.isfile():
+            continue
+        slug, part = _split_member_name(member.name)
+        if part is None or not selected(slug):
+            continue
+        if page is None or page.slug != slug:
+            if page is not None:
+                yield page
+            page = BackupPage(slug, None, [])
+        source = tf.extractfile(member)
+        if part == 'content':
+            page.content = source.read().decode('utf-8')
+        else:
+            page.attachments.append(_spool(part, member.size, source))
+    if page is not None:
+        yield page
+
+
+def _iter_manifest_pages(path: str, selected):
+    backup_dir = os.path.dirname(path)
+    for entry in read_manifest(path)['pages']:
+        if not selected(entry['slug']):
+            continue
+        content_path = blob_path(backup_dir, entry['content'])
+        content = None
+        if os.path.isfile(content_path):
+            with open(content_path, encoding='utf-8') as content_file:
+                content = content_file.read()
+        attachments = [
+            BackupAttachment(
+                attachment['name'],
+                attachment['size'],
+                partial(open, blob_path(backup_dir, attachment['blob']), 'rb'),
+                ('sha256', attachment['blob']),
+            )
+            for attachment in entry['attachments']
+        ]
+        yield BackupPage(entry['slug'], content, attachments, {'title': entry['title'], 'visibility': entry['visibility']})
+
+
+@contextmanager
+def open_backup(path: str, selected=None):
+    """
+    Opens a ZIP, tar(.gz) or snapshot manifest and gives an iterator of its BackupPages,
+    limited to the slugs for which `selected(slug)` is true. The archive stays open (and
+    the attachments readable) until the block exits. Raises ValueError for other files.
+    """
+    selected = selected or (lambda slug: True)
+    if is_manifest(path):
+        yield _iter_manifest_pages(path, selected)
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            yield _iter_zip_pages(zf, selected)
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, 'r|*') as tf:
+            yield _iter_tar_pages(tf, selected)
+    else:
+        raise ValueError(f"Not a ZIP or tar archive or snapshot manifest: {path}")
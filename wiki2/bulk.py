@@ -0,0 +1,86 @@
+# wiki2/bulk.py
+"""
+Helpers for commands that write many pages at once (imports, restores).
+
+They use bulk_create/bulk_update, which send no signals, and then bring the derived data
+(link graph, rendered page cache, search index, media jobs) up to date in one pass.
+"""
+from itertools import islice
+
+from django.conf import settings
+
+from .models import WikiPage, WikiFile
+from . import services
+from . import fulltext
+from . import jobs
+
+
+def batched(items, size: int):
+    """Yields lists of up to `size` items from any iterable, consuming it lazily."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def create_with_ids(model, objects: list, key_fields: str | tuple[str, ...]) -> list:
+    """
+    bulk_create, then fills in the ids by looking them up on a unique field (or combination
+    of fields) when the database backend can't return them from the INSERT.
+    """
+    model.objects.bulk_create(objects)
+    if any(obj.pk is None for obj in objects):
+        if isinstance(key_fields, str):
+            key_fields = (key_fields,)
+        def key(obj):
+            return tuple(str(getattr(obj, field)) for field in key_fields)
+        lookups = {f"{field}__in": {str(getattr(obj, field)) for obj in objects} for field in key_fields}
+        rows = model.objects.filter(**lookups).values_list(*key_fields, 'pk')
+        pks = {tuple(map(str, row[:-1])): row[-1] for row in rows}
+        for obj in objects:
+            obj.pk = pks[key(obj)]
+    return objects
+
+
+def unique_title(title: str, taken: set[str]) -> str:
+    """Returns `title`, or `title (N)` with the lowest N > 1 that isn't in `taken`."""
+    candidate = title
+    counter = 2
+    while candidate in taken:
+        candidate = f"{title} ({counter})"
+        counter += 1
+    return candidate
+
+
+def refresh_derived_data(page_ids: list[int], changed_page_ids, new_files: list[WikiFile], batch_size: int, log=print,
+                         rebuild_search_index: bool = True):
+    """
+    Does once, for all written pages, what the post_save signals would have done per row.
+    `changed_page_ids` are existing pages whose content changed, `log` reports progress.
+    With rebuild_search_index=False only the written pages are re-indexed, not the whole wiki.
+    """
+    log(f"Rebuilding the link graph for {len(page_ids)} page(s)...")
+    stale_page_ids = set(changed_page_ids)
+    for batch in batched(page_ids, batch_size):
+        for page in WikiPage.objects.filter(pk__in=batch).prefetch_related('files'):
+            services.update_page_links(page)
+    # Links from other pages that now resolve to one of the written pages.
+    for batch in batched(page_ids, batch_size):
+        stale_page_ids |= services.refresh_links_to_pages(list(WikiPage.objects.filter(pk__in=batch).only('pk', 'slug', 'title')))
+    services.invalidate_rendered_pages(stale_page_ids)
+    services.bump_generation()
+
+    if rebuild_search_index:
+        log(f"Rebuilding the search index ({fulltext.get_backend()} backend)...")
+        fulltext.rebuild_index()
+    else:
+        log(f"Re-indexing {len(page_ids)} page(s) for search ({fulltext.get_backend()} backend)...")
+        for batch in batched(page_ids, batch_size):
+            fulltext.index_pages(batch)
+
+    if new_files:
+        log(f"Indexing and queueing media work for {len(new_files)} attachment(s)...")
+    for wiki_file in new_files:
+        if wiki_file.archive_index is None:
+            services.ensure_archive_index(wiki_file)
+        if settings.WIKI_MEDIA_WORKER_ENABLED:
+            jobs.enqueue_for_upload(wiki_file)
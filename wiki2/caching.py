@@ -0,0 +1,94 @@
+# wiki2/caching.py
+"""
+Cache-aside with stampede protection for values that are expensive to compute.
+
+`get_or_build` replaces the usual get → compute → set:
+- Single flight: on a miss one caller computes the value while the others wait for it,
+  behind a Redis lock with django-redis or a per-process lock with LocMemCache (which is
+  per process anyway).
+- Stale-while-revalidate: an entry is still served for `stale_timeout` seconds after it
+  expires, while a single caller refreshes it.
+- Probabilistic early refresh ("XFetch"): as expiry approaches, a caller is increasingly
+  likely to refresh the entry ahead of time, so expiries don't all line up.
+"""
+import math
+import random
+import threading
+import time
+from weakref import WeakValueDictionary
+
+from django.core.cache import cache
+
+LOCK_TIMEOUT = 30  # Longest a builder may hold the lock, in case it dies
+LOCK_WAIT = 5  # Longest a caller waits for someone else's build before doing it itself
+
+_local_locks = WeakValueDictionary()
+_local_locks_guard = threading.Lock()
+
+
+class _BuildLock:
+    """A lock per cache key: a Redis lock when the cache offers one, a thread lock otherwise."""
+
+    def __init__(self, cache_key: str):
+        if hasattr(cache, 'lock'):  # django-redis
+            self._lock = cache.lock(f"{cache_key}:lock", timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_WAIT)
+            self._is_local = False
+        else:
+            with _local_locks_guard:
+                self._lock = _local_locks.setdefault(cache_key, threading.Lock())
+            self._is_local = True
+
+    def acquire(self, wait: bool) -> bool:
+        if self._is_local:
+            return self._lock.acquire(timeout=LOCK_WAIT) if wait else self._lock.acquire(blocking=False)
+        return self._lock.acquire(blocking=wait)
+
+    def release(self):
+        try:
+            self._lock.release()
+        except Exception:
+            pass  # The Redis lock expired while building, someone else may hold it by now
+
+
+def _build_and_store(cache_key: str, build, timeout, stale_timeout: int):
+    started = time.monotonic()
+    value = build()
+    build_time = time.monotonic() - started
+    if timeout is None:
+        cache.set(cache_key, (value, math.inf, build_time), timeout=None)
+    else:
+        cache.set(cache_key, (value, time.time() + timeout, build_time), timeout=timeout + stale_timeout)
+    return value
+
+
+def get_or_build(cache_key: str, build, timeout: int | None = 3600, stale_timeout: int = 0, beta: float = 1.0):
+    """
+    Returns the cached value for `cache_key`, calling `build()` to compute it when needed.
+    `timeout` is how long a value is fresh (None: forever), `stale_timeout` how much longer
+    it may be served while being refreshed and `beta` how eagerly it's refreshed early.
+    Any value, None included, can be cached.
+    """
+    entry = cache.get(cache_key)
+    if entry is not None:
+        value, fresh_until, build_time = entry
+        # XFetch: refresh early with a probability that rises as expiry nears and with the build time.
+        if time.time() - build_time * beta * math.log(1.0 - random.random()) < fresh_until:
+            return value
+        lock = _BuildLock(cache_key)
+        if not lock.acquire(wait=False):
+            return value  # Someone else is refreshing it, the current value will do until then
+        try:
+            return _build_and_store(cache_key, build, timeout, stale_timeout)
+        finally:
+            lock.release()
+
+    lock = _BuildLock(cache_key)
+    if not lock.acquire(wait=True):
+        return build()  # The builder is slow or gone, don't keep the request waiting
+    try:
+        entry = cache.get(cache_key)  # Built by whoever held the lock while we waited
+        if entry is not None:
+            return entry[0]
+        return _build_and_store(cache_key, build, timeout, stale_timeout)
+    finally:
+        lock.release()
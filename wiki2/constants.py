@@ -200,6 +200,27 @@ WIKI_PICTURE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.svg', '.webp', '.h
 # --- Archives supported for photo galleries ---
 WIKI_ARCHIVE_EXTENSIONS = ['.zip']
 
+# --- Resized image derivatives (thumbnails and lightbox size), longest side in pixels ---
+IMAGE_DERIVATIVE_SIZES = {'thumb': 320, 'medium': 1280}
+IMAGE_DERIVATIVE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp']
+
+# --- Shown (with HTTP 202) while the media worker is still converting an image ---
+PENDING_IMAGE_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="320" height="320" viewBox="0 0 320 320">'
+    '<rect width="320" height="320" fill="#e0e0e0"/>'
+    '<text x="160" y="165" font-family="sans-serif" font-size="18" fill="#777" text-anchor="middle">Converting image…</text>'
+    '</svg>'
+)
+PENDING_IMAGE_RETRY_AFTER = 5
+
+# --- Already compressed formats, stored as-is in backup archives instead of deflated again ---
+PRECOMPRESSED_EXTENSIONS = [
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heic', '.heif',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp',
+    '.mp3', '.m4a', '.ogg', '.mp4', '.mov', '.webm', '.mkv',
+]
+
 DEFAULT_MARKDOWN_TO_PDF_CSS = """
 @page { size: A4; margin: 2cm; }
 body { font-family: sans-serif; line-height: 1.5; font-size: 10pt; }
@@ -253,4 +274,32 @@ STANDARD_MARKDOWN_LINK_RE = re.compile(
     r"\)"
 )
 
-MARKDOWN_IMAGE_RE = re.compile(r"!\[(.*?)\]\((.*?)(?:\s+(['\"])(.*?)\3)?\)")
\ No newline at end of file
+MARKDOWN_IMAGE_RE = re.compile(r"!\[(.*?)\]\((.*?)(?:\s+(['\"])(.*?)\3)?\)")
+
+# The four patterns above as one alternation, so a single scan finds every construct.
+# Code comes first and wins, like the code-first split did. The groups are named because
+# the patterns' own numbered backreferences don't survive being combined. The lookahead
+# lets the scan skip plain text without trying each alternative, and [\s\S] is the same
+# "any character" as (?:.|\n), without an alternation per character.
+MARKUP_TOKEN_RE = re.compile(
+    r"(?=[`~\[!])(?:"
+    r"(?P<code>"
+    r"(?:^```[^\n]*\n[\s\S]*?^\s*```$)"
+    r"|(?:^~~~[^\n]*\n[\s\S]*?^\s*~~~$)"
+    r"|(?P<ticks>`+)(?:(?!(?P=ticks))[\s\S])*?(?P=ticks)"
+    r")"
+    r"|(?P<wikilink>\[\[(?:(?P<wikilink_text>[^|\]]+)\|)?(?P<wikilink_target>[^\]]+)\]\])"
+    r"|(?P<image>!\[(?P<image_alt>.*?)\]\((?P<image_src>.*?)"
+    r"(?:\s+(?P<image_quote>['\"])(?P<image_title>.*?)(?P=image_quote))?\))"
+    r"|(?P<link>(?<!\!)\[(?P<link_text>[^\]]+)\]\((?P<link_target>[^)\s]+?)"
+    r"(?:\s+(?P<link_quote>['\"])(?P<link_title>.*?)(?P=link_quote))?\))"
+    r")",
+    re.MULTILINE
+)
+
+# Per token kind, the groups that correspond to the numbered groups of its own pattern.
+MARKUP_TOKEN_GROUPS = {
+    'wikilink': ('wikilink_text', 'wikilink_target'),
+    'image': ('image_alt', 'image_src', 'image_quote', 'image_title'),
+    'link': ('link_text', 'link_target', 'link_quote', 'link_title'),
+}
@@ -2,10 +2,11 @@
 import json
 import re
 from django.urls import reverse, NoReverseMatch
-from django.core.cache import cache
 from .models import WikiPage
 from django.utils.text import slugify
 from . import constants
+from . import services
+from . import caching
 
 
 def _extract_json_array_from_text(text_content):
@@ -150,9 +151,15 @@ def _parse_menu_data(menu_raw_content, source_page_slug="menu"):
 
     return parsed_sections
 
-def _filter_menu_for_user(parsed_sections, user):
-    visible_slugs = set(WikiPage.objects.get_visible_by_user(user).values_list('slug', flat=True))
+VISIBILITIES_BY_CLASS = {
+    'anonymous': {WikiPage.Visibility.PUBLIC.value},
+    'authenticated': {WikiPage.Visibility.PUBLIC.value, WikiPage.Visibility.LOGGED_IN.value},
+    'staff': set(WikiPage.Visibility.values),
+}
 
+MENU_CACHE_TIMEOUT = 3600
+
+def _get_menu_slugs(parsed_sections):
     menu_slugs = set()
     for section in parsed_sections:
         if section.get("section_link_slug"):
@@ -160,10 +167,36 @@ def _filter_menu_for_user(parsed_sections, user):
         for item in section.get('items', []):
             if item.get('slug'):
                 menu_slugs.add(item.get('slug'))
-    
-    existing_menu_slugs = set(WikiPage.objects.filter(slug__in=menu_slugs).values_list('slug', flat=True))
-    non_existent_slugs = menu_slugs - existing_menu_slugs
-    
+    return menu_slugs
+
+def _build_menu_state():
+    menu_page_slug_val = constants.MENU_CONFIG_PAGE_SLUG
+    try:
+        menu_config_content = WikiPage.objects.values_list('content', flat=True).get(slug=menu_page_slug_val)
+    except WikiPage.DoesNotExist:
+        menu_page_title = menu_page_slug_val.replace('-', ' ').title()
+        new_menu_page, _ = WikiPage.objects.get_or_create(
+            slug=menu_page_slug_val,
+            defaults={'title': menu_page_title, 'content': constants.DEFAULT_MENU_CONFIG}
+        )
+        menu_config_content = new_menu_page.content
+
+    parsed_sections = _parse_menu_data(menu_config_content, source_page_slug=menu_page_slug_val)
+    menu_pages = WikiPage.objects.filter(slug__in=_get_menu_slugs(parsed_sections)).values_list('slug', 'visibility', 'author_id')
+    return {
+        'sections': parsed_sections,
+        'pages': {slug: (visibility, author_id) for slug, visibility, author_id in menu_pages},
+    }
+
+def _get_menu_state(generation):
+    """
+    Returns the parsed menu together with the visibility and author of the pages it
+    links to, cached per wiki generation.
+    """
+    return caching.get_or_build(f"wiki_menu_state:{generation}", _build_menu_state, MENU_CACHE_TIMEOUT)
+
+def _filter_menu(parsed_sections, visible_slugs, existing_menu_slugs, is_authenticated):
+    """Drops the menu items and sections a user can't see. Works on the menu only, without queries."""
     user_filtered_sections = []
     for section in parsed_sections:
         new_section = section.copy()
@@ -177,10 +210,10 @@ def _filter_menu_for_user(parsed_sections, user):
                 can_see_item = True
             elif item_slug in visible_slugs:
                 can_see_item = True
-            elif user.is_authenticated and item_slug in non_existent_slugs:
+            elif is_authenticated and item_slug not in existing_menu_slugs:
                 can_see_item = True
             
-            if can_see_item and item.get('login_required', False) and not user.is_authenticated:
+            if can_see_item and item.get('login_required', False) and not is_authenticated:
                 can_see_item = False
             
             if can_see_item:
@@ -198,8 +231,7 @@ def _filter_menu_for_user(parsed_sections, user):
                 show_section_header = True
             elif section_link_slug in visible_slugs:
                 show_section_header = True
-                print("test")
-            elif user.is_authenticated and section_link_slug in non_existent_slugs:
+            elif is_authenticated and section_link_slug not in existing_menu_slugs:
                 show_section_header = True
 
         if show_section_header:
@@ -207,36 +239,41 @@ def _filter_menu_for_user(parsed_sections, user):
             
     return user_filtered_sections
 
+def _get_menu_for_user(generation, menu_state, user):
+    """
+    The menu filtered for the user's visibility class, precomputed once per class. Only users
+    whose own private pages are in the menu get a filtered copy of their own.
+    """
+    visibility_class = services.get_visibility_class(user)
+    menu_pages = menu_state['pages']
+    visible_slugs = {
+        slug for slug, (visibility, _author_id) in menu_pages.items()
+        if visibility in VISIBILITIES_BY_CLASS[visibility_class]
+    }
+
+    if visibility_class == 'authenticated':
+        own_private_slugs = {
+            slug for slug, (visibility, author_id) in menu_pages.items()
+            if visibility == WikiPage.Visibility.PRIVATE and author_id == user.pk
+        }
+        if own_private_slugs:
+            return _filter_menu(menu_state['sections'], visible_slugs | own_private_slugs, menu_pages.keys(), True)
+
+    return caching.get_or_build(
+        f"wiki_menu:{visibility_class}:{generation}",
+        lambda: _filter_menu(menu_state['sections'], visible_slugs, menu_pages.keys(), user.is_authenticated),
+        MENU_CACHE_TIMEOUT,
+    )
+
 def wiki_menu(request):
     user = request.user
 
     menu_page_slug_val = constants.MENU_CONFIG_PAGE_SLUG
-    
-    try:
-        menu_config_page = WikiPage.objects.only('content', 'updated_at').get(slug=menu_page_slug_val)
-        cache_key = f"wiki_menu_parsed_structure_{menu_page_slug_val}_{menu_config_page.updated_at.timestamp()}"
-    except WikiPage.DoesNotExist:
-        menu_config_page = None
-        cache_key = f"wiki_menu_parsed_structure_default"
-
-    parsed_sections = cache.get(cache_key)
-    if parsed_sections is None:
-        if menu_config_page:
-            menu_config_content = menu_config_page.content
-        else:
-            menu_page_title = menu_page_slug_val.replace('-', ' ').title()
-            new_menu_page, _ = WikiPage.objects.get_or_create(
-                slug=menu_page_slug_val,
-                defaults={'title': menu_page_title, 'content': constants.DEFAULT_MENU_CONFIG}
-            )
-            menu_config_content = new_menu_page.content
-
-        parsed_sections = _parse_menu_data(menu_config_content, source_page_slug=menu_page_slug_val)
-        
-        cache.set(cache_key, parsed_sections, timeout=3600)
+    generation = services.get_generation()
+    menu_state = _get_menu_state(generation)
 
-    if parsed_sections:
-        custom_menu_sections = _filter_menu_for_user(parsed_sections, user)
+    if menu_state['sections']:
+        custom_menu_sections = _get_menu_for_user(generation, menu_state, user)
     else:
         try:
             menu_config_page_url = reverse('wiki:wiki_page', kwargs={'slug': menu_page_slug_val})
@@ -248,26 +285,14 @@ def wiki_menu(request):
             custom_menu_sections = []
 
 
-    if not user.is_authenticated:
-        user_type = 'anonymous'
-    elif user.is_staff:
-        user_type = 'staff'
-    else:
-        user_type = 'authenticated'
-        
-    search_data_cache_key = f'all_wiki_pages_for_search_{user_type}'
-    all_pages_for_search = cache.get(search_data_cache_key)
-    
-    if all_pages_for_search is None:
-        visible_pages = WikiPage.objects.get_visible_by_user(user).values('title', 'slug')
-        all_pages_for_search = [
-            {"title": p['title'], "url": reverse('wiki:wiki_page', kwargs={'slug': p['slug']})}
-            for p in visible_pages
-        ]
-        cache.set(search_data_cache_key, all_pages_for_search, timeout=600)
+    page_index_scope = services.get_page_index_scope(user, generation)
+    page_index_url = reverse('wiki:page_index', kwargs={
+        'scope': page_index_scope,
+        'version': services.get_page_index_version(page_index_scope, generation),
+    })
 
     return {
         "custom_wiki_menu_sections": custom_menu_sections,
         "MENU_CONFIG_PAGE_SLUG": menu_page_slug_val,
-        "all_wiki_pages_json": json.dumps(all_pages_for_search)
-    }
\ No newline at end of file
+        "page_index_url": page_index_url,
+    }
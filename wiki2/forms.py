@@ -1,6 +1,6 @@
 # wiki/forms.py
 from django import forms
-from .models import WikiPage, WikiFile, Profile
+from .models import WikiPage, WikiFile, Profile, UploadSession
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 
@@ -66,6 +66,12 @@ class WikiFileForm(forms.ModelForm):
             'filename_slug': 'This name (without extension) will be used for display. It will be auto-generated. This is also the name used to refrence this file in the wiki.'
         }
 
+class UploadSessionForm(forms.ModelForm):
+    """Starts a chunked upload; the file's bytes follow in separate requests."""
+    class Meta:
+        model = UploadSession
+        fields = ['filename', 'size', 'filename_slug']
+
 class UserUpdateForm(forms.ModelForm):
     email = forms.EmailField()
 
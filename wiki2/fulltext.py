@@ -0,0 +1,208 @@
+# wiki2/fulltext.py
+"""
+Full-text search over wiki page titles and content.
+
+The backend is picked from the database in use:
+- postgres:   a generated `tsvector` column on wiki2_wikipage with a GIN index.
+- sqlite_fts: an FTS5 virtual table kept in sync from the WikiPage signals.
+- inverted:   the in-process index of `inverted_index`, for databases without either.
+- basic:      plain `icontains` matching, only when configured explicitly.
+"""
+import re
+from functools import cache as memoize
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Value, FloatField
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import WikiPage
+from .utils import tokenize
+from . import inverted_index
+
+FTS_TABLE = 'wiki2_wikipage_fts'
+SEARCH_CONFIG = 'simple'
+
+# Private-use characters delimit highlighted terms until the snippet has been escaped.
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_END = '\ue001'
+
+SNIPPET_LENGTH = 200
+
+
+@memoize
+def _sqlite_fts_available() -> bool:
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def get_backend() -> str:
+    """Returns the name of the search backend to use for the default database."""
+    configured = settings.WIKI_SEARCH_BACKEND
+    if configured != 'auto':
+        return configured
+    if connection.vendor == 'postgresql':
+        return 'postgres'
+    if connection.vendor == 'sqlite' and _sqlite_fts_available():
+        return 'sqlite_fts'
+    return 'inverted'
+
+
+# --- Index maintenance ---
+
+def index_page(page: WikiPage):
+    """Brings the search index up to date with a saved page."""
+    backend = get_backend()
+    if backend == 'inverted':
+        # The index file isn't rolled back with the transaction, so only record committed pages.
+        page_id, title, content = page.pk, page.title, page.content
+        transaction.on_commit(lambda: inverted_index.index_document(page_id, title, content))
+    elif backend == 'sqlite_fts':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [page.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, title, content) VALUES (%s, %s, %s)",
+                [page.pk, page.title, page.content],
+            )
+    # The postgres search vector is a generated column, the database keeps it in sync.
+
+
+def remove_page(page_id: int):
+    """Drops a deleted page from the search index."""
+    backend = get_backend()
+    if backend == 'inverted':
+        transaction.on_commit(lambda: inverted_index.remove_document(page_id))
+    elif backend == 'sqlite_fts':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [page_id])
+
+
+def index_pages(page_ids):
+    """Brings the search index up to date with the given pages, after a bulk write."""
+    for page in WikiPage.objects.filter(pk__in=page_ids).only('pk', 'title', 'content'):
+        index_page(page)
+
+
+def rebuild_index():
+    """Rebuilds the whole search index from the pages table."""
+    backend = get_backend()
+    if backend == 'inverted':
+        inverted_index.rebuild()
+    elif backend == 'sqlite_fts':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, title, content) "
+                f"SELECT id, title, content FROM {WikiPage._meta.db_table}"
+            )
+
+
+# --- Querying ---
+
+def _fts5_query(query: str) -> str | None:
+    """Turns free user input into a safe FTS5 query: all terms, last one as a prefix."""
+    tokens = tokenize(query)
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def matching_pages(query: str, queryset):
+    """Filters a WikiPage queryset down to the pages matching the query, unordered."""
+    backend = get_backend()
+
+    if backend == 'postgres':
+        from django.contrib.postgres.search import SearchQuery, SearchVectorField
+        search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+        vector = RawSQL(f'"{WikiPage._meta.db_table}"."search_vector"', [], output_field=SearchVectorField())
+        return queryset.annotate(search_vector=vector).filter(search_vector=search_query)
+
+    if backend == 'inverted':
+        return queryset.filter(pk__in=[page_id for page_id, _score in inverted_index.search(query)])
+
+    if backend == 'sqlite_fts':
+        fts_query = _fts5_query(query)
+        if fts_query is None:
+            return queryset.none()
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.rowid = {WikiPage._meta.db_table}.id', f'{FTS_TABLE} MATCH %s'],
+            params=[fts_query],
+        )
+
+    terms = tokenize(query)
+    if not terms:
+        return queryset.none()
+    condition = Q()
+    for term in terms:
+        condition &= Q(title__icontains=term) | Q(content__icontains=term)
+    return queryset.filter(condition)
+
+
+def search_pages(query: str, queryset):
+    """
+    Returns the pages of `queryset` matching the query, best match first. Every result
+    carries a `search_rank`, and a `search_snippet` where the database can build one.
+    """
+    backend = get_backend()
+    if backend == 'inverted':
+        return inverted_index.RankedResults(inverted_index.search(query), queryset)
+
+    results = matching_pages(query, queryset)
+
+    if backend == 'postgres':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchHeadline
+        search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+        return results.annotate(
+            search_rank=SearchRank(F('search_vector'), search_query),
+            search_snippet=SearchHeadline(
+                'content', search_query, config=SEARCH_CONFIG,
+                start_sel=HIGHLIGHT_START, stop_sel=HIGHLIGHT_END,
+                max_words=35, min_words=15, max_fragments=2,
+            ),
+        ).defer('content').order_by('-search_rank', '-updated_at')
+
+    if backend == 'sqlite_fts':
+        # bm25() is "lower is better", title matches weigh ten times as much as content.
+        return results.extra(select={
+            'search_rank': f'bm25({FTS_TABLE}, 10.0, 1.0)',
+            'search_snippet': f"snippet({FTS_TABLE}, 1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 24)",
+        }).defer('content').order_by('search_rank', '-updated_at')
+
+    return results.annotate(search_rank=Value(0.0, output_field=FloatField())).order_by('-updated_at')
+
+
+def build_snippet(text: str, query: str) -> str:
+    """Cuts a highlighted snippet around the first query term found in the text."""
+    terms = tokenize(query)
+    if not text or not terms:
+        return text[:SNIPPET_LENGTH]
+
+    term_re = re.compile(r"\b(" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE)
+    match = term_re.search(text)
+    start = max(0, match.start() - SNIPPET_LENGTH // 3) if match else 0
+    window = text[start:start + SNIPPET_LENGTH]
+    snippet = term_re.sub(lambda m: f"{HIGHLIGHT_START}{m.group(0)}{HIGHLIGHT_END}", window)
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + SNIPPET_LENGTH < len(text) else ''
+    return f"{prefix}{snippet}{suffix}"
+
+
+def format_snippet(raw_snippet: str) -> str:
+    """Escapes a raw snippet and turns the highlight delimiters into <mark> tags."""
+    html = escape(raw_snippet)
+    html = html.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+    return mark_safe(html)
+
+
+def attach_snippets(results, query: str):
+    """Sets a ready-to-render `snippet` on each result of a (paginated) result list."""
+    for page in results:
+        raw_snippet = getattr(page, 'search_snippet', None)
+        if raw_snippet is None:
+            raw_snippet = build_snippet(page.content, query)
+        page.snippet = format_snippet(raw_snippet)
+    return results
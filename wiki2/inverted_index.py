@@ -0,0 +1,533 @@
+# wiki2/inverted_index.py
+"""
+A small in-process inverted index, the search fallback for databases without a
+full-text engine (SQLite builds without FTS5).
+
+Every token maps to a sorted array of page ids plus, in parallel, an array of the
+token's positions in each page, which is enough for prefix and phrase queries. The
+index lives in memory in every worker and is persisted as a compact varint-encoded
+snapshot plus an append-only delta log: saving a page appends that page's postings,
+and the log is folded into a new snapshot once it has grown to half the snapshot's
+size. Workers pick up each other's updates by reading the log from where they left off.
+"""
+import os
+import math
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, cross-process locking is skipped there.
+    fcntl = None
+
+from django.conf import settings
+
+from .models import WikiPage
+from .utils import tokenize
+
+FILE_MAGIC = b'WIKIIDX\x02'
+LOG_MAGIC = b'WIKILOG\x01'
+# Snapshot and log carry the same random id, so a log is never replayed onto another snapshot.
+LOG_ID_SIZE = 8
+LOG_HEADER_SIZE = len(LOG_MAGIC) + LOG_ID_SIZE
+COMPACT_MIN_BYTES = 1024 * 1024
+TITLE_WEIGHT = 10
+
+
+# --- Varint encoding ---
+
+def _write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def document_postings(title: str, content: str) -> tuple[int, dict[str, array]]:
+    """A page's number of title tokens and the positions of each of its tokens."""
+    title_tokens = tokenize(title)
+    token_positions: dict[str, array] = {}
+    for position, token in enumerate(title_tokens + tokenize(content)):
+        token_positions.setdefault(token, array('L')).append(position)
+    return len(title_tokens), token_positions
+
+
+class InvertedIndex:
+
+    def __init__(self):
+        self.postings: dict[str, array] = {}         # token -> sorted page ids
+        self.positions: dict[str, list[array]] = {}  # token -> positions, parallel to postings
+        self.doc_terms: dict[int, list[str]] = {}    # page id -> its distinct tokens
+        self.doc_title_length: dict[int, int] = {}   # page id -> number of title tokens
+        self.log_id = b''                            # the delta log that continues this snapshot
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    # --- Updates ---
+
+    def add_document(self, doc_id: int, title: str, content: str):
+        self.add_postings(doc_id, *document_postings(title, content))
+
+    def add_postings(self, doc_id: int, title_length: int, token_positions: dict[str, array]):
+        self.remove_document(doc_id)
+        for token, positions in token_positions.items():
+            doc_ids = self.postings.get(token)
+            if doc_ids is None:
+                self.postings[token] = array('L', [doc_id])
+                self.positions[token] = [positions]
+                self._vocabulary = None
+            else:
+                index = bisect_left(doc_ids, doc_id)
+                doc_ids.insert(index, doc_id)
+                self.positions[token].insert(index, positions)
+
+        self.doc_terms[doc_id] = list(token_positions)
+        self.doc_title_length[doc_id] = title_length
+
+    def remove_document(self, doc_id: int):
+        for token in self.doc_terms.pop(doc_id, ()):
+            doc_ids = self.postings[token]
+            index = bisect_left(doc_ids, doc_id)
+            del doc_ids[index]
+            del self.positions[token][index]
+            if not doc_ids:
+                del self.postings[token]
+                del self.positions[token]
+                self._vocabulary = None
+        self.doc_title_length.pop(doc_id, None)
+
+    # --- Queries ---
+
+    def _expand_prefix(self, prefix: str) -> list[str]:
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        start = bisect_left(self._vocabulary, prefix)
+        matches = []
+        for token in self._vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            matches.append(token)
+        return matches
+
+    def _score(self, token: str, doc_id: int, positions) -> float:
+        title_length = self.doc_title_length.get(doc_id, 0)
+        weighted_hits = sum(TITLE_WEIGHT if p < title_length else 1 for p in positions)
+        idf = math.log(1 + len(self.doc_terms) / len(self.postings[token]))
+        return weighted_hits * idf
+
+    def _term_scores(self, term: str, prefix: bool) -> dict[int, float]:
+        tokens = self._expand_prefix(term) if prefix else ([term] if term in self.postings else [])
+        scores: dict[int, float] = {}
+        for token in tokens:
+            for doc_id, positions in zip(self.postings[token], self.positions[token]):
+                scores[doc_id] = scores.get(doc_id, 0.0) + self._score(token, doc_id, positions)
+        return scores
+
+    def _phrase_scores(self, terms: list[str]) -> dict[int, float]:
+        if any(term not in self.postings for term in terms):
+            return {}
+
+        candidates = set(self.postings[terms[0]])
+        for term in terms[1:]:
+            candidates.intersection_update(self.postings[term])
+
+        scores = {}
+        for doc_id in candidates:
+            term_positions = []
+            for term in terms:
+                index = bisect_left(self.postings[term], doc_id)
+                term_positions.append(self.positions[term][index])
+            following = [set(positions) for positions in term_positions[1:]]
+            hits = [
+                start for start in term_positions[0]
+                if all(start + offset + 1 in positions for offset, positions in enumerate(following))
+            ]
+            if hits:
+                scores[doc_id] = sum(self._score(term, doc_id, hits) for term in terms)
+        return scores
+
+    def search(self, clauses: list[tuple[str, list[str], bool]]) -> list[tuple[int, float]]:
+        """
+        Runs an AND query. Each clause is ('term', [token], prefix) or ('phrase', tokens, False).
+        Returns (page id, score) pairs, best match first.
+        """
+        result = None
+        for kind, terms, prefix in clauses:
+            scores = self._phrase_scores(terms) if kind == 'phrase' else self._term_scores(terms[0], prefix)
+            if result is None:
+                result = scores
+            else:
+                result = {doc_id: result[doc_id] + score for doc_id, score in scores.items() if doc_id in result}
+            if not result:
+                return []
+        return sorted((result or {}).items(), key=lambda item: (-item[1], -item[0]))
+
+    # --- Persistence ---
+
+    def to_bytes(self) -> bytes:
+        buffer = bytearray(FILE_MAGIC)
+        buffer += self.log_id
+        _write_varint(buffer, len(self.doc_title_length))
+        for doc_id, title_length in self.doc_title_length.items():
+            _write_varint(buffer, doc_id)
+            _write_varint(buffer, title_length)
+
+        _write_varint(buffer, len(self.postings))
+        for token, doc_ids in self.postings.items():
+            encoded_token = token.encode('utf-8')
+            _write_varint(buffer, len(encoded_token))
+            buffer += encoded_token
+            _write_varint(buffer, len(doc_ids))
+            previous_doc_id = 0
+            for doc_id, positions in zip(doc_ids, self.positions[token]):
+                _write_varint(buffer, doc_id - previous_doc_id)
+                previous_doc_id = doc_id
+                _write_varint(buffer, len(positions))
+                previous_position = 0
+                for position in positions:
+                    _write_varint(buffer, position - previous_position)
+                    previous_position = position
+        return bytes(buffer)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'InvertedIndex':
+        if not data.startswith(FILE_MAGIC):
+            raise ValueError("Not a wiki search index file.")
+        index = cls()
+        index.log_id = data[len(FILE_MAGIC):len(FILE_MAGIC) + LOG_ID_SIZE]
+        offset = len(FILE_MAGIC) + LOG_ID_SIZE
+
+        doc_count, offset = _read_varint(data, offset)
+        for _ in range(doc_count):
+            doc_id, offset = _read_varint(data, offset)
+            title_length, offset = _read_varint(data, offset)
+            index.doc_title_length[doc_id] = title_length
+            index.doc_terms[doc_id] = []
+
+        token_count, offset = _read_varint(data, offset)
+        for _ in range(token_count):
+            token_length, offset = _read_varint(data, offset)
+            token = data[offset:offset + token_length].decode('utf-8')
+            offset += token_length
+            posting_count, offset = _read_varint(data, offset)
+
+            doc_ids = array('L')
+            token_positions = []
+            doc_id = 0
+            for _ in range(posting_count):
+                delta, offset = _read_varint(data, offset)
+                doc_id += delta
+                position_count, offset = _read_varint(data, offset)
+                positions = array('L')
+                position = 0
+                for _ in range(position_count):
+                    delta, offset = _read_varint(data, offset)
+                    position += delta
+                    positions.append(position)
+                doc_ids.append(doc_id)
+                token_positions.append(positions)
+                index.doc_terms[doc_id].append(token)
+
+            index.postings[token] = doc_ids
+            index.positions[token] = token_positions
+        return index
+
+
+# --- Delta log records ---
+# Each record is length-prefixed, so a record cut short by a crash is recognized and dropped.
+
+def _write_positions(buffer: bytearray, positions):
+    _write_varint(buffer, len(positions))
+    previous_position = 0
+    for position in positions:
+        _write_varint(buffer, position - previous_position)
+        previous_position = position
+
+
+def encode_record(doc_id: int, postings: tuple[int, dict[str, array]] | None) -> bytes:
+    """A log record with a page's postings (see `document_postings`), or its removal for None."""
+    payload = bytearray()
+    _write_varint(payload, doc_id)
+    if postings is None:
+        payload.append(0)
+    else:
+        title_length, token_positions = postings
+        payload.append(1)
+        _write_varint(payload, title_length)
+        _write_varint(payload, len(token_positions))
+        for token, positions in token_positions.items():
+            encoded_token = token.encode('utf-8')
+            _write_varint(payload, len(encoded_token))
+            payload += encoded_token
+            _write_positions(payload, positions)
+    record = bytearray()
+    _write_varint(record, len(payload))
+    return bytes(record + payload)
+
+
+def apply_records(index: InvertedIndex, data: bytes) -> int:
+    """Replays the complete records in `data` onto the index. Returns how many bytes they took."""
+    offset = 0
+    while offset < len(data):
+        try:
+            length, start = _read_varint(data, offset)
+        except IndexError:
+            break
+        if start + length > len(data):
+            break
+        doc_id, position = _read_varint(data, start)
+        if data[position] == 0:
+            index.remove_document(doc_id)
+        else:
+            title_length, position = _read_varint(data, position + 1)
+            token_count, position = _read_varint(data, position)
+            token_positions = {}
+            for _ in range(token_count):
+                token_length, position = _read_varint(data, position)
+                token = data[position:position + token_length].decode('utf-8')
+                position += token_length
+                position_count, position = _read_varint(data, position)
+                positions = array('L')
+                value = 0
+                for _ in range(position_count):
+                    delta, position = _read_varint(data, position)
+                    value += delta
+                    positions.append(value)
+                token_positions[token] = positions
+            index.add_postings(doc_id, title_length, token_positions)
+        offset = start + length
+    return offset
+
+
+# --- Process-wide index ---
+
+_lock = threading.Lock()
+_state = {'index': None, 'log_id': None, 'log_offset': 0, 'snapshot_size': 0, 'file_locked': False}
+
+
+def _index_path() -> str:
+    return str(settings.WIKI_SEARCH_INDEX_PATH)
+
+
+def _log_path() -> str:
+    return _index_path() + '.log'
+
+
+@contextmanager
+def _file_lock():
+    """Serializes index writes between worker processes."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(_index_path()) or '.', exist_ok=True)
+    with open(_index_path() + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _state['file_locked'] = True
+        try:
+            yield
+        finally:
+            _state['file_locked'] = False
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _replace_file(path: str, data: bytes):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as tmp_file:
+        tmp_file.write(data)
+    os.chmod(tmp_file.name, 0o644)
+    os.replace(tmp_file.name, path)
+
+
+def _write_snapshot(index: InvertedIndex):
+    """Persists the whole index as a new snapshot, followed by an empty delta log of its own."""
+    index.log_id = os.urandom(LOG_ID_SIZE)
+    data = index.to_bytes()
+    _replace_file(_index_path(), data)
+    _replace_file(_log_path(), LOG_MAGIC + index.log_id)
+    _state.update(index=index, log_id=index.log_id, log_offset=LOG_HEADER_SIZE, snapshot_size=len(data))
+
+
+def _load_snapshot() -> bool:
+    try:
+        with open(_index_path(), 'rb') as index_file:
+            data = index_file.read()
+        index = InvertedIndex.from_bytes(data)
+    except (FileNotFoundError, ValueError):
+        return False
+    _state.update(index=index, log_id=index.log_id, log_offset=LOG_HEADER_SIZE, snapshot_size=len(data))
+    return True
+
+
+def _read_log(offset: int | None) -> tuple[bytes | None, bytes]:
+    """
+    The log's id and its bytes from `offset` on (only meaningful if the id is the expected
+    one). With offset=None only the header is read.
+    """
+    try:
+        with open(_log_path(), 'rb') as log_file:
+            header = log_file.read(LOG_HEADER_SIZE)
+            if len(header) < LOG_HEADER_SIZE or not header.startswith(LOG_MAGIC):
+                return None, b''
+            if offset is None:
+                return header[len(LOG_MAGIC):], b''
+            log_file.seek(offset)
+            return header[len(LOG_MAGIC):], log_file.read()
+    except FileNotFoundError:
+        return None, b''
+
+
+def _build_from_database() -> InvertedIndex:
+    index = InvertedIndex()
+    for page_id, title, content in WikiPage.objects.values_list('id', 'title', 'content').iterator():
+        index.add_document(page_id, title, content)
+    return index
+
+
+def _current_index() -> InvertedIndex:
+    """Returns the in-memory index, caught up with the records other processes appended."""
+    log_id, new_data = _read_log(_state['log_offset'])
+    if _state['index'] is None or log_id != _state['log_id']:
+        # First use, or another process compacted: start over from the snapshot.
+        if not _load_snapshot():
+            if not _state['file_locked']:
+                with _file_lock():
+                    return _current_index()
+            _write_snapshot(_build_from_database())
+            return _state['index']
+        log_id, new_data = _read_log(_state['log_offset'])
+        if log_id != _state['log_id']:
+            return _state['index']  # Its log isn't written yet, so it has nothing to add
+    _state['log_offset'] += apply_records(_state['index'], new_data)
+    return _state['index']
+
+
+def _append(record: bytes):
+    """Appends a record to the log, or compacts instead once the log has grown large enough."""
+    log_size = _state['log_offset'] + len(record)
+    if _read_log(None)[0] != _state['log_id'] or log_size > max(COMPACT_MIN_BYTES, _state['snapshot_size'] // 2):
+        _write_snapshot(_state['index'])
+        return
+    with open(_log_path(), 'r+b') as log_file:
+        # Drops the tail of a record a crashed writer left half-written.
+        log_file.truncate(_state['log_offset'])
+        log_file.seek(_state['log_offset'])
+        log_file.write(record)
+    _state['log_offset'] = log_size
+
+
+def index_document(page_id: int, title: str, content: str):
+    postings = document_postings(title, content)
+    with _lock, _file_lock():
+        _current_index().add_postings(page_id, *postings)
+        _append(encode_record(page_id, postings))
+
+
+def remove_document(page_id: int):
+    with _lock, _file_lock():
+        _current_index().remove_document(page_id)
+        _append(encode_record(page_id, None))
+
+
+def rebuild():
+    with _lock, _file_lock():
+        _write_snapshot(_build_from_database())
+
+
+def parse_query(query: str) -> list[tuple[str, list[str], bool]]:
+    """
+    Splits user input into query clauses: "quoted text" is a phrase, a trailing `*`
+    makes a prefix term, and the last bare term is always matched as a prefix.
+    """
+    clauses = []
+    for i, part in enumerate(query.split('"')):
+        if i % 2 == 1:
+            tokens = tokenize(part)
+            if len(tokens) > 1:
+                clauses.append(('phrase', tokens, False))
+            elif tokens:
+                clauses.append(('term', tokens, False))
+            continue
+        for word in part.split():
+            for token in tokenize(word):
+                clauses.append(('term', [token], word.endswith('*')))
+
+    last_kind, last_terms, _ = clauses[-1] if clauses else (None, None, None)
+    if last_kind == 'term' and not query.rstrip().endswith('"'):
+        clauses[-1] = ('term', last_terms, True)
+    return clauses
+
+
+def search(query: str) -> list[tuple[int, float]]:
+    """Returns (page id, score) pairs for all pages matching the query, best first."""
+    clauses = parse_query(query)
+    if not clauses:
+        return []
+    with _lock:
+        return _current_index().search(clauses)
+
+
+class RankedResults:
+    """
+    Lazily filters ranked page ids through a visibility queryset. Only the matching
+    candidates are ever checked against the database, in chunks, and only the slice
+    being displayed is loaded. Sliceable and countable, so it works with Paginator.
+    """
+    ordered = True
+    CHUNK_SIZE = 500
+
+    def __init__(self, ranked: list[tuple[int, float]], queryset):
+        self.ranked = ranked
+        self.queryset = queryset
+        self._visible = None
+
+    def _visible_ranked(self) -> list[tuple[int, float]]:
+        if self._visible is None:
+            visible = []
+            for start in range(0, len(self.ranked), self.CHUNK_SIZE):
+                chunk = self.ranked[start:start + self.CHUNK_SIZE]
+                allowed = set(self.queryset.filter(pk__in=[page_id for page_id, _ in chunk]).values_list('pk', flat=True))
+                visible.extend(item for item in chunk if item[0] in allowed)
+            self._visible = visible
+        return self._visible
+
+    def count(self) -> int:
+        return len(self._visible_ranked())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        selected = self._visible_ranked()[key]
+        pages = self.queryset.in_bulk([page_id for page_id, _ in selected])
+        results = []
+        for page_id, score in selected:
+            page = pages.get(page_id)
+            if page is None:
+                continue  # Deleted since the search ran
+            page.search_rank = score
+            results.append(page)
+        return results
+
+    def first(self):
+        results = self[0:1]
+        return results[0] if results else None
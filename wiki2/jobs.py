@@ -0,0 +1,129 @@
+# wiki2/jobs.py
+"""
+A small database-backed queue for slow media work.
+
+Requests only enqueue MediaJobs. The `run_media_worker` command claims them, reads the
+source bytes and hands the CPU-heavy part (HEIC conversion, resizing) to a process pool,
+so a gallery full of phone photos no longer ties up the web server's threads.
+"""
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import WikiFile, MediaJob
+from . import constants
+from . import services
+
+MAX_ATTEMPTS = 3
+HEIC_EXTENSIONS = ['.heic', '.heif']
+
+
+def is_heic(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in HEIC_EXTENSIONS
+
+
+# --- Enqueueing ---
+
+def enqueue(kind: str, wiki_file: WikiFile, member_path: str = '', restart: bool = False) -> MediaJob:
+    """
+    Queues a job unless the same one already exists. With `restart`, a finished or failed
+    job is queued again, e.g. because the attachment's bytes were replaced.
+    """
+    job, created = MediaJob.objects.get_or_create(kind=kind, wiki_file=wiki_file, member_path=member_path)
+    if not created and restart and job.status != MediaJob.Status.PENDING:
+        MediaJob.objects.filter(pk=job.pk).update(status=MediaJob.Status.PENDING, attempts=0, error='')
+        job.status = MediaJob.Status.PENDING
+    return job
+
+
+def enqueue_for_upload(wiki_file: WikiFile):
+    """Queues everything worth precomputing for a new or replaced attachment."""
+    if services.supports_derivatives(wiki_file.file.name):
+        enqueue(MediaJob.Kind.IMAGE_DERIVATIVES, wiki_file, restart=True)
+        return
+
+    if os.path.splitext(wiki_file.file.name)[1].lower() not in constants.WIKI_ARCHIVE_EXTENSIONS:
+        return
+    archive_index = services.ensure_archive_index(wiki_file)
+    if archive_index is None:
+        return
+    for member_path in archive_index['members']:
+        if member_path.startswith('__MACOSX'):
+            continue
+        if is_heic(member_path):
+            enqueue(MediaJob.Kind.CONVERT_HEIC, wiki_file, member_path, restart=True)
+        elif services.supports_derivatives(member_path):
+            enqueue(MediaJob.Kind.IMAGE_DERIVATIVES, wiki_file, member_path, restart=True)
+
+
+# --- Claiming and finishing (worker side) ---
+
+def requeue_stalled():
+    """Puts back jobs left running by a worker that died or was restarted."""
+    cutoff = timezone.now() - timedelta(seconds=settings.WIKI_MEDIA_JOB_TIMEOUT)
+    return MediaJob.objects.filter(status=MediaJob.Status.RUNNING, started_at__lt=cutoff).update(status=MediaJob.Status.PENDING)
+
+
+def claim(limit: int) -> list[MediaJob]:
+    """
+    Marks up to `limit` pending jobs as running and returns them, oldest first. Each claim
+    is a conditional UPDATE, so several workers never pick up the same job.
+    """
+    candidate_ids = list(
+        MediaJob.objects.filter(status=MediaJob.Status.PENDING)
+        .order_by('created_at').values_list('pk', flat=True)[:limit]
+    )
+    claimed_ids = [
+        job_id for job_id in candidate_ids
+        if MediaJob.objects.filter(pk=job_id, status=MediaJob.Status.PENDING).update(
+            status=MediaJob.Status.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1,
+        )
+    ]
+    return list(MediaJob.objects.filter(pk__in=claimed_ids).select_related('wiki_file__page').order_by('created_at'))
+
+
+def build_tasks(job: MediaJob) -> list[tuple]:
+    """
+    Returns the job's CPU-bound work as (function, args) pairs for the process pool. The
+    functions touch neither the database nor the cache. Raises ValueError for bad sources.
+    """
+    wiki_file = job.wiki_file
+
+    if job.kind == MediaJob.Kind.CONVERT_HEIC:
+        path = services.get_converted_image_path(wiki_file, job.member_path)
+        if os.path.exists(path):
+            return []
+        heic_bytes = services.get_image_bytes_from_archive(wiki_file, job.member_path)
+        if heic_bytes is None:
+            raise ValueError(f"'{job.member_path}' not found in archive.")
+        fmt, quality = settings.WIKI_HEIC_OUTPUT_FORMAT, settings.WIKI_HEIC_OUTPUT_QUALITY
+        return [(services.write_converted_heic, (heic_bytes, path, fmt, quality))]
+
+    member_path = job.member_path or None
+    tasks = []
+    for variant, max_size in constants.IMAGE_DERIVATIVE_SIZES.items():
+        for fmt in services.get_derivative_formats():
+            path = services.get_derivative_path(wiki_file, variant, fmt, member_path)
+            if not os.path.exists(path):
+                tasks.append((variant, max_size, fmt, path))
+    if not tasks:
+        return []
+    source = services.get_derivative_source(wiki_file, member_path)
+    if source is None:
+        raise ValueError("Not a usable image.")
+    return [(services.write_image_derivative, (source, max_size, fmt, path)) for _variant, max_size, fmt, path in tasks]
+
+
+def finish(job: MediaJob, error: str = ''):
+    """Records the outcome of a claimed job. Failed jobs are retried up to MAX_ATTEMPTS times."""
+    if not error:
+        status = MediaJob.Status.DONE
+    elif job.attempts < MAX_ATTEMPTS:
+        status = MediaJob.Status.PENDING
+    else:
+        status = MediaJob.Status.FAILED
+    MediaJob.objects.filter(pk=job.pk).update(status=status, error=error, finished_at=timezone.now())
+
@@ -0,0 +1,77 @@
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from wiki2 import backups
+
+WORDS = (
+    "wiki page markdown attachment gallery backup restore archive image link search "
+    "the a of and to in is for on with as by at from this that it be are was"
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Compares the throughput of the backup archive writers on a synthetic media tree.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=256,
+            help='Size of the synthetic media tree in MiB. Half is text, half incompressible "photos".'
+        )
+        parser.add_argument(
+            '--file-size',
+            type=int,
+            default=4,
+            help='Size of each synthetic file in MiB.'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of processes for the parallel tar.gz writer.'
+        )
+
+    def _build_tree(self, root: Path, total_size: int, file_size: int) -> list[tuple[str, str]]:
+        rng = random.Random(0)
+        members = []
+        for i in range(max(2, total_size // file_size)):
+            if i % 2:
+                path = root / f"page-{i}" / f"photo-{i}.jpg"
+                data = rng.randbytes(file_size)
+            else:
+                path = root / f"page-{i}" / f"notes-{i}.txt"
+                text = ' '.join(rng.choices(WORDS, k=file_size // 4))
+                data = text.encode('ascii')[:file_size]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+            members.append((str(path.relative_to(root)), str(path)))
+        return members
+
+    def handle(self, *args, **options):
+        jobs = max(1, options['jobs'])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir) / 'media'
+            members = self._build_tree(root, options['size'] * 1024 * 1024, options['file_size'] * 1024 * 1024)
+            input_size = sum(os.path.getsize(path) for _arcname, path in members)
+            self.stdout.write(f"{len(members)} file(s), {input_size / 1024 / 1024:.0f} MiB, {jobs} job(s).\n")
+
+            writers = [('zip (single thread)', 'zip', 1), ('tar.gz, 1 process', 'tar.gz', 1)]
+            if jobs > 1:
+                writers.append((f"tar.gz, {jobs} processes", 'tar.gz', jobs))
+
+            self.stdout.write(f"{'writer':<24} {'seconds':>8} {'MiB/s':>8} {'x input':>8}")
+            for name, archive_format, writer_jobs in writers:
+                output_path = os.path.join(temp_dir, f"backup{backups.ARCHIVE_FORMATS[archive_format]}")
+                start = time.perf_counter()
+                backups.write_archive(output_path, iter(members), archive_format, writer_jobs)
+                elapsed = time.perf_counter() - start
+                output_size = os.path.getsize(output_path)
+                os.remove(output_path)
+                self.stdout.write(
+                    f"{name:<24} {elapsed:>8.2f} {input_size / 1024 / 1024 / elapsed:>8.1f} {output_size / input_size:>8.2f}"
+                )
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from statistics import median
+
+from django.core.management.base import BaseCommand, CommandError
+from wiki2 import services
+
+HEIC_SUFFIXES = {'.heic', '.heif'}
+
+
+def convert_heic_to_png_bytes(heic_bytes: bytes) -> bytes:
+    """The conversion the wiki used before the in-memory path: heic2png, through temporary files."""
+    from heic2png import HEIC2PNG  # pyright: ignore[reportMissingImports] # Only needed for this comparison
+
+    tmp_heic_path = None
+    output_png_path = None
+    try:
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.heic', delete=False) as tmp_heic:
+            tmp_heic.write(heic_bytes)
+            tmp_heic_path = tmp_heic.name
+
+        heic_img = HEIC2PNG(tmp_heic_path, quality=90)
+        heic_img.save()
+
+        output_png_path = os.path.splitext(tmp_heic_path)[0] + '.png'
+        with open(output_png_path, 'rb') as png_file:
+            return png_file.read()
+    finally:
+        if tmp_heic_path and os.path.exists(tmp_heic_path):
+            os.remove(tmp_heic_path)
+        if output_png_path and os.path.exists(output_png_path):
+            os.remove(output_png_path)
+
+
+class Command(BaseCommand):
+    help = 'Compares the temp-file HEIC to PNG conversion with the in-memory conversion paths on sample images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='HEIC files, or directories to search for them.'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='How many times to convert each image per path. The median time is reported.'
+        )
+        parser.add_argument(
+            '--quality',
+            type=int,
+            default=85,
+            help='Quality for the webp and jpeg outputs.'
+        )
+
+    def _find_samples(self, paths):
+        samples = []
+        for path in map(Path, paths):
+            if path.is_dir():
+                samples.extend(sorted(p for p in path.rglob('*') if p.suffix.lower() in HEIC_SUFFIXES))
+            elif path.is_file():
+                samples.append(path)
+            else:
+                raise CommandError(f"Not a file or directory: {path}")
+        if not samples:
+            raise CommandError("No HEIC files found.")
+        return samples
+
+    def handle(self, *args, **options):
+        samples = [(path, path.read_bytes()) for path in self._find_samples(options['paths'])]
+        repeat = max(1, options['repeat'])
+        quality = options['quality']
+        input_size = sum(len(data) for _path, data in samples)
+        self.stdout.write(f"{len(samples)} sample(s), {input_size / 1024:.0f} KiB of HEIC, {repeat} run(s) each.\n")
+
+        conversions = [
+            ('temp files -> png (heic2png)', convert_heic_to_png_bytes),
+            ('in memory -> png', lambda data: services.convert_heic_bytes(data, 'png')),
+            ('in memory -> webp', lambda data: services.convert_heic_bytes(data, 'webp', quality)),
+            ('in memory -> jpeg', lambda data: services.convert_heic_bytes(data, 'jpeg', quality)),
+        ]
+
+        self.stdout.write(f"{'path':<30} {'ms/image':>10} {'output KiB':>12} {'x input':>8}")
+        for name, convert in conversions:
+            timings = []
+            output_size = 0
+            try:
+                for _path, data in samples:
+                    runs = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        output = convert(data)
+                        runs.append(time.perf_counter() - start)
+                    timings.append(median(runs))
+                    output_size += len(output)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"{name:<30} failed: {e}"))
+                continue
+            ms_per_image = 1000 * sum(timings) / len(timings)
+            self.stdout.write(f"{name:<30} {ms_per_image:>10.1f} {output_size / 1024:>12.0f} {output_size / input_size:>8.2f}")
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from wiki2.models import WikiFile, wiki_page_file_path
+from wiki2.storage import BLOB_DIRECTORY
+from wiki2 import services
+from wiki2 import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes attachment blobs no attachment refers to any more (left behind by uploads '
+        'that failed or raced a delete). With --migrate-legacy, first moves attachments still '
+        'stored under wiki_files/<page>/ into the content-addressed blob store.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--migrate-legacy',
+            action='store_true',
+            help='Move attachments stored before the blob store into it, deduplicating them.'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Don't change anything; just show what would be done."
+        )
+
+    def handle(self, *args, **options):
+        if options['migrate_legacy']:
+            self._migrate_legacy(options['dry_run'])
+
+        count, size = services.collect_unreferenced_blobs(dry_run=options['dry_run'])
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {count} unreferenced blob(s), {size / 1024 / 1024:.1f} MiB."))
+
+    def _migrate_legacy(self, dry_run: bool):
+        storage = WikiFile.file.field.storage
+        legacy_files = WikiFile.objects.exclude(file__startswith=f"{BLOB_DIRECTORY}/").exclude(file='').select_related('page')
+        self.stdout.write(f"{legacy_files.count()} attachment(s) stored outside the blob store.")
+        if dry_run:
+            return
+
+        touched_page_ids = set()
+        migrated = 0
+        for wiki_file in legacy_files.iterator(chunk_size=200):
+            old_name = wiki_file.file.name
+            try:
+                with open(storage.path(old_name), 'rb') as source:
+                    new_name = storage.save(wiki_page_file_path(wiki_file, old_name), File(source))
+            except FileNotFoundError:
+                self.stderr.write(self.style.WARNING(f"  - File missing, skipped: {old_name}"))
+                continue
+            # Derivatives are versioned by the stored name, so the old ones are stale now.
+            services.remove_image_derivatives(wiki_file)
+            WikiFile.objects.filter(pk=wiki_file.pk).update(file=new_name)
+            services.release_blobs([old_name])
+            wiki_file.file.name = new_name
+            if settings.WIKI_MEDIA_WORKER_ENABLED:
+                jobs.enqueue_for_upload(wiki_file)
+            touched_page_ids.add(wiki_file.page_id)
+            migrated += 1
+            self.stdout.write(f"  - {old_name} -> {new_name}")
+
+        services.invalidate_rendered_pages(touched_page_ids)
+        services.bump_generation()
+        self.stdout.write(f"Moved {migrated} attachment(s) into the blob store.")
@@ -1,10 +1,12 @@
 import os
-import shutil
-import zipfile
 from datetime import datetime
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
 from wiki2.models import WikiPage
+from wiki2 import backups
+from wiki2.storage import blob_digest
+
+PAGE_CHUNK_SIZE = 200
+
 
 class Command(BaseCommand):
     help = 'Creates a backup of all wiki pages, their content and attachments.'
@@ -14,7 +16,27 @@ class Command(BaseCommand):
             '--output-dir',
             type=str,
             default='/backups_archive',
-            help='The directory where backup ZIP files will be stored.'
+            help='The directory where backup files will be stored.'
+        )
+        parser.add_argument(
+            '--format',
+            choices=list(backups.ARCHIVE_FORMATS),
+            default='zip',
+            help='Archive format. tar.gz is compressed in parallel, see --jobs.'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of processes compressing a tar.gz backup. Defaults to the number of CPU cores.'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help=(
+                'Write a snapshot manifest instead of a ZIP file. Page content and attachments go '
+                'into a deduplicated blob store in the output directory, so only changes take up space.'
+            )
         )
 
     def handle(self, *args, **options):
@@ -26,77 +48,128 @@ class Command(BaseCommand):
             except OSError as e:
                 raise CommandError(f"Could not create backup output directory {output_dir}: {e}")
 
+        pages = WikiPage.objects.all()
+        if not pages.exists():
+            self.stdout.write(self.style.WARNING("No wiki pages found to back up."))
+            return
+
         timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M')
-        temp_base_staging_dir = os.path.join(settings.BASE_DIR, 'temp_backup_staging')
-        current_backup_staging_path = os.path.join(temp_base_staging_dir, timestamp)
-        
-        if os.path.exists(current_backup_staging_path):
-            shutil.rmtree(current_backup_staging_path)
-        os.makedirs(current_backup_staging_path, exist_ok=True)
+        if options['incremental']:
+            self._create_incremental_backup(output_dir, timestamp, pages)
+            return
 
-        self.stdout.write(f"Starting backup process. Staging in: {current_backup_staging_path}")
+        archive_format = options['format']
+        archive_filepath = os.path.join(output_dir, f"{timestamp}{backups.ARCHIVE_FORMATS[archive_format]}")
+        # Written under a hidden name and renamed when complete, so prune_backups and
+        # restores never see a half-written archive.
+        partial_filepath = os.path.join(output_dir, f".{os.path.basename(archive_filepath)}.partial")
+        jobs = max(1, options['jobs'])
+
+        self.stdout.write(f"Starting backup process. Writing to: {archive_filepath}")
+        if archive_format == 'tar.gz':
+            self.stdout.write(f"Compressing on {jobs} process(es).")
 
         try:
-            pages = WikiPage.objects.all()
-            if not pages.exists():
-                self.stdout.write(self.style.WARNING("No wiki pages found to back up."))
-                shutil.rmtree(current_backup_staging_path)
-                return
-
-            for page in pages:
-                page_slug_for_path = page.slug if page.slug else f"page-id-{page.id}"
-                self.stdout.write(f"Backing up page: '{page.title}' (slug: {page_slug_for_path})")
-                
-                page_backup_content_dir = os.path.join(current_backup_staging_path, page_slug_for_path)
-                os.makedirs(page_backup_content_dir, exist_ok=True)
-
-                # NOTE: 1. Save main content (plain-text)
-                content_file_path = os.path.join(page_backup_content_dir, 'content.md')
-                with open(content_file_path, 'w', encoding='utf-8') as f:
-                    f.write(page.content)
-                self.stdout.write(f"  - Saved content.md for '{page_slug_for_path}'")
-
-                # NOTE: 2. Save attachments
-                attachments = page.files.all()
-                if attachments.exists():
-                    attachments_dir = os.path.join(page_backup_content_dir, 'attachments')
-                    os.makedirs(attachments_dir, exist_ok=True)
-                    for attachment in attachments:
-                        if attachment.file and hasattr(attachment.file, 'path'):
-                            try:
-                                source_path = attachment.file.path
-                                if os.path.exists(source_path):
-                                    dest_filename = attachment.filename_display
-                                    dest_path = os.path.join(attachments_dir, dest_filename)
-                                    shutil.copy2(source_path, dest_path)
-                                    self.stdout.write(f"    - Copied attachment: {dest_filename}")
-                                else:
-                                    self.stderr.write(self.style.WARNING(f"    - Attachment file not found: {source_path} for page '{page_slug_for_path}'"))
-                            except Exception as e:
-                                self.stderr.write(self.style.ERROR(f"    - Error copying attachment {getattr(attachment, 'filename_display', 'N/A')} for page '{page_slug_for_path}': {e}"))
-                        else:
-                             self.stderr.write(self.style.WARNING(f"    - Attachment object for page '{page_slug_for_path}' lacks file or path attribute."))
-                else:
-                    self.stdout.write(f"  - No attachments for '{page_slug_for_path}'")
-
-            zip_filename = f"{timestamp}.zip"
-            zip_filepath = os.path.join(output_dir, zip_filename)
-            
-            self.stdout.write(f"Zipping backup contents from {current_backup_staging_path} to {zip_filepath}...")
-            with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for root, _, files in os.walk(current_backup_staging_path):
-                    for file_item in files:
-                        file_path_to_zip = os.path.join(root, file_item)
-                        arcname = os.path.relpath(file_path_to_zip, current_backup_staging_path)
-                        zf.write(file_path_to_zip, arcname=arcname)
-            
-            self.stdout.write(self.style.SUCCESS(f"Successfully created backup: {zip_filepath}"))
+            backups.write_archive(partial_filepath, self._iter_members(pages), archive_format, jobs)
+            os.replace(partial_filepath, archive_filepath)
+            self.stdout.write(self.style.SUCCESS(f"Successfully created backup: {archive_filepath}"))
 
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"An error occurred during backup: {e}"))
             import traceback
             self.stderr.write(traceback.format_exc())
         finally:
-            if os.path.exists(current_backup_staging_path):
-                shutil.rmtree(current_backup_staging_path)
-                self.stdout.write(f"Cleaned up temporary staging directory: {current_backup_staging_path}")
\ No newline at end of file
+            if os.path.exists(partial_filepath):
+                os.remove(partial_filepath)
+                self.stdout.write(f"Removed incomplete backup file: {partial_filepath}")
+
+    def _iter_members(self, pages):
+        """
+        Yields the archive members straight from the database cursor and the media directory,
+        without a staging copy on disk.
+        """
+        pages = pages.only('id', 'slug', 'title', 'content').order_by('pk').prefetch_related('files')
+        for page in pages.iterator(chunk_size=PAGE_CHUNK_SIZE):
+            page_slug_for_path = page.slug if page.slug else f"page-id-{page.id}"
+            self.stdout.write(f"Backing up page: '{page.title}' (slug: {page_slug_for_path})")
+
+            # NOTE: 1. Save main content (plain-text)
+            yield f"{page_slug_for_path}/content.md", page.content.encode('utf-8')
+
+            # NOTE: 2. Save attachments
+            attachments = page.files.all()
+            if not attachments:
+                self.stdout.write(f"  - No attachments for '{page_slug_for_path}'")
+                continue
+            for attachment in attachments:
+                if not attachment.file:
+                    self.stderr.write(self.style.WARNING(f"    - Attachment object for page '{page_slug_for_path}' lacks a file."))
+                    continue
+                source_path = attachment.file.path
+                if not os.path.exists(source_path):
+                    self.stderr.write(self.style.WARNING(f"    - Attachment file not found: {source_path} for page '{page_slug_for_path}'"))
+                    continue
+                dest_filename = attachment.filename_display
+                yield f"{page_slug_for_path}/attachments/{dest_filename}", source_path
+                self.stdout.write(f"    - Added attachment: {dest_filename}")
+
+    def _create_incremental_backup(self, output_dir: str, timestamp: str, pages):
+        manifest_path = os.path.join(output_dir, f"{timestamp}{backups.MANIFEST_SUFFIX}")
+        self.stdout.write(f"Starting incremental backup. Writing to: {manifest_path}")
+
+        hash_cache = backups.load_hash_cache(output_dir)
+        new_hash_cache = {}
+        manifest_pages = []
+        new_blobs = new_bytes = 0
+
+        pages = pages.only('id', 'slug', 'title', 'visibility', 'content').order_by('pk').prefetch_related('files')
+        for page in pages.iterator(chunk_size=PAGE_CHUNK_SIZE):
+            page_slug_for_path = page.slug if page.slug else f"page-id-{page.id}"
+            content = page.content.encode('utf-8')
+            content_digest, is_new = backups.store_bytes(output_dir, content)
+            if is_new:
+                new_blobs += 1
+                new_bytes += len(content)
+
+            attachments = []
+            for attachment in page.files.all():
+                if not attachment.file:
+                    continue
+                source_path = attachment.file.path
+                try:
+                    stat_result = os.stat(source_path)
+                except FileNotFoundError:
+                    self.stderr.write(self.style.WARNING(f"    - Attachment file not found: {source_path} for page '{page_slug_for_path}'"))
+                    continue
+
+                fingerprint = [stat_result.st_size, stat_result.st_mtime_ns]
+                cached = hash_cache.get(attachment.file.name)
+                # Attachments in the blob store are named after their SHA-256, like backup blobs.
+                stored_digest = blob_digest(attachment.file.name)
+                if stored_digest and backups.has_blob(output_dir, stored_digest):
+                    digest = stored_digest
+                elif cached and cached[:2] == fingerprint and backups.has_blob(output_dir, cached[2]):
+                    digest = cached[2]
+                else:
+                    digest, is_new = backups.store_file(output_dir, source_path)
+                    if is_new:
+                        new_blobs += 1
+                        new_bytes += stat_result.st_size
+                        self.stdout.write(f"    - Stored attachment: {attachment.filename_display} ('{page_slug_for_path}')")
+                new_hash_cache[attachment.file.name] = [*fingerprint, digest]
+                attachments.append({'name': attachment.filename_display, 'blob': digest, 'size': stat_result.st_size})
+
+            manifest_pages.append({
+                'slug': page_slug_for_path,
+                'title': page.title,
+                'visibility': page.visibility,
+                'content': content_digest,
+                'attachments': attachments,
+            })
+
+        backups.write_manifest(manifest_path, manifest_pages)
+        backups.save_hash_cache(output_dir, new_hash_cache)
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully created backup: {manifest_path} ({len(manifest_pages)} page(s), "
+            f"{new_blobs} new blob(s), {new_bytes / 1024 / 1024:.1f} MiB added)"
+        ))
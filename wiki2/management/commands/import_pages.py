@@ -0,0 +1,260 @@
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from wiki2.models import WikiPage, WikiFile
+from wiki2.utils import next_free_slug
+from wiki2 import bulk
+from wiki2 import services
+
+MARKDOWN_SUFFIXES = {'.md', '.markdown'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports a directory tree or archive (.zip, .tar.gz, ...) of Markdown files as wiki pages. '
+        'Other files are attached to the page named after the directory they are in, e.g. '
+        'guide/diagram.png to guide.md. Rows are written in batches without per-row signals; '
+        'the link graph, search index and media jobs are brought up to date once at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source',
+            type=str,
+            help='A directory, or a ZIP or tar archive, containing the Markdown files.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of rows per INSERT/UPDATE.'
+        )
+        parser.add_argument(
+            '--visibility',
+            choices=WikiPage.Visibility.values,
+            default=WikiPage.Visibility.LOGGED_IN,
+            help='Visibility of the created pages.'
+        )
+        parser.add_argument(
+            '--user',
+            type=str,
+            help='Username recorded as the last editor (and owner of private pages) of created pages.'
+        )
+        parser.add_argument(
+            '--skip-existing',
+            action='store_true',
+            help="Leave pages whose slug already exists untouched instead of replacing their content."
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Don't change anything; just show what would be imported."
+        )
+
+    def handle(self, *args, **options):
+        source = Path(options['source'])
+        if not source.exists():
+            raise CommandError(f"Source not found: {source}")
+
+        if source.is_dir():
+            self._import_tree(source, options)
+            return
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.stdout.write(f"Extracting {source.name} to a temporary directory...")
+            self._extract(source, Path(temp_dir))
+            self._import_tree(Path(temp_dir), options)
+
+    def _extract(self, archive_path: Path, target: Path):
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as zf:
+                zf.extractall(target)
+        elif tarfile.is_tarfile(archive_path):
+            with tarfile.open(archive_path) as tf:
+                tf.extractall(target, filter='data')
+        else:
+            raise CommandError(f"Not a directory, ZIP or tar archive: {archive_path}")
+
+    # --- 1. Planning (no writes) ---
+
+    def _collect(self, root: Path):
+        """Returns the Markdown files keyed on their path without suffix, and the other files per page key."""
+        markdown_files = {}
+        other_files = []
+        for path in sorted(root.rglob('*')):
+            relative_path = path.relative_to(root)
+            if not path.is_file() or any(part.startswith('.') or part == '__MACOSX' for part in relative_path.parts):
+                continue
+            if path.suffix.lower() in MARKDOWN_SUFFIXES:
+                markdown_files[relative_path.with_suffix('')] = path
+            else:
+                other_files.append(relative_path)
+
+        attachments = {}
+        unattached = []
+        for relative_path in other_files:
+            page_key = next((parent for parent in relative_path.parents if parent in markdown_files), None)
+            if page_key is None:
+                unattached.append(relative_path)
+            else:
+                attachments.setdefault(page_key, []).append(root / relative_path)
+        return markdown_files, attachments, unattached
+
+    def _plan_pages(self, markdown_files: dict, skip_existing: bool):
+        """
+        Precomputes every slug and title in memory against the existing ones, so no row
+        needs a lookup of its own. Returns (new, updated, skipped) lists of entries.
+        """
+        existing_slugs = set(WikiPage.objects.values_list('slug', flat=True))
+        taken_titles = set(WikiPage.objects.values_list('title', flat=True))
+        taken_slugs = set(existing_slugs)
+        slug_max_length = WikiPage._meta.get_field('slug').max_length
+
+        new_entries, update_entries, skipped = [], [], []
+        occurrences = {}
+        for page_key, path in markdown_files.items():
+            base_slug = slugify(page_key.name) or 'page'
+            # The n-th file with the same name maps to `slug-n`, so a re-import finds the same pages.
+            occurrence = occurrences[base_slug] = occurrences.get(base_slug, -1) + 1
+            expected_slug = base_slug if occurrence == 0 else f"{base_slug}-{occurrence}"
+            if expected_slug in existing_slugs:
+                existing_slugs.discard(expected_slug)
+                (skipped if skip_existing else update_entries).append((page_key, expected_slug, path))
+                continue
+            slug = next_free_slug(expected_slug if expected_slug not in taken_slugs else base_slug, taken_slugs, slug_max_length)
+            taken_slugs.add(slug)
+            title = bulk.unique_title(page_key.name.replace('-', ' ').replace('_', ' ').strip().title() or slug, taken_titles)
+            taken_titles.add(title)
+            new_entries.append((page_key, slug, title, path))
+        return new_entries, update_entries, skipped
+
+    # --- 2. Batched writes ---
+
+    def _create_pages(self, new_entries, options, user) -> dict:
+        visibility = options['visibility']
+        pages_by_key = {}
+        for batch in bulk.batched(new_entries, options['batch_size']):
+            pages = [
+                WikiPage(
+                    title=title,
+                    slug=slug,
+                    content=path.read_text(encoding='utf-8', errors='replace'),
+                    visibility=visibility,
+                    last_modified_by=user,
+                    author=user if visibility == WikiPage.Visibility.PRIVATE else None,
+                )
+                for _page_key, slug, title, path in batch
+            ]
+            bulk.create_with_ids(WikiPage, pages, 'slug')
+            for (page_key, *_rest), page in zip(batch, pages):
+                pages_by_key[page_key] = WikiPage(pk=page.pk, slug=page.slug)
+            self.stdout.write(f"  - Created {len(pages_by_key)}/{len(new_entries)} page(s)")
+        return pages_by_key
+
+    def _update_pages(self, update_entries, options) -> tuple[dict, list[int]]:
+        pages_by_key = {}
+        changed_ids = []
+        now = timezone.now()
+        for batch in bulk.batched(update_entries, options['batch_size']):
+            pages = WikiPage.objects.in_bulk([slug for _page_key, slug, _path in batch], field_name='slug')
+            changed = []
+            for page_key, slug, path in batch:
+                page = pages[slug]
+                pages_by_key[page_key] = WikiPage(pk=page.pk, slug=page.slug)
+                content = path.read_text(encoding='utf-8', errors='replace')
+                if page.content != content:
+                    page.content = content
+                    page.updated_at = now  # bulk_update skips auto_now
+                    changed.append(page)
+            WikiPage.objects.bulk_update(changed, ['content', 'updated_at'])
+            changed_ids.extend(page.pk for page in changed)
+        self.stdout.write(f"  - Updated {len(changed_ids)} of {len(update_entries)} existing page(s), the rest were unchanged")
+        return pages_by_key, changed_ids
+
+    def _create_attachments(self, attachments, pages_by_key, options, user, stored_names: list) -> list[WikiFile]:
+        page_ids = [page.pk for page in pages_by_key.values()]
+        taken_slugs, present_files = {}, set()
+        for batch in bulk.batched(page_ids, options['batch_size']):
+            for page_id, filename_slug, name in WikiFile.objects.filter(page_id__in=batch).values_list('page_id', 'filename_slug', 'file'):
+                taken_slugs.setdefault(page_id, set()).add(filename_slug)
+                present_files.add((page_id, filename_slug, Path(name).suffix.lower()))
+        slug_max_length = WikiFile._meta.get_field('filename_slug').max_length
+
+        created, pending = [], []
+        for page_key, paths in attachments.items():
+            page = pages_by_key.get(page_key)
+            if page is None:
+                continue
+            page_slugs = taken_slugs.setdefault(page.pk, set())
+            for path in paths:
+                base_slug = slugify(path.stem) or 'file'
+                if (page.pk, base_slug, path.suffix.lower()) in present_files:
+                    continue  # Imported before
+                filename_slug = next_free_slug(base_slug, page_slugs, slug_max_length)
+                page_slugs.add(filename_slug)
+                wiki_file = WikiFile(page=page, filename_slug=filename_slug, uploaded_by=user)
+                with open(path, 'rb') as file_obj:
+                    wiki_file.file.save(path.name, File(file_obj), save=False)
+                stored_names.append(wiki_file.file.name)
+                pending.append(wiki_file)
+                if len(pending) >= options['batch_size']:
+                    created.extend(bulk.create_with_ids(WikiFile, pending, ('page_id', 'filename_slug')))
+                    pending = []
+                    self.stdout.write(f"  - Stored {len(created)} attachment(s)")
+        created.extend(bulk.create_with_ids(WikiFile, pending, ('page_id', 'filename_slug')))
+        self.stdout.write(f"  - Stored {len(created)} attachment(s)")
+        return created
+
+    def _import_tree(self, root: Path, options):
+        options['batch_size'] = max(1, options['batch_size'])
+        user = None
+        if options['user']:
+            user = get_user_model().objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"No user named '{options['user']}'.")
+
+        markdown_files, attachments, unattached = self._collect(root)
+        if not markdown_files:
+            raise CommandError(f"No Markdown files found in {root}.")
+        new_entries, update_entries, skipped = self._plan_pages(markdown_files, options['skip_existing'])
+
+        self.stdout.write(
+            f"Found {len(markdown_files)} Markdown file(s): {len(new_entries)} new page(s), "
+            f"{len(update_entries)} existing page(s) to update, {len(skipped)} skipped. "
+            f"{sum(map(len, attachments.values()))} attachment(s)."
+        )
+        for relative_path in unattached:
+            self.stderr.write(self.style.WARNING(f"  - No page for '{relative_path}', not imported."))
+        if options['dry_run']:
+            for _page_key, slug, title, path in new_entries:
+                self.stdout.write(f"  + {slug} ('{title}') from {path.relative_to(root)}")
+            for _page_key, slug, path in update_entries:
+                self.stdout.write(f"  ~ {slug} from {path.relative_to(root)}")
+            self.stdout.write(self.style.SUCCESS("Dry run complete. Nothing was changed."))
+            return
+
+        stored_names = []
+        try:
+            with transaction.atomic():
+                pages_by_key = self._create_pages(new_entries, options, user)
+                updated_pages_by_key, changed_ids = self._update_pages(update_entries, options)
+                pages_by_key.update(updated_pages_by_key)
+                new_files = self._create_attachments(attachments, pages_by_key, options, user, stored_names)
+        except BaseException:
+            # The rows were rolled back, don't leave their files behind.
+            services.release_blobs(stored_names)
+            raise
+
+        page_ids = [page.pk for page in pages_by_key.values()]
+        bulk.refresh_derived_data(page_ids, changed_ids, new_files, options['batch_size'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {len(new_entries)} new and {len(changed_ids)} updated page(s) with {len(new_files)} attachment(s)."
+        ))
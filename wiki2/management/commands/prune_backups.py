@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 from pathlib import Path
 from collections import defaultdict
 from django.core.management.base import BaseCommand, CommandError
+from wiki2.backups import MANIFEST_SUFFIX, BLOB_DIRECTORY, is_manifest, collect_garbage
 
 class Command(BaseCommand):
     help = 'Prunes old backup files based on a GFS (Grandfather-Father-Son) retention policy.'
@@ -13,7 +14,7 @@ class Command(BaseCommand):
             '--backup-dir',
             type=str,
             default='/backups_archive',
-            help='The directory where backup ZIP files are stored.'
+            help='The directory where backup archives and incremental snapshot manifests are stored.'
         )
         parser.add_argument(
             '--dry-run',
@@ -33,7 +34,8 @@ class Command(BaseCommand):
 
         # --- 1. Find and parse all backup files ---
         backup_files = []
-        backup_pattern = re.compile(r"(\d{4}-\d{2}-\d{2}-\d{2}-\d{2})\.zip")
+        # Full backups (ZIP or tar.gz) and incremental snapshot manifests follow the same retention policy.
+        backup_pattern = re.compile(r"(\d{4}-\d{2}-\d{2}-\d{2}-\d{2})(\.zip|\.tar\.gz|" + re.escape(MANIFEST_SUFFIX) + r")$")
 
         for f in backup_dir.iterdir():
             if f.is_file():
@@ -144,4 +146,12 @@ class Command(BaseCommand):
             if is_dry_run:
                 self.stdout.write(self.style.SUCCESS(f"\nDry run complete. Would have deleted {len(to_delete)} files."))
             else:
-                self.stdout.write(self.style.SUCCESS(f"\nSuccessfully pruned {len(to_delete)} old backups."))
\ No newline at end of file
+                self.stdout.write(self.style.SUCCESS(f"\nSuccessfully pruned {len(to_delete)} old backups."))
+
+        # --- 6. Garbage-collect blobs no remaining snapshot refers to ---
+        remaining_manifests = sorted(path for path in all_backup_paths - to_delete if is_manifest(path))
+        if remaining_manifests or (backup_dir / BLOB_DIRECTORY).is_dir():
+            self.stdout.write(f"\n--- Collecting unreferenced blobs ({len(remaining_manifests)} snapshot(s) kept) ---")
+            freed_count, freed_bytes = collect_garbage(str(backup_dir), remaining_manifests, dry_run=is_dry_run)
+            verb = "Would free" if is_dry_run else "Freed"
+            self.stdout.write(self.style.SUCCESS(f"{verb} {freed_count} blob(s), {freed_bytes / 1024 / 1024:.1f} MiB."))
\ No newline at end of file
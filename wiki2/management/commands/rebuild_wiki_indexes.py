@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from wiki2.models import WikiPage
+from wiki2 import services
+from wiki2 import fulltext
+
+class Command(BaseCommand):
+    help = 'Rebuilds the derived wiki indexes (link graph, search index) from the stored page content.'
+
+    def handle(self, *args, **options):
+        pages = WikiPage.objects.all()
+        total = pages.count()
+        self.stdout.write(f"Rebuilding link graph for {total} page(s)...")
+
+        for page in pages.iterator():
+            services.update_page_links(page)
+
+        services.invalidate_rendered_pages(pages.values_list('pk', flat=True))
+        self.stdout.write(self.style.SUCCESS(f"Successfully rebuilt the link graph for {total} page(s)."))
+
+        self.stdout.write(f"Rebuilding search index ({fulltext.get_backend()} backend)...")
+        fulltext.rebuild_index()
+        self.stdout.write(self.style.SUCCESS("Successfully rebuilt the search index."))
@@ -1,26 +1,50 @@
+import fnmatch
 import os
-import shutil
-import tempfile
+import tarfile
+import time
 import zipfile
 from pathlib import Path
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from django.core.files import File
+from django.utils import timezone
+from django.utils.text import slugify
 
 from wiki2.models import WikiPage, WikiFile
+from wiki2.utils import next_free_slug
+from wiki2 import backups
+from wiki2 import bulk
+from wiki2 import services
 
 class Command(BaseCommand):
     help = (
-        'Restores the wiki from a backup ZIP file created by the '
-        'create_wiki_backup command.'
+        'Restores the wiki from a backup archive or incremental snapshot manifest '
+        'created by the create_wiki_backup command. Pages are read straight from the '
+        'backup, without extracting it, and written in batches.'
     )
 
     def add_arguments(self, parser):
         parser.add_argument(
             'zip_filepath',
             type=str,
-            help='The full path to the backup ZIP file to restore.'
+            help='The full path to the backup ZIP or tar.gz file (or .manifest.json.gz snapshot) to restore.'
+        )
+        parser.add_argument(
+            '--page',
+            action='append',
+            metavar='SLUG',
+            help=(
+                'Only restore this page. Accepts shell-style wildcards (e.g. "projects-*") and can be '
+                'repeated. ZIPs and snapshots are read at random, so restoring one page from a large '
+                'backup only reads that page.'
+            )
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of pages written per transaction.'
         )
         parser.add_argument(
             '--dry-run',
@@ -36,110 +60,189 @@ class Command(BaseCommand):
             )
         )
 
-    @transaction.atomic
     def handle(self, *args, **options):
         zip_filepath = Path(options['zip_filepath'])
         is_dry_run = options['dry_run']
         delete_unmatched = options['delete_unmatched']
-        
+        page_patterns = options['page'] or []
+
         self.stdout.write(self.style.WARNING("--- Wiki Restore Initialized ---"))
         if is_dry_run:
             self.stdout.write(self.style.WARNING("--- Running in Dry Run Mode: No changes will be made. ---"))
-        
+
         # --- 1. Validate Input ---
         if not zip_filepath.exists() or not zip_filepath.is_file():
             raise CommandError(f"Backup file not found at: {zip_filepath}")
-        if not zipfile.is_zipfile(zip_filepath):
-            raise CommandError(f"File is not a valid ZIP archive: {zip_filepath}")
-            
+        if delete_unmatched and page_patterns:
+            raise CommandError("--delete-unmatched can't be combined with --page.")
+
+        def is_selected(slug):
+            return not page_patterns or any(fnmatch.fnmatchcase(slug, pattern) for pattern in page_patterns)
+
         self.stdout.write(f"Restoring from backup file: {zip_filepath.name}")
+        self.stats = dict.fromkeys(['created', 'updated', 'unchanged', 'restored_files', 'skipped_files', 'deleted_files', 'bytes'], 0)
+        self.slugs_in_backup = set()
+        self.touched_page_ids = []
+        self.changed_page_ids = []
+        self.new_files = []
+        started = time.monotonic()
+
+        # --- 2. Process the pages from the backup, one batch per transaction ---
+        try:
+            with backups.open_backup(str(zip_filepath), is_selected) as backup_pages:
+                for batch in bulk.batched(backup_pages, max(1, options['batch_size'])):
+                    self._restore_batch(batch, is_dry_run)
+        except (ValueError, KeyError, zipfile.BadZipFile, tarfile.TarError) as e:
+            raise CommandError(f"Could not read the backup: {e}")
 
-        slugs_in_backup = set()
-
-        # Use a temporary directory that cleans itself up automatically
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            self.stdout.write(f"Extracting backup to temporary directory: {temp_path}")
-            
-            with zipfile.ZipFile(zip_filepath, 'r') as zf:
-                zf.extractall(temp_path)
-
-            # --- 2. Process each page from the backup ---
-            # The top-level items in the extracted archive should be page-slug directories
-            for page_slug_dir in temp_path.iterdir():
-                if not page_slug_dir.is_dir():
-                    continue
-
-                page_slug = page_slug_dir.name
-                slugs_in_backup.add(page_slug)
-                self.stdout.write(f"\nProcessing page slug: '{page_slug}'")
-
-                # Restore content
-                content_file = page_slug_dir / 'content.md'
-                if not content_file.exists():
-                    self.stderr.write(self.style.WARNING(f"  - Warning: content.md not found for '{page_slug}'. Skipping content restore."))
-                    continue
-                
-                restored_content = content_file.read_text(encoding='utf-8')
-
-                # Get or create the page object
-                page, created = WikiPage.objects.get_or_create(slug=page_slug)
-                action_str = "CREATED" if created else "UPDATED"
-                self.stdout.write(f"  - Page '{page_slug}': {action_str}")
-
-                page.content = restored_content
-                # If the page is new, we derive a title from the slug.
-                if created:
-                    page.title = page_slug.replace('-', ' ').replace('_', ' ').title()
+        if page_patterns and not self.slugs_in_backup:
+            self.stderr.write(self.style.WARNING(f"No page in the backup matches {', '.join(page_patterns)}."))
+
+        # --- 3. Handle pages in DB but not in backup (if requested) ---
+        if delete_unmatched:
+            self.stdout.write("\nChecking for pages to delete (present in DB but not in backup)...")
+            slugs_in_db = set(WikiPage.objects.values_list('slug', flat=True))
+            slugs_to_delete = slugs_in_db - self.slugs_in_backup
+
+            if slugs_to_delete:
+                self.stdout.write(self.style.WARNING(f"Found {len(slugs_to_delete)} page(s) to delete:"))
+                for slug in sorted(list(slugs_to_delete)):
+                    self.stdout.write(f"  - {slug}")
 
                 if not is_dry_run:
-                    page.save()
-
-                # Restore attachments
-                attachments_dir = page_slug_dir / 'attachments'
-                
-                # First, clear existing attachments for this page to avoid duplicates
-                if page.files.exists():
-                    self.stdout.write(f"  - Deleting {page.files.count()} existing attachment(s) for this page.")
-                    if not is_dry_run:
-                        page.files.all().delete()
-                
-                if attachments_dir.exists() and attachments_dir.is_dir():
-                    for attachment_file_path in attachments_dir.iterdir():
-                        if attachment_file_path.is_file():
-                            self.stdout.write(f"    - Restoring attachment: {attachment_file_path.name}")
-                            if not is_dry_run:
-                                # Create a new WikiFile object and attach the file
-                                wf = WikiFile(page=page)
-                                with open(attachment_file_path, 'rb') as f:
-                                    # Django's FileField.save handles moving the file to MEDIA_ROOT
-                                    wf.file.save(attachment_file_path.name, File(f), save=True)
-                else:
-                    self.stdout.write("  - No attachments found in backup for this page.")
-            
-            # --- 3. Handle pages in DB but not in backup (if requested) ---
-            if delete_unmatched:
-                self.stdout.write("\nChecking for pages to delete (present in DB but not in backup)...")
-                slugs_in_db = set(WikiPage.objects.values_list('slug', flat=True))
-                slugs_to_delete = slugs_in_db - slugs_in_backup
-                
-                if slugs_to_delete:
-                    self.stdout.write(self.style.WARNING(f"Found {len(slugs_to_delete)} page(s) to delete:"))
-                    for slug in sorted(list(slugs_to_delete)):
-                        self.stdout.write(f"  - {slug}")
-                    
-                    if not is_dry_run:
-                        pages_to_delete = WikiPage.objects.filter(slug__in=slugs_to_delete)
-                        count, _ = pages_to_delete.delete()
-                        self.stdout.write(self.style.SUCCESS(f"Successfully deleted {count} page(s)."))
-                else:
-                    self.stdout.write("  - No pages to delete.")
+                    pages_to_delete = WikiPage.objects.filter(slug__in=slugs_to_delete)
+                    count, _ = pages_to_delete.delete()
+                    self.stdout.write(self.style.SUCCESS(f"Successfully deleted {count} page(s)."))
+            else:
+                self.stdout.write("  - No pages to delete.")
 
         if is_dry_run:
             self.stdout.write(
                 self.style.SUCCESS("\n--- Dry Run Complete. No actual changes were made to the database or media files. ---")
             )
-            # Since this is a dry run within a transaction, we must cause it to rollback.
-            raise CommandError("Dry run successful. Rolling back transaction.")
-        else:
-            self.stdout.write(self.style.SUCCESS("\n--- Wiki Restore Completed Successfully! ---"))
\ No newline at end of file
+            return
+
+        # --- 4. Derived data (link graph, search index, ...) in one pass ---
+        if self.touched_page_ids:
+            bulk.refresh_derived_data(
+                self.touched_page_ids, self.changed_page_ids, self.new_files,
+                max(1, options['batch_size']), log=self.stdout.write, rebuild_search_index=False,
+            )
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        stats = self.stats
+        megabytes = stats['bytes'] / 1024 / 1024
+        self.stdout.write(
+            f"\nPages: {stats['created']} created, {stats['updated']} updated, {stats['unchanged']} unchanged. "
+            f"Attachments: {stats['restored_files']} restored, {stats['skipped_files']} already up to date, "
+            f"{stats['deleted_files']} removed."
+        )
+        self.stdout.write(
+            f"{len(self.slugs_in_backup)} page(s) and {megabytes:.1f} MiB in {elapsed:.1f}s "
+            f"({len(self.slugs_in_backup) / elapsed:.1f} pages/s, {megabytes / elapsed:.1f} MiB/s)."
+        )
+        self.stdout.write(self.style.SUCCESS("\n--- Wiki Restore Completed Successfully! ---"))
+
+    def _plan_pages(self, batch: list[backups.BackupPage]):
+        """Returns (backup page, page, action) for the batch; new pages aren't saved yet."""
+        existing = {page.slug: page for page in WikiPage.objects.filter(slug__in=[bp.slug for bp in batch]).prefetch_related('files')}
+        derived_titles = {bp.slug: bp.defaults.get('title') or bp.slug.replace('-', ' ').replace('_', ' ').title() for bp in batch}
+        taken_titles = set(WikiPage.objects.filter(title__in=derived_titles.values()).values_list('title', flat=True))
+        now = timezone.now()
+
+        planned = []
+        for backup_page in batch:
+            self.slugs_in_backup.add(backup_page.slug)
+            self.stdout.write(f"\nProcessing page slug: '{backup_page.slug}'")
+            if backup_page.content is None:
+                self.stderr.write(self.style.WARNING(f"  - Warning: content not found for '{backup_page.slug}'. Skipping content restore."))
+                continue
+
+            page = existing.get(backup_page.slug)
+            if page is None:
+                # If the page is new, we derive a title from the slug (or take it from the manifest).
+                title = bulk.unique_title(derived_titles[backup_page.slug], taken_titles)
+                taken_titles.add(title)
+                page = WikiPage(slug=backup_page.slug, content=backup_page.content, **{**backup_page.defaults, 'title': title})
+                action = 'created'
+            elif page.content != backup_page.content:
+                page.content = backup_page.content
+                page.updated_at = now  # bulk_update skips auto_now
+                action = 'updated'
+            else:
+                action = 'unchanged'
+            self.stats[action] += 1
+            self.stdout.write(f"  - Page '{backup_page.slug}': {action.upper()}")
+            planned.append((backup_page, page, action))
+        return planned
+
+    def _plan_attachments(self, backup_page: backups.BackupPage, page: WikiPage, action: str):
+        """Returns (attachments to write, WikiFiles to delete). Files whose bytes already match are kept."""
+        current_files = {} if action == 'created' else {wf.filename_display: wf for wf in page.files.all()}
+        to_write, to_delete = [], []
+        for attachment in backup_page.attachments:
+            wiki_file = current_files.pop(attachment.name, None)
+            if wiki_file is not None and wiki_file.file and attachment.matches(wiki_file.file.path):
+                self.stats['skipped_files'] += 1
+                continue
+            if wiki_file is not None:
+                to_delete.append(wiki_file)
+            to_write.append(attachment)
+            self.stdout.write(f"    - Restoring attachment: {attachment.name}")
+        # Attachments that aren't in the backup are removed, the page ends up as it was backed up.
+        to_delete.extend(current_files.values())
+        self.stats['deleted_files'] += len(current_files)
+        for wiki_file in current_files.values():
+            self.stdout.write(f"    - Removing attachment not in backup: {wiki_file.filename_display}")
+        if not backup_page.attachments and not to_delete:
+            self.stdout.write("  - No attachments found in backup for this page.")
+        return to_write, to_delete
+
+    def _restore_batch(self, batch: list[backups.BackupPage], is_dry_run: bool):
+        planned = self._plan_pages(batch)
+        attachment_plans = [(page, action, *self._plan_attachments(backup_page, page, action)) for backup_page, page, action in planned]
+        if is_dry_run:
+            return
+
+        stored_names = []
+        try:
+            with transaction.atomic():
+                bulk.create_with_ids(WikiPage, [page for _bp, page, action in planned if action == 'created'], 'slug')
+                WikiPage.objects.bulk_update([page for _bp, page, action in planned if action == 'updated'], ['content', 'updated_at'])
+
+                # Replaced files go first, so their successors can take over the same file names.
+                deleted_ids = [wiki_file.pk for _page, _action, _write, to_delete in attachment_plans for wiki_file in to_delete]
+                if deleted_ids:
+                    WikiFile.objects.filter(pk__in=deleted_ids).delete()
+
+                new_files = []
+                for page, action, to_write, to_delete in attachment_plans:
+                    deleted = {wiki_file.pk for wiki_file in to_delete}
+                    taken_slugs = set() if action == 'created' else {wf.filename_slug for wf in page.files.all() if wf.pk not in deleted}
+                    for attachment in to_write:
+                        base_slug = slugify(os.path.splitext(attachment.name)[0]) or 'file'
+                        filename_slug = next_free_slug(base_slug, taken_slugs, WikiFile._meta.get_field('filename_slug').max_length)
+                        taken_slugs.add(filename_slug)
+                        wiki_file = WikiFile(page=page, filename_slug=filename_slug)
+                        try:
+                            with attachment.open() as source:
+                                wiki_file.file.save(attachment.name, File(source), save=False)
+                        except OSError as e:
+                            self.stderr.write(self.style.WARNING(f"    - Attachment data missing from backup: {attachment.name} ({e})"))
+                            continue
+                        stored_names.append(wiki_file.file.name)
+                        new_files.append(wiki_file)
+                        self.stats['bytes'] += attachment.size
+                bulk.create_with_ids(WikiFile, new_files, ('page_id', 'filename_slug'))
+                self.stats['restored_files'] += len(new_files)
+                self.new_files.extend(new_files)
+        except BaseException:
+            # The rows were rolled back, don't leave their files behind.
+            services.release_blobs(stored_names)
+            raise
+
+        for page, action, to_write, to_delete in attachment_plans:
+            if action != 'unchanged' or to_write or to_delete:
+                self.touched_page_ids.append(page.pk)
+                if action != 'created':
+                    self.changed_page_ids.append(page.pk)
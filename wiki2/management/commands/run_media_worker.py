@@ -0,0 +1,79 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from wiki2 import jobs
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Command(BaseCommand):
+    help = 'Runs queued media jobs (HEIC conversion, resized images) in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=settings.WIKI_MEDIA_WORKER_PROCESSES or _available_cores(),
+            help='Number of worker processes. Defaults to the number of available CPU cores.'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty instead of waiting for new jobs.'
+        )
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        requeued = jobs.requeue_stalled()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Requeued {requeued} stalled job(s)."))
+
+        # The pool forks its processes on first use. They only run database-free functions,
+        # but must not inherit (and later close) the parent's open database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            pool.submit(int).result()
+            self.stdout.write(f"Media worker started with {processes} process(es).")
+
+            while True:
+                batch = jobs.claim(limit=processes * 2)
+                if not batch:
+                    if options['once']:
+                        break
+                    time.sleep(settings.WIKI_MEDIA_WORKER_POLL_INTERVAL)
+                    jobs.requeue_stalled()
+                    continue
+
+                submitted = []
+                for job in batch:
+                    try:
+                        tasks = jobs.build_tasks(job)
+                    except Exception as e:
+                        jobs.finish(job, error=str(e))
+                        self.stderr.write(self.style.ERROR(f"{job}: {e}"))
+                        continue
+                    submitted.append((job, [pool.submit(function, *task_args) for function, task_args in tasks]))
+
+                for job, futures in submitted:
+                    errors = []
+                    for future in futures:
+                        try:
+                            if not future.result():
+                                errors.append("The image could not be processed.")
+                        except Exception as e:
+                            errors.append(repr(e))
+                    jobs.finish(job, error='; '.join(errors))
+                    if errors:
+                        self.stderr.write(self.style.ERROR(f"{job}: {'; '.join(errors)}"))
+
+        self.stdout.write(self.style.SUCCESS("Media job queue is empty."))
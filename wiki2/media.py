@@ -0,0 +1,130 @@
+# wiki2/media.py
+"""
+Serving attachment bytes after the view has done its permission checks.
+
+Files are streamed in chunks (never read into memory), with conditional requests
+(ETag / Last-Modified) and single HTTP byte ranges for resumable downloads and video
+seeking. With WIKI_MEDIA_ACCEL_REDIRECT enabled, nginx sends the bytes instead and
+Django only answers with an X-Accel-Redirect header.
+"""
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, content_disposition_header, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 256 * 1024
+
+
+def _parse_range(range_header: str, size: int):
+    """
+    Returns the (start, end) of a single byte range, inclusive, or None when the header
+    should be ignored. Raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if not match:
+        # Multiple ranges or another unit: serving the whole file is always allowed.
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        suffix_length = int(last)
+        if suffix_length == 0:
+            raise ValueError("Empty suffix range.")
+        return max(0, size - suffix_length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range starts after the end of the file.")
+    return start, end
+
+
+def _range_is_current(request, etag: str, last_modified: int) -> bool:
+    """Checks If-Range: a range is only honoured for the representation the client has."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _iter_file_range(path: str, start: int, length: int):
+    with open(path, 'rb') as file_obj:
+        file_obj.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = file_obj.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path: str, storage_name: str, filename: str, as_attachment: bool = False, content_type: str | None = None):
+    """
+    Returns a streaming (or X-Accel-Redirect) response for a file on disk.
+    `storage_name` is the file's path relative to MEDIA_ROOT.
+    """
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise Http404("File does not exist on the server.")
+
+    size = stat_result.st_size
+    last_modified = int(stat_result.st_mtime)
+    etag = quote_etag(f"{stat_result.st_mtime_ns:x}-{size:x}")
+    if content_type is None:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    if settings.WIKI_MEDIA_ACCEL_REDIRECT:
+        # nginx handles ranges and conditional requests on the internal redirect itself.
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.WIKI_MEDIA_ACCEL_PREFIX + quote(storage_name)
+    else:
+        byte_range = None
+        range_header = request.headers.get('Range')
+        if range_header and _range_is_current(request, etag, last_modified):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(_iter_file_range(path, start, length), status=206, content_type=content_type)
+            response['Content-Length'] = str(length)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response.block_size = CHUNK_SIZE
+
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def serve_wiki_file(request, wiki_file, as_attachment: bool = False):
+    """Serves the bytes of a WikiFile the requesting user is allowed to see."""
+    return serve_file(
+        request,
+        wiki_file.file.path,
+        wiki_file.file.name,
+        wiki_file.filename_display,
+        as_attachment=as_attachment,
+    )
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0002_wikipage_author_wikipage_visibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('WIKILINK', 'Wikilink'), ('LINK', 'Markdown link'), ('IMAGE', 'Image')], max_length=10)),
+                ('target', models.CharField(help_text='The link target as written in the content.', max_length=255)),
+                ('target_slug', models.CharField(db_index=True, help_text="Slugified target, used to find links to pages that don't exist yet.", max_length=255)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_links', to='wiki2.wikipage')),
+                ('target_file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='incoming_links', to='wiki2.wikifile')),
+                ('target_page', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='incoming_links', to='wiki2.wikipage')),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, transaction
+from django.db.utils import OperationalError
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            "ALTER TABLE wiki2_wikipage ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(content, '')), 'B')"
+            ") STORED"
+        )
+        schema_editor.execute("CREATE INDEX wiki2_wikipage_search_vector_idx ON wiki2_wikipage USING GIN (search_vector)")
+    elif vendor == 'sqlite':
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                schema_editor.execute(
+                    "CREATE VIRTUAL TABLE wiki2_wikipage_fts USING fts5("
+                    "title, content, tokenize='unicode61 remove_diacritics 2')"
+                )
+        except OperationalError:
+            # SQLite was built without FTS5, search falls back to plain matching.
+            return
+        schema_editor.execute(
+            "INSERT INTO wiki2_wikipage_fts(rowid, title, content) SELECT id, title, content FROM wiki2_wikipage"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS wiki2_wikipage_search_vector_idx")
+        schema_editor.execute("ALTER TABLE wiki2_wikipage DROP COLUMN IF EXISTS search_vector")
+    elif vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS wiki2_wikipage_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0003_pagelink'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0004_page_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wikifile',
+            name='archive_index',
+            field=models.JSONField(blank=True, editable=False, help_text='Member index of zip/tar attachments, for direct member reads.', null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0005_wikifile_archive_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('CONVERT_HEIC', 'Convert HEIC image'), ('IMAGE_DERIVATIVES', 'Generate resized images')], max_length=20)),
+                ('member_path', models.CharField(blank=True, default='', help_text='Path inside an archive attachment, empty for the attachment itself.', max_length=1024)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], db_index=True, default='PENDING', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('wiki_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_jobs', to='wiki2.wikifile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'wiki_file', 'member_path'), name='unique_media_job')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:38
+
+import wiki2.models
+import wiki2.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0007_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wikifile',
+            name='file',
+            field=models.FileField(db_index=True, max_length=255, storage=wiki2.storage.ContentAddressedStorage(), upload_to=wiki2.models.wiki_page_file_path),
+        ),
+    ]
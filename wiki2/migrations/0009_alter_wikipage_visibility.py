@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki2', '0008_wikifile_blob_storage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wikipage',
+            name='visibility',
+            field=models.CharField(choices=[('LOGGED_IN', 'Logged-In'), ('PRIVATE', 'Private'), ('PUBLIC', 'Public')], default='LOGGED_IN', help_text='Control who can view this page.', max_length=10),
+        ),
+    ]
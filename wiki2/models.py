@@ -1,11 +1,15 @@
 # wiki2/models.py
 import os
-from django.db import models
+import uuid
+import hashlib
+from django.db import models, transaction, IntegrityError
 from django.urls import reverse
 from django.utils.text import slugify
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db.models import Q
+from .utils import allocate_slug
+from .storage import attachment_storage, blob_digest, BLOB_DIRECTORY
 
 
 class Profile(models.Model):
@@ -74,29 +78,34 @@ class WikiPage(models.Model):
     def __str__(self):
         return self.title
 
+    SLUG_ALLOCATION_ATTEMPTS = 5
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
-        
-        original_slug = self.slug
-        counter = 1
-        queryset = WikiPage.objects.filter(slug=self.slug)
-        if self.pk:
-            queryset = queryset.exclude(pk=self.pk)
-
-        while queryset.exists():
-            self.slug = f"{original_slug}-{counter}"
-            counter += 1
-            queryset = WikiPage.objects.filter(slug=self.slug)
-            if self.pk:
-                queryset = queryset.exclude(pk=self.pk)
 
         if self.visibility == self.Visibility.PRIVATE:
             self.author = self.last_modified_by
         elif self.visibility != self.Visibility.PRIVATE:
             self.author = None
 
-        super().save(*args, **kwargs)
+        original_slug = self.slug
+        other_pages = WikiPage.objects.exclude(pk=self.pk) if self.pk else WikiPage.objects.all()
+        slug_max_length = self._meta.get_field('slug').max_length
+
+        for attempt in range(self.SLUG_ALLOCATION_ATTEMPTS):
+            self.slug = allocate_slug(other_pages, 'slug', original_slug, slug_max_length)
+            try:
+                # A savepoint, so a concurrent save taking the same slug can be retried. The
+                # post_save receivers run inside it, so they leave caches and other state
+                # outside the database to transaction.on_commit.
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                return
+            except IntegrityError:
+                is_last_attempt = attempt == self.SLUG_ALLOCATION_ATTEMPTS - 1
+                if is_last_attempt or not other_pages.filter(slug=self.slug).exists():
+                    raise
 
 
     def get_absolute_url(self):
@@ -109,22 +118,14 @@ class WikiPage(models.Model):
 
 
 def wiki_page_file_path(instance, filename):
-    page_slug = instance.page.slug if instance.page else 'unknown_page'
+    """Only the extension survives: the blob storage names the file after its content."""
     _original_name_part, original_ext = os.path.splitext(filename)
-    original_ext = original_ext.lower()
-
-    final_filename_slug = instance.filename_slug
-    if not final_filename_slug:
-        temp_slug_base, _ = os.path.splitext(os.path.basename(filename))
-        final_filename_slug = slugify(temp_slug_base) if temp_slug_base and slugify(temp_slug_base) else 'uploaded-file'
-
-    new_filename = f"{final_filename_slug}{original_ext}"
-    return f'wiki_files/{page_slug}/{new_filename}'
+    return f'{BLOB_DIRECTORY}/upload{original_ext.lower()}'
 
 
 class WikiFile(models.Model):
     page = models.ForeignKey(WikiPage, related_name='files', on_delete=models.CASCADE)
-    file = models.FileField(upload_to=wiki_page_file_path)
+    file = models.FileField(upload_to=wiki_page_file_path, storage=attachment_storage, max_length=255, db_index=True)
     filename_slug = models.SlugField(max_length=255, blank=True, help_text="The slugified name of the file, without extension. Auto-generated if blank.")
     uploaded_at = models.DateTimeField(auto_now_add=True)
     uploaded_by = models.ForeignKey(
@@ -134,6 +135,7 @@ class WikiFile(models.Model):
         blank=True,
         related_name='wiki_files_uploaded'
     )
+    archive_index = models.JSONField(null=True, blank=True, editable=False, help_text="Member index of zip/tar attachments, for direct member reads.")
 
     def __str__(self):
         return self.filename_display
@@ -145,8 +147,131 @@ class WikiFile(models.Model):
             return f"{self.filename_slug}{ext}"
         return os.path.basename(self.file.name)
 
+    @property
+    def content_version(self):
+        """A short token that changes whenever the bytes behind an attachment are replaced."""
+        digest = blob_digest(self.file.name)
+        if digest:
+            return digest[:16]
+        # Stored before the blob layout: the name and upload time stand in for the content.
+        return hashlib.md5(f"{self.file.name}:{self.uploaded_at.timestamp()}".encode()).hexdigest()[:12]
+
+    def get_serving_url(self):
+        """
+        The URL pages link to: the permission-checked view. It embeds the content version,
+        so responses are cached as immutable.
+        """
+        return reverse('wiki:versioned_file', kwargs={'file_id': self.pk, 'version': self.content_version, 'filename': self.filename_display})
+
     def save(self, *args, **kwargs):
         if self.file and not self.filename_slug:
             name_part, _ = os.path.splitext(os.path.basename(self.file.name))
-            self.filename_slug = slugify(name_part) if name_part and slugify(name_part) else 'file'
-        super().save(*args, **kwargs)
\ No newline at end of file
+            base_slug = slugify(name_part) if name_part and slugify(name_part) else 'file'
+            # Unique within the page, so `![](slug)` references and the stored file name are unambiguous.
+            self.filename_slug = allocate_slug(
+                WikiFile.objects.filter(page_id=self.page_id).exclude(pk=self.pk),
+                'filename_slug', base_slug, self._meta.get_field('filename_slug').max_length,
+            )
+        super().save(*args, **kwargs)
+
+
+class PageLink(models.Model):
+    """An edge in the link graph: one link target referenced from a page's content."""
+
+    TARGET_MAX_LENGTH = 255
+
+    class Kind(models.TextChoices):
+        WIKILINK = 'WIKILINK', 'Wikilink'
+        LINK = 'LINK', 'Markdown link'
+        IMAGE = 'IMAGE', 'Image'
+
+    source = models.ForeignKey(WikiPage, related_name='outgoing_links', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    target = models.CharField(max_length=TARGET_MAX_LENGTH, help_text="The link target as written in the content.")
+    target_slug = models.CharField(max_length=TARGET_MAX_LENGTH, db_index=True, help_text="Slugified target, used to find links to pages that don't exist yet.")
+    target_page = models.ForeignKey(
+        WikiPage,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='incoming_links',
+    )
+    target_file = models.ForeignKey(
+        WikiFile,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='incoming_links',
+    )
+
+    def __str__(self):
+        return f"{self.source} -> {self.target}"
+
+
+class MediaJob(models.Model):
+    """Slow media work on an attachment, done outside requests by the `run_media_worker` command."""
+
+    class Kind(models.TextChoices):
+        CONVERT_HEIC = 'CONVERT_HEIC', 'Convert HEIC image'
+        IMAGE_DERIVATIVES = 'IMAGE_DERIVATIVES', 'Generate resized images'
+
+    class Status(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
+        RUNNING = 'RUNNING', 'Running'
+        DONE = 'DONE', 'Done'
+        FAILED = 'FAILED', 'Failed'
+
+    kind = models.CharField(max_length=20, choices=Kind.choices)
+    wiki_file = models.ForeignKey(WikiFile, related_name='media_jobs', on_delete=models.CASCADE)
+    member_path = models.CharField(max_length=1024, blank=True, default='', help_text="Path inside an archive attachment, empty for the attachment itself.")
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'wiki_file', 'member_path'], name='unique_media_job'),
+        ]
+
+    def __str__(self):
+        target = f"{self.wiki_file}:{self.member_path}" if self.member_path else str(self.wiki_file)
+        return f"{self.get_kind_display()} ({target}) - {self.status}"
+
+
+class UploadSession(models.Model):
+    """A chunked upload in progress. Chunks are written into a staging file until it is finalized into a WikiFile."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    page = models.ForeignKey(WikiPage, related_name='upload_sessions', on_delete=models.CASCADE)
+    uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='upload_sessions', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255, help_text="The file's original name.")
+    filename_slug = models.SlugField(max_length=255, blank=True)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.size} bytes) for {self.page}"
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+
+class UploadChunk(models.Model):
+    """A chunk of an UploadSession that was written and verified."""
+
+    session = models.ForeignKey(UploadSession, related_name='chunks', on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'index'], name='unique_upload_chunk'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} #{self.index}"
@@ -1,17 +1,33 @@
 # wiki2/services.py
 import os
 import re
+import gzip
+import json
+import zlib
+import logging
+import struct
+import shutil
 import zipfile
+import threading
 import tarfile
 import tempfile
+import time
 import hashlib
 from io import BytesIO
+from collections import OrderedDict
+from functools import cache as memoize
 
 import markdown2
+from PIL import Image, ImageOps, ExifTags, features
 from requests import post
-from heic2png import HEIC2PNG # pyright: ignore[reportMissingImports] # INFO: Fake ass warning
+from pillow_heif import register_heif_opener
+try:
+    import brotli
+except ImportError:  # Optional: the page index is then only pre-compressed with gzip
+    brotli = None
 from urllib.parse import quote, urlencode, parse_qsl
 
+from django.db import transaction
 from django.db.models import Q
 from django.urls import reverse, NoReverseMatch
 from django.utils.html import escape
@@ -20,8 +36,12 @@ from django.conf import settings
 from django.core.cache import cache
 from django.template.loader import render_to_string
 
-from .models import WikiPage, WikiFile
+from .models import WikiPage, WikiFile, PageLink
 from . import constants
+from . import caching
+from .storage import BLOB_DIRECTORY, blob_digest
+
+logger = logging.getLogger(__name__)
 
 # --- Notification Service ---
 
@@ -45,35 +65,154 @@ def send_ntfy_notification(title, message, click_url, priority="3", tags=""):
 
 # --- Image and Archive Services ---
 
-def convert_heic_to_png_bytes(heic_bytes: bytes) -> bytes:
-    """Converts HEIC image bytes to PNG bytes, using temporary files."""
-    tmp_heic_path = None
-    output_png_path = None
-    try:
-        # Create a temporary file to write the HEIC bytes
-        with tempfile.NamedTemporaryFile(mode='wb', suffix='.heic', delete=False) as tmp_heic:
-            tmp_heic.write(heic_bytes)
-            tmp_heic_path = tmp_heic.name
+register_heif_opener()  # Lets Pillow decode HEIC/HEIF straight from memory
+
+HEIC_OUTPUT_CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+
+
+def convert_heic_bytes(heic_bytes: bytes, fmt: str | None = None, quality: int | None = None) -> bytes:
+    """
+    Decodes HEIC image bytes in memory and re-encodes them as WIKI_HEIC_OUTPUT_FORMAT
+    (webp, jpeg or png). Nothing touches the disk.
+    """
+    fmt = fmt or settings.WIKI_HEIC_OUTPUT_FORMAT
+    if quality is None:
+        quality = settings.WIKI_HEIC_OUTPUT_QUALITY
+    output = BytesIO()
+    with Image.open(BytesIO(heic_bytes)) as image:
+        if fmt == 'jpeg':
+            image = _flatten_for_jpeg(image)
+        if fmt == 'png':
+            image.save(output, format='PNG', compress_level=6)
+        else:
+            image.save(output, format=fmt.upper(), quality=quality)
+    return output.getvalue()
 
-        # Convert the temporary HEIC file to PNG
-        heic_img = HEIC2PNG(tmp_heic_path, quality=90)
-        heic_img.save()
 
-        output_png_path = os.path.splitext(tmp_heic_path)[0] + '.png'
+# Archive members are read through a persisted per-file index (name -> local header
+# offset, sizes, method, CRC) so a gallery thumbnail is a single seek + read instead of
+# a central-directory parse, and the open archive handles are reused between requests.
 
-        # Read the resulting PNG file back into bytes
-        with open(output_png_path, 'rb') as png_file:
-            return png_file.read()
-    finally:
-        # Clean up temporary files
-        if tmp_heic_path and os.path.exists(tmp_heic_path):
-            os.remove(tmp_heic_path)
-        if output_png_path and os.path.exists(output_png_path):
-            os.remove(output_png_path)
+ARCHIVE_HANDLE_CACHE_SIZE = 16
+TAR_MEMBER = 'tar'
+
+
+def build_archive_index(wiki_file: WikiFile) -> dict | None:
+    """Builds the member index of a zip or uncompressed tar attachment, or None if it isn't one."""
+    _, archive_ext = os.path.splitext(wiki_file.file.name.lower())
+    members = {}
+    try:
+        with wiki_file.file.open('rb') as archive_file_obj:
+            if archive_ext == '.zip':
+                with zipfile.ZipFile(archive_file_obj, 'r') as zf:
+                    for info in zf.infolist():
+                        if info.is_dir() or info.flag_bits & 0x1:  # Skip directories and encrypted members
+                            continue
+                        members[info.filename] = [info.header_offset, info.compress_size, info.file_size, info.compress_type, info.CRC]
+            elif archive_ext == '.tar':
+                with tarfile.open(fileobj=archive_file_obj, mode='r:') as tf:
+                    for member in tf.getmembers():
+                        if member.isfile():
+                            members[member.name] = [member.offset_data, member.size, member.size, TAR_MEMBER, None]
+            else:
+                return None
+    except (zipfile.BadZipFile, tarfile.TarError):
+        return None
+    return {'members': members}
+
+
+def ensure_archive_index(wiki_file: WikiFile) -> dict | None:
+    """Returns the archive index of a file, computing and storing it on first use."""
+    if wiki_file.archive_index is None:
+        archive_index = build_archive_index(wiki_file)
+        if archive_index is not None:
+            wiki_file.archive_index = archive_index
+            WikiFile.objects.filter(pk=wiki_file.pk).update(archive_index=archive_index)
+    return wiki_file.archive_index
+
+
+class _ArchiveHandleCache:
+    """A small per-process LRU of open archive files, safe to share between threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()  # path -> (file object, mtime_ns, lock)
+        self._lock = threading.Lock()
+
+    def _get(self, path):
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._handles.get(path)
+            if entry is not None and entry[1] == mtime_ns:
+                self._handles.move_to_end(path)
+                return entry
+            if entry is not None:
+                self._close(self._handles.pop(path))
+            entry = (open(path, 'rb'), mtime_ns, threading.Lock())
+            self._handles[path] = entry
+            while len(self._handles) > self.maxsize:
+                _path, evicted = self._handles.popitem(last=False)
+                self._close(evicted)
+            return entry
+
+    @staticmethod
+    def _close(entry):
+        file_obj, _mtime_ns, handle_lock = entry
+        with handle_lock:
+            file_obj.close()
+
+    def read(self, path, reader):
+        """Calls reader(file_obj) with exclusive use of the cached handle for `path`."""
+        while True:
+            file_obj, _mtime_ns, handle_lock = self._get(path)
+            with handle_lock:
+                if not file_obj.closed:  # It may have been evicted in the meantime
+                    return reader(file_obj)
+
+
+_archive_handles = _ArchiveHandleCache(ARCHIVE_HANDLE_CACHE_SIZE)
+
+
+def _read_indexed_member(file_obj, entry) -> bytes | None:
+    offset, compress_size, file_size, compress_type, crc = entry
+    if compress_type == TAR_MEMBER:
+        file_obj.seek(offset)
+        return file_obj.read(file_size)
+
+    file_obj.seek(offset)
+    header = file_obj.read(zipfile.sizeFileHeader)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    signature, filename_length, extra_length = fields[0], fields[-2], fields[-1]
+    if signature != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header in archive index.")
+    file_obj.seek(offset + zipfile.sizeFileHeader + filename_length + extra_length)
+    data = file_obj.read(compress_size)
+
+    if compress_type == zipfile.ZIP_STORED:
+        member_bytes = data
+    elif compress_type == zipfile.ZIP_DEFLATED:
+        member_bytes = zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        return None  # Rare compression methods go through zipfile
+    if zlib.crc32(member_bytes) != crc or len(member_bytes) != file_size:
+        raise zipfile.BadZipFile("CRC mismatch reading indexed archive member.")
+    return member_bytes
 
 
 def get_image_bytes_from_archive(wiki_file: WikiFile, image_path: str) -> bytes | None:
     """Extracts a single file's bytes from a zip or tar archive."""
+    archive_index = ensure_archive_index(wiki_file)
+    if archive_index is not None:
+        entry = archive_index['members'].get(image_path)
+        if entry is None:
+            return None
+        try:
+            member_bytes = _archive_handles.read(wiki_file.file.path, lambda f: _read_indexed_member(f, entry))
+            if member_bytes is not None:
+                return member_bytes
+        except (zipfile.BadZipFile, zlib.error, struct.error, OSError):
+            pass  # The index is stale or the member unusual, fall back to a full parse
+
     archive_filename = wiki_file.file.name
     _, archive_ext = os.path.splitext(archive_filename.lower())
     image_bytes = None
@@ -82,8 +221,10 @@ def get_image_bytes_from_archive(wiki_file: WikiFile, image_path: str) -> bytes
         with wiki_file.file.open('rb') as archive_file_obj:
             if archive_ext == '.zip':
                 with zipfile.ZipFile(archive_file_obj, 'r') as zf:
-                    if image_path in zf.namelist():
+                    try:
                         image_bytes = zf.read(image_path)
+                    except KeyError:
+                        image_bytes = None
             elif archive_ext in ['.tar', '.gz', '.bz2', '.xz']:
                 with tarfile.open(fileobj=archive_file_obj, mode='r:*') as tf:
                     for member in tf.getmembers():
@@ -100,6 +241,10 @@ def get_image_bytes_from_archive(wiki_file: WikiFile, image_path: str) -> bytes
 
 def get_image_list_from_archive(wiki_file: WikiFile) -> list[str] | None:
     """Inspects an archive and returns a sorted list of all file paths within it."""
+    archive_index = ensure_archive_index(wiki_file)
+    if archive_index is not None:
+        return sorted(name for name in archive_index['members'] if not name.startswith('__MACOSX'))
+
     archive_filename = wiki_file.file.name
     _, archive_ext = os.path.splitext(archive_filename.lower())
     paths = []
@@ -116,6 +261,285 @@ def get_image_list_from_archive(wiki_file: WikiFile) -> list[str] | None:
         return None
 
 
+# --- Attachment Blobs ---
+# Attachments are stored content-addressed (see storage.py), so one blob can back several
+# WikiFile rows. A blob touched within the grace period may belong to an upload whose row
+# isn't committed yet; it is left for `collect_attachment_blobs`.
+
+BLOB_GRACE_PERIOD = 60 * 60
+
+
+def release_blobs(names):
+    """Deletes the stored files of `names` that no WikiFile refers to any more. Run it after the commit."""
+    names = {name for name in names if name}
+    if not names:
+        return
+    storage = WikiFile.file.field.storage
+    referenced = set(WikiFile.objects.filter(file__in=names).values_list('file', flat=True))
+    cutoff = time.time() - BLOB_GRACE_PERIOD
+    for name in names - referenced:
+        try:
+            if blob_digest(name) and os.path.getmtime(storage.path(name)) > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        storage.delete(name)
+
+
+def collect_unreferenced_blobs(dry_run: bool = False, batch_size: int = 500) -> tuple[int, int]:
+    """Deletes blobs (and abandoned temp files) no WikiFile refers to. Returns (count, bytes)."""
+    storage = WikiFile.file.field.storage
+    root = storage.path(BLOB_DIRECTORY)
+    cutoff = time.time() - BLOB_GRACE_PERIOD
+    candidates = []
+    for directory, _dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat_result.st_mtime <= cutoff:
+                candidates.append((os.path.relpath(path, storage.location).replace(os.sep, '/'), stat_result.st_size))
+
+    removed = removed_bytes = 0
+    for start in range(0, len(candidates), batch_size):
+        batch = dict(candidates[start:start + batch_size])
+        referenced = set(WikiFile.objects.filter(file__in=batch).values_list('file', flat=True))
+        for name, size in batch.items():
+            if name in referenced:
+                continue
+            if not dry_run:
+                storage.delete(name)
+            removed += 1
+            removed_bytes += size
+    return removed, removed_bytes
+
+
+# --- Image Derivatives ---
+
+# Resized copies and HEIC conversions, per attachment under MEDIA_ROOT. Not under the page's
+# directory: that follows the slug, and renaming a page would orphan them.
+DERIVATIVE_DIRECTORY = 'wiki_derivatives'
+DERIVATIVE_QUALITY = {'avif': 60, 'webp': 80, 'jpeg': 85}
+DERIVATIVE_CONTENT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+# Markdown images are at most 500px wide (see .markdown-content img in wiki.css).
+MARKDOWN_IMAGE_SIZES = '(max-width: 500px) 100vw, 500px'
+
+
+@memoize
+def get_derivative_formats() -> list[str]:
+    """The formats this Pillow build can encode derivatives in, best first. JPEG is the fallback."""
+    return [fmt for fmt in ('avif', 'webp') if features.check(fmt)] + ['jpeg']
+
+
+def supports_derivatives(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in constants.IMAGE_DERIVATIVE_EXTENSIONS
+
+
+def get_file_version(wiki_file: WikiFile) -> str:
+    return wiki_file.content_version
+
+
+def get_derivative_directory(wiki_file: WikiFile) -> str:
+    return os.path.join(settings.MEDIA_ROOT, DERIVATIVE_DIRECTORY, str(wiki_file.pk))
+
+
+def get_derivative_path(wiki_file: WikiFile, variant: str, fmt: str, member_path: str | None = None) -> str:
+    member_key = hashlib.md5(member_path.encode()).hexdigest()[:16] if member_path else 'file'
+    filename = f"{get_file_version(wiki_file)}-{member_key}-{variant}.{fmt}"
+    return os.path.join(get_derivative_directory(wiki_file), filename)
+
+
+def get_derivative_url(wiki_file: WikiFile, variant: str, fmt: str, member_path: str | None = None) -> str:
+    url = reverse('wiki:image_derivative', kwargs={
+        'file_id': wiki_file.pk,
+        'version': get_file_version(wiki_file),
+        'derivative': f"{variant}.{fmt}",
+    })
+    if member_path:
+        url += f"?path={quote(member_path)}"
+    return url
+
+
+def remove_image_derivatives(wiki_file: WikiFile, stale_only: bool = False):
+    """Deletes the resized copies of an attachment, or only those of replaced versions."""
+    directory = get_derivative_directory(wiki_file)
+    if not os.path.isdir(directory):
+        return
+    if not stale_only:
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+    current_prefix = f"{get_file_version(wiki_file)}-"
+    for filename in os.listdir(directory):
+        if not filename.startswith(current_prefix):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def _flatten_for_jpeg(image: Image.Image) -> Image.Image:
+    """JPEG has no alpha channel: transparent areas become white instead of black."""
+    if image.mode == 'RGB':
+        return image
+    rgba = image.convert('RGBA')
+    flattened = Image.new('RGB', rgba.size, 'white')
+    flattened.paste(rgba, mask=rgba.getchannel('A'))
+    return flattened
+
+
+def _write_atomically(path: str, write) -> bool:
+    """
+    Calls `write(file_obj)` on a temporary file next to `path` and moves it into place,
+    so readers never see half a file. Returns False (and leaves nothing) if writing fails.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as tmp_file:
+        tmp_path = tmp_file.name
+        try:
+            write(tmp_file)
+        except OSError:
+            os.remove(tmp_path)
+            return False
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _save_image_atomically(image: Image.Image, path: str, fmt: str, **save_options) -> bool:
+    return _write_atomically(path, lambda file_obj: image.save(file_obj, format=fmt.upper(), **save_options))
+
+
+def write_image_derivative(source, max_size: int, fmt: str, path: str) -> bool:
+    """
+    Resizes an image (a path or a file-like object) to fit `max_size` and writes it to `path`.
+    Touches neither the database nor the cache, so it can run in a worker process.
+    """
+    try:
+        with Image.open(source) as image:
+            derivative = ImageOps.exif_transpose(image)
+            derivative.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    except (OSError, Image.DecompressionBombError):
+        return False
+
+    if fmt == 'jpeg':
+        derivative = _flatten_for_jpeg(derivative)
+    elif derivative.mode not in ('RGB', 'RGBA'):
+        derivative = derivative.convert('RGBA')
+    return _save_image_atomically(derivative, path, fmt, quality=DERIVATIVE_QUALITY[fmt])
+
+
+def get_derivative_source(wiki_file: WikiFile, member_path: str | None = None):
+    """The image derivatives are made from: a path, an in-memory archive member, or None."""
+    if member_path:
+        if not supports_derivatives(member_path):
+            return None
+        image_bytes = get_image_bytes_from_archive(wiki_file, member_path)
+        return BytesIO(image_bytes) if image_bytes is not None else None
+    if not supports_derivatives(wiki_file.file.name):
+        return None
+    return wiki_file.file.path
+
+
+def ensure_image_derivative(wiki_file: WikiFile, variant: str, fmt: str, member_path: str | None = None) -> str | None:
+    """
+    Returns the path of a resized copy of an image attachment (or of an image inside an
+    archive attachment), generating it on first use. None if the source isn't a usable image.
+    """
+    path = get_derivative_path(wiki_file, variant, fmt, member_path)
+    if os.path.exists(path):
+        return path
+
+    source = get_derivative_source(wiki_file, member_path)
+    if source is None:
+        return None
+    if not write_image_derivative(source, constants.IMAGE_DERIVATIVE_SIZES[variant], fmt, path):
+        return None
+    return path
+
+
+def get_converted_image_path(wiki_file: WikiFile, member_path: str) -> str:
+    """Where the browser-friendly conversion of a HEIC archive member is kept."""
+    return get_derivative_path(wiki_file, 'converted', settings.WIKI_HEIC_OUTPUT_FORMAT, member_path)
+
+
+def write_converted_heic(heic_bytes: bytes, path: str, fmt: str, quality: int) -> bool:
+    """Converts HEIC bytes and writes the result to `path`. Safe to run in a worker process."""
+    converted_bytes = convert_heic_bytes(heic_bytes, fmt, quality)
+    return _write_atomically(path, lambda file_obj: file_obj.write(converted_bytes))
+
+
+def get_image_dimensions(wiki_file: WikiFile) -> tuple[int, int] | None:
+    """The displayed (EXIF-rotated) size of an image attachment, read from its header only."""
+    cache_key = f"wiki_image_size:{wiki_file.pk}:{get_file_version(wiki_file)}"
+    dimensions = cache.get(cache_key)
+    if dimensions is None:
+        try:
+            with Image.open(wiki_file.file.path) as image:
+                width, height = image.size
+                if image.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+                    width, height = height, width
+        except (OSError, Image.DecompressionBombError):
+            return None
+        dimensions = (width, height)
+        cache.set(cache_key, dimensions, timeout=None)
+    return tuple(dimensions)
+
+
+def render_responsive_image(wiki_file: WikiFile, alt_text: str, title_part: str = "") -> str | None:
+    """
+    A <picture> for an image attachment: AVIF/WebP sources and a JPEG fallback, each with a
+    srcset of the derivative sizes. None when no derivatives can be made for the file.
+    """
+    dimensions = get_image_dimensions(wiki_file) if supports_derivatives(wiki_file.file.name) else None
+    if not dimensions:
+        return None
+    width, height = dimensions
+
+    # Derivatives never upscale, so sizes past the original collapse into one candidate.
+    candidates = {}
+    for variant, max_size in sorted(constants.IMAGE_DERIVATIVE_SIZES.items(), key=lambda item: item[1]):
+        scale = min(1.0, max_size / max(width, height))
+        candidates.setdefault(max(1, round(width * scale)), variant)
+
+    def srcset(fmt):
+        return ', '.join(f"{get_derivative_url(wiki_file, variant, fmt)} {w}w" for w, variant in candidates.items())
+
+    largest_variant = list(candidates.values())[-1]
+    sources = ''.join(
+        f'<source type="{DERIVATIVE_CONTENT_TYPES[fmt]}" srcset="{srcset(fmt)}" sizes="{MARKDOWN_IMAGE_SIZES}">'
+        for fmt in get_derivative_formats() if fmt != 'jpeg'
+    )
+    return (
+        f'<picture>{sources}'
+        f'<img src="{get_derivative_url(wiki_file, largest_variant, "jpeg")}" srcset="{srcset("jpeg")}" '
+        f'sizes="{MARKDOWN_IMAGE_SIZES}" width="{width}" height="{height}" alt="{alt_text}"{title_part} loading="lazy">'
+        f'</picture>'
+    )
+
+
+def get_gallery_image(wiki_file: WikiFile, image_path: str) -> dict:
+    """Template context for one archive member in a gallery: thumbnail sources and the lightbox URL."""
+    image = {'name': os.path.basename(image_path), 'path': image_path}
+    if not supports_derivatives(image_path):
+        # HEIC, GIF and SVG members are still served whole by the archive view.
+        image['url'] = reverse('wiki:view_image_in_archive', args=[wiki_file.id]) + f'?path={quote(image_path)}'
+        return image
+
+    def srcset(fmt):
+        thumb = get_derivative_url(wiki_file, 'thumb', fmt, image_path)
+        medium = get_derivative_url(wiki_file, 'medium', fmt, image_path)
+        return f"{thumb} 1x, {medium} 2x"
+
+    formats = get_derivative_formats()
+    image['url'] = get_derivative_url(wiki_file, 'medium', 'webp' if 'webp' in formats else 'jpeg', image_path)
+    image['thumb_url'] = get_derivative_url(wiki_file, 'thumb', 'jpeg', image_path)
+    image['thumb_srcset'] = srcset('jpeg')
+    image['sources'] = [{'type': DERIVATIVE_CONTENT_TYPES[fmt], 'srcset': srcset(fmt)} for fmt in formats if fmt != 'jpeg']
+    return image
+
+
 # --- Markdown Processing Service (Major Refactor) ---
 
 def _parse_pdf_embed_params(param_string: str) -> str:
@@ -128,14 +552,64 @@ def _parse_pdf_embed_params(param_string: str) -> str:
     return urlencode(safe_params)
 
 
-def render_markdown_to_html(markdown_text: str, current_page: WikiPage) -> str:
+def _tokenize_markup(markdown_text: str) -> list[tuple[str, str | re.Match]] | None:
     """
-    Efficiently processes Markdown text by pre-fetching all potential links
-    and files from the database in batches, avoiding N+1 query problems.
+    Splits the text into ('text', str) and ('code' | 'wikilink' | 'image' | 'link', match)
+    tokens in one scan. Returns None when constructs overlap or nest (a wikilink inside a
+    link's text, a backtick inside a link, ...): the pattern-by-pattern pipeline rewrites
+    those differently, and it stays in charge of them.
     """
-    # --- Pass 1: Collect all potential link and file targets from the text ---
+    tokens = []
+    last_end = 0
+    for match in constants.MARKUP_TOKEN_RE.finditer(markdown_text):
+        kind = match.lastgroup
+        gap = markdown_text[last_end:match.start()]
+        if kind != 'code':
+            whole = match.group(0)
+            # A "[" or "](" left open before the token could reach across it once it is HTML.
+            if gap.rfind('[') > gap.rfind(']') or gap.rfind('](') > gap.rfind(')'):
+                return None
+            # A second "[" means nested constructs; a backtick or fence means it overlaps code.
+            if whole.find('[', 2 if kind != 'link' else 1) != -1 or '`' in whole or '~~~' in whole:
+                return None
+        if gap:
+            tokens.append(('text', gap))
+        tokens.append((kind, match))
+        last_end = match.end()
+    if last_end < len(markdown_text):
+        tokens.append(('text', markdown_text[last_end:]))
+    return tokens
+
+
+def _collect_link_targets(markdown_text: str, tokens: list | None = None) -> tuple[set[str], set[str], set[str]]:
+    """
+    Returns the (wikilink, markdown link, image) targets referenced in the text, read from its
+    tokens. Text the tokenizer hands back is searched pattern by pattern, code included.
+    """
+    if tokens is None:
+        tokens = _tokenize_markup(markdown_text)
+    if tokens is None:
+        return _collect_link_targets_by_pattern(markdown_text)
+
+    wikilink_targets, md_link_targets, image_targets = set(), set(), set()
+    for kind, token in tokens:
+        if kind == 'wikilink':
+            wikilink_targets.add(token.group('wikilink_target').strip())
+        elif kind == 'link':
+            target = token.group('link_target').strip()
+            if not target.startswith(('http', '//', '/')):
+                md_link_targets.add(target)
+        elif kind == 'image':
+            target = token.group('image_src').strip()
+            if not target.startswith(('http', '//', '/')):
+                image_targets.add(target)
+    return wikilink_targets, md_link_targets, image_targets
+
+
+def _collect_link_targets_by_pattern(markdown_text: str) -> tuple[set[str], set[str], set[str]]:
+    """The same targets, found by running each pattern over the whole text (code blocks too)."""
     wikilink_targets = {match.group(2).strip() for match in constants.WIKILINK_RE.finditer(markdown_text)}
-    
+
     md_link_targets = set()
     for match in constants.STANDARD_MARKDOWN_LINK_RE.finditer(markdown_text):
         target = match.group(2).strip()
@@ -148,85 +622,123 @@ def render_markdown_to_html(markdown_text: str, current_page: WikiPage) -> str:
         if not target.startswith(('http', '//', '/')):
             image_targets.add(target)
 
-    # --- Pass 2: Batch query the database for all collected targets ---
-    all_page_targets = {slugify(t) for t in wikilink_targets | md_link_targets}
-    all_page_titles = wikilink_targets | md_link_targets
-    
+    return wikilink_targets, md_link_targets, image_targets
+
+
+def _fetch_pages_for_targets(targets: set[str]) -> tuple[dict, dict]:
+    """Batch-loads every page a set of link targets could refer to, by slug and by title."""
     resolved_pages = WikiPage.objects.filter(
-        Q(slug__in=all_page_targets) | Q(title__in=all_page_titles)
+        Q(slug__in={slugify(t) for t in targets}) | Q(title__in=targets)
     )
     # Create lookup dictionaries for fast access
     pages_by_slug = {p.slug: p for p in resolved_pages}
     pages_by_title = {p.title.lower(): p for p in resolved_pages}
+    return pages_by_slug, pages_by_title
+
 
-    all_file_targets = md_link_targets | image_targets
-    page_files = current_page.files.all()
-    # Create lookup dictionaries for files attached to the current page
+def _index_files(page_files) -> tuple[dict, dict]:
+    """Creates lookup dictionaries for the files attached to a page."""
     files_by_name = {pf.filename_display.lower(): pf for pf in page_files}
     files_by_slug = {pf.filename_slug.lower(): pf for pf in page_files}
+    return files_by_name, files_by_slug
+
+
+def _match_page(target: str, pages_by_slug: dict, pages_by_title: dict) -> WikiPage | None:
+    return pages_by_title.get(target.lower()) or pages_by_slug.get(slugify(target))
+
+
+def _match_file(target: str, files_by_name: dict, files_by_slug: dict) -> WikiFile | None:
+    return files_by_name.get(target.lower()) or files_by_slug.get(os.path.splitext(target)[0].lower())
+
+
+def render_markdown_to_html(markdown_text: str, current_page: WikiPage) -> str:
+    """
+    Efficiently processes Markdown text by pre-fetching all potential links
+    and files from the database in batches, avoiding N+1 query problems.
+    """
+    final_markdown = _expand_markup(markdown_text, current_page)
+    return markdown2.markdown(final_markdown, extras=["fenced-code-blocks", "tables", "nofollow", "header-ids", "break-on-newline", "html-classes"])
+
+
+def _expand_markup(markdown_text: str, current_page: WikiPage, single_pass: bool = True) -> str:
+    """
+    Replaces the wikilinks, links and images outside code with HTML, leaving the rest for markdown2.
+    The text is tokenized once; with single_pass=False (or when the tokenizer gives up) every
+    pattern is applied to the whole text in turn instead, which is what the tokens reproduce.
+    """
+    tokens = _tokenize_markup(markdown_text) if single_pass else None
+    if single_pass and tokens is None:
+        logger.debug("Nested or overlapping markup on page %s, expanding it pattern by pattern", current_page.pk)
+
+    # --- Pass 1: Collect all potential link and file targets from the text ---
+    if tokens is None:
+        wikilink_targets, md_link_targets, image_targets = _collect_link_targets_by_pattern(markdown_text)
+    else:
+        wikilink_targets, md_link_targets, image_targets = _collect_link_targets(markdown_text, tokens)
+
+    # --- Pass 2: Batch query the database for all collected targets ---
+    pages_by_slug, pages_by_title = _fetch_pages_for_targets(wikilink_targets | md_link_targets)
+    files_by_name, files_by_slug = _index_files(current_page.files.all())
 
     # --- Pass 3: Define replacer functions that use the pre-fetched data ---
 
-    def wikilink_replacer(match):
-        link_text_group = match.group(1)
-        target_group = match.group(2).strip()
+    # Each replacer takes the whole match and its groups, numbered as in its own pattern.
+
+    def wikilink_replacer(whole, groups):
+        link_text_group = groups[0]
+        target_group = groups[1].strip()
         display_text = escape(link_text_group.strip() if link_text_group else target_group)
 
-        page = pages_by_title.get(target_group.lower()) or pages_by_slug.get(slugify(target_group))
+        page = _match_page(target_group, pages_by_slug, pages_by_title)
         if page:
             return f'<a href="{page.get_absolute_url()}" class="wikilink">{display_text}</a>'
         else:
             create_url = reverse('wiki:page_create') + f'?initial_title_str={quote(target_group)}'
             return f'<a href="{create_url}" class="wikilink-missing" title="Create page: {escape(target_group)}">{display_text} (create)</a>'
 
-    def markdown_link_replacer(match):
-        display_text = escape(match.group(1))
-        target = match.group(2).strip()
+    def markdown_link_replacer(whole, groups):
+        display_text = escape(groups[0])
+        target = groups[1].strip()
 
         # External links are returned as-is
         if target.startswith(('http://', 'https://', '//', '/')):
-            return match.group(0)
+            return whole
         
         # Check for WikiPage link
-        page = pages_by_title.get(target.lower()) or pages_by_slug.get(slugify(target))
+        page = _match_page(target, pages_by_slug, pages_by_title)
         if page:
             return f'<a href="{page.get_absolute_url()}" class="wikilink">{display_text}</a>'
 
         # Check for attached file link
-        file = files_by_name.get(target.lower()) or files_by_slug.get(os.path.splitext(target)[0].lower())
+        file = _match_file(target, files_by_name, files_by_slug)
         if file:
-            return f'<a href="{file.file.url}" class="filelink" target="_blank" title="View file: {escape(file.filename_display)}">{display_text}</a>'
+            return f'<a href="{file.get_serving_url()}" class="filelink" target="_blank" title="View file: {escape(file.filename_display)}">{display_text}</a>'
 
         # If not found, assume it's a link to a missing page
         create_url = reverse('wiki:page_create') + f'?initial_title_str={quote(target)}'
         return f'<a href="{create_url}" class="wikilink-missing" title="Create page: {escape(target)}">{display_text} (create)</a>'
 
-    def image_replacer(match):
-        alt_text, src, title = escape(match.group(1)), match.group(2).strip(), match.group(3) or match.group(4)
+    def image_replacer(whole, groups):
+        alt_text, src, title = escape(groups[0]), groups[1].strip(), groups[2] or groups[3]
         
         if src.startswith(('http', '//', '/')):
-            return match.group(0)
+            return whole
 
-        file = files_by_name.get(src.lower()) or files_by_slug.get(os.path.splitext(src)[0].lower())
+        file = _match_file(src, files_by_name, files_by_slug)
         if not file:
             return f'<span class="filelink-missing" title="File not found on page: {escape(src)}">Image: {alt_text} (not found)</span>'
 
-        file_url = file.file.url
+        file_url = file.get_serving_url()
         file_ext = os.path.splitext(file.file.name)[1].lower()
 
         # Handle image archives
         if file_ext in constants.WIKI_ARCHIVE_EXTENSIONS:
-            cache_key = f'wiki_gallery_{file.id}_{file.uploaded_at.timestamp()}'
-            image_list = cache.get(cache_key)
-            if image_list is None:
-                image_list = get_image_list_from_archive(file)
-                cache.set(cache_key, image_list, timeout=3600)
+            # v2: get_or_build stores (value, fresh_until, build_time), not the bare list.
+            cache_key = f'wiki_gallery:v2:{file.id}:{file.uploaded_at.timestamp()}'
+            image_list = caching.get_or_build(cache_key, lambda: get_image_list_from_archive(file), timeout=3600, stale_timeout=3600)
             
             if image_list:
-                context = {'images': [], 'alt_text': alt_text}
-                for image_path in image_list:
-                    img_src_url = reverse('wiki:view_image_in_archive', args=[file.id]) + f'?path={quote(image_path)}'
-                    context['images'].append({'url': img_src_url, 'name': os.path.basename(image_path)})
+                context = {'images': [get_gallery_image(file, image_path) for image_path in image_list], 'alt_text': alt_text}
                 return render_to_string('wiki/modules/_archive_gallery.html', context)
             else: # Archive is not a valid image gallery
                 return f'<a href="{file_url}" class="filelink" target="_blank">{alt_text or escape(file.filename_display)}</a>'
@@ -242,32 +754,259 @@ def render_markdown_to_html(markdown_text: str, current_page: WikiPage) -> str:
         # Handle standard images
         else:
             title_part = f' title="{escape(title)}"' if title else ""
-            return f'<img src="{file_url}" alt="{alt_text}"{title_part}>'
+            return render_responsive_image(file, alt_text, title_part) or f'<img src="{file_url}" alt="{alt_text}"{title_part}>'
     
     # --- Final Step: Apply replacements, skipping code blocks ---
-    
+
+    if tokens is not None:
+        replacers = {'wikilink': wikilink_replacer, 'image': image_replacer, 'link': markdown_link_replacer}
+        processed_parts = []
+        for kind, token in tokens:
+            if kind == 'text':
+                processed_parts.append(token)
+            elif kind == 'code':
+                processed_parts.append(token.group(0))
+            else:
+                whole = token.group(0)
+                html = replacers[kind](whole, token.group(*constants.MARKUP_TOKEN_GROUPS[kind]))
+                # Links are looked for after wikilinks and images are replaced, so a "[" in their
+                # HTML (an archive member's name, say) could still start one. An external image is
+                # kept as written, and the link pattern skips the "[" after its "!".
+                if kind != 'link' and html != whole and '[' in html:
+                    logger.debug("Expanded %s on page %s contains '[', expanding it pattern by pattern", kind, current_page.pk)
+                    return _expand_markup(markdown_text, current_page, single_pass=False)
+                processed_parts.append(html)
+        return "".join(processed_parts)
+
+    def apply_patterns(text):
+        text = constants.WIKILINK_RE.sub(lambda match: wikilink_replacer(match.group(0), match.groups()), text)
+        text = constants.MARKDOWN_IMAGE_RE.sub(lambda match: image_replacer(match.group(0), match.groups()), text)
+        return constants.STANDARD_MARKDOWN_LINK_RE.sub(lambda match: markdown_link_replacer(match.group(0), match.groups()), text)
+
     processed_parts = []
     last_end = 0
     # Process text outside of code blocks
     for match in constants.CODE_PATTERN_RE.finditer(markdown_text):
-        # Process the segment before the code block
-        text_before_code = markdown_text[last_end:match.start()]
-        text_before_code = constants.WIKILINK_RE.sub(wikilink_replacer, text_before_code)
-        text_before_code = constants.MARKDOWN_IMAGE_RE.sub(image_replacer, text_before_code)
-        text_before_code = constants.STANDARD_MARKDOWN_LINK_RE.sub(markdown_link_replacer, text_before_code)
-        processed_parts.append(text_before_code)
-        
-        # Add the code block itself, unprocessed
+        # Process the segment before the code block, then add the code block itself, unprocessed
+        processed_parts.append(apply_patterns(markdown_text[last_end:match.start()]))
         processed_parts.append(match.group(0))
         last_end = match.end()
 
     # Process the final segment after the last code block
-    text_after = markdown_text[last_end:]
-    text_after = constants.WIKILINK_RE.sub(wikilink_replacer, text_after)
-    text_after = constants.MARKDOWN_IMAGE_RE.sub(image_replacer, text_after)
-    text_after = constants.STANDARD_MARKDOWN_LINK_RE.sub(markdown_link_replacer, text_after)
-    processed_parts.append(text_after)
+    processed_parts.append(apply_patterns(markdown_text[last_end:]))
+    return "".join(processed_parts)
+
+
+# --- Link Graph ---
+# Every link a page makes is stored as a PageLink edge. The edges give us "what links
+# here" without scanning content, and tell us exactly which cached renders go stale
+# when a page is created, renamed or deleted, or an attachment changes.
+
+def update_page_links(page: WikiPage):
+    """Re-parses a page's content and replaces its outgoing PageLink edges."""
+    wikilink_targets, md_link_targets, image_targets = _collect_link_targets(page.content)
+    pages_by_slug, pages_by_title = _fetch_pages_for_targets(wikilink_targets | md_link_targets)
+    files_by_name, files_by_slug = _index_files(page.files.all())
+
+    links = []
+    for kind, targets in (
+        (PageLink.Kind.WIKILINK, wikilink_targets),
+        (PageLink.Kind.LINK, md_link_targets),
+        (PageLink.Kind.IMAGE, image_targets),
+    ):
+        for target in targets:
+            target_page = None
+            target_file = None
+            if kind != PageLink.Kind.IMAGE:
+                target_page = _match_page(target, pages_by_slug, pages_by_title)
+            if kind != PageLink.Kind.WIKILINK:
+                target_file = _match_file(target, files_by_name, files_by_slug)
+            links.append(PageLink(
+                source=page,
+                kind=kind,
+                target=target[:PageLink.TARGET_MAX_LENGTH],
+                target_slug=slugify(target)[:PageLink.TARGET_MAX_LENGTH],
+                target_page=target_page,
+                target_file=target_file,
+            ))
+
+    with transaction.atomic():
+        PageLink.objects.filter(source=page).delete()
+        PageLink.objects.bulk_create(links)
+
+
+def refresh_links_to_page(page: WikiPage, deleted: bool = False) -> set[int]:
+    """
+    Re-resolves the edges that point at (or could now point at) a page after it was
+    saved or deleted. Returns the ids of the source pages whose renders went stale.
+    """
+    return refresh_links_to_pages([page], deleted=deleted)
+
+
+def refresh_links_to_pages(pages, deleted: bool = False) -> set[int]:
+    """`refresh_links_to_page` for many pages at once, e.g. after a bulk import."""
+    page_ids = {page.pk for page in pages}
+    target_slugs = {slug for page in pages for slug in (page.slug, slugify(page.title))}
+    candidates = Q(target_slug__in=target_slugs, kind__in=[PageLink.Kind.WIKILINK, PageLink.Kind.LINK])
+    if not deleted:
+        candidates |= Q(target_page_id__in=page_ids)
+    dependent_links = list(PageLink.objects.filter(candidates).exclude(source_id__in=page_ids))
+    if not dependent_links:
+        return set()
+
+    pages_by_slug, pages_by_title = _fetch_pages_for_targets({link.target for link in dependent_links})
+    changed_links = []
+    for link in dependent_links:
+        resolved = _match_page(link.target, pages_by_slug, pages_by_title)
+        resolved_id = resolved.pk if resolved else None
+        if resolved_id != link.target_page_id:
+            link.target_page_id = resolved_id
+            changed_links.append(link)
+    PageLink.objects.bulk_update(changed_links, ['target_page'])
+
+    # A page can be renamed while its links stay resolved, the rendered URL still changes.
+    return {link.source_id for link in dependent_links}
+
+
+def refresh_file_links(page_id: int):
+    """Re-resolves the file targets of a page's links after its attachments changed."""
+    links = list(PageLink.objects.filter(source_id=page_id).exclude(kind=PageLink.Kind.WIKILINK))
+    files_by_name, files_by_slug = _index_files(WikiFile.objects.filter(page_id=page_id))
+    changed_links = []
+    for link in links:
+        resolved = _match_file(link.target, files_by_name, files_by_slug)
+        resolved_id = resolved.pk if resolved else None
+        if resolved_id != link.target_file_id:
+            link.target_file_id = resolved_id
+            changed_links.append(link)
+    PageLink.objects.bulk_update(changed_links, ['target_file'])
+
+
+# --- Rendered Page Cache ---
+# A render is keyed on the page's `updated_at` plus a per-page render version. Content
+# edits change the former; the link graph bumps the latter for exactly the pages whose
+# links are affected by a page or attachment change.
+
+def _render_version_key(page_id: int) -> str:
+    return f"wiki_render_version:{page_id}"
+
+
+def invalidate_rendered_pages(page_ids):
+    """Marks the cached renders of the given pages as stale."""
+    version = time.time_ns()
+    cache.set_many({_render_version_key(page_id): version for page_id in page_ids}, timeout=None)
+
+
+def get_rendered_page_html(page: WikiPage) -> str:
+    """Returns the rendered HTML for a page, served from the cache when still valid."""
+    cache_key = f"wiki_rendered_html:{page.pk}:{page.updated_at.timestamp()}"
+    version_key = _render_version_key(page.pk)
+
+    cached = cache.get_many([cache_key, version_key])
+    current_version = cached.get(version_key)
+    if current_version is None:
+        # Never set, or evicted: start a new version, so no earlier render can match it.
+        current_version = cache.get_or_set(version_key, time.time_ns(), timeout=None)
+    if cache_key in cached:
+        html, rendered_version = cached[cache_key]
+        if rendered_version == current_version:
+            return html
+
+    html = render_markdown_to_html(page.content, current_page=page)
+    cache.set(cache_key, (html, current_version), timeout=settings.RENDER_CACHE_DURATION)
+    return html
+
+
+# --- Wiki Generation ---
+# A counter bumped on every page save or delete. Data derived from the set of pages as a
+# whole (the menu, the page index) is cached under keys that include it, so a change makes
+# every stale copy unreachable at once instead of waiting for a TTL to run out.
+
+GENERATION_KEY = 'wiki_generation'
+DERIVED_DATA_TIMEOUT = 60 * 60 * 24  # Only to clean up keys of old generations
+
+
+def get_generation() -> int:
+    # A lost counter restarts from the clock, never from a value used before.
+    return cache.get_or_set(GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)  # Atomic (INCR) on Redis
+    except ValueError:
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+# --- Page Index (quick search in the menu) ---
+# Titles and URLs of all pages a visibility class may see, served as a versioned JSON file
+# that the menu fetches when the search box is first used.
+
+def get_visibility_class(user) -> str:
+    if not user.is_authenticated:
+        return 'anonymous'
+    if user.is_staff:
+        return 'staff'
+    return 'authenticated'
+
+
+def _get_private_page_authors(generation: int) -> set[int]:
+    return caching.get_or_build(f'wiki_private_page_authors:{generation}', lambda: set(
+        WikiPage.objects.filter(visibility=WikiPage.Visibility.PRIVATE, author__isnull=False)
+        .values_list('author_id', flat=True).distinct()
+    ), timeout=DERIVED_DATA_TIMEOUT)
+
+
+def get_page_index_scope(user, generation: int) -> str:
+    """The visibility class whose page index the user gets, or a personal one if they own private pages."""
+    visibility_class = get_visibility_class(user)
+    if visibility_class == 'authenticated' and user.pk in _get_private_page_authors(generation):
+        return f"user-{user.pk}"
+    return visibility_class
+
+
+def _page_index_pages(scope: str):
+    if scope == 'anonymous':
+        return WikiPage.objects.filter(visibility=WikiPage.Visibility.PUBLIC)
+    if scope == 'staff':
+        return WikiPage.objects.all()
+    condition = Q(visibility__in=[WikiPage.Visibility.PUBLIC, WikiPage.Visibility.LOGGED_IN])
+    if scope.startswith('user-'):
+        condition |= Q(visibility=WikiPage.Visibility.PRIVATE, author_id=int(scope.removeprefix('user-')))
+    return WikiPage.objects.filter(condition)
+
+
+def _page_index_key(scope: str, generation: int) -> str:
+    return f'all_wiki_pages_for_search_{scope}:{generation}'
+
+
+def _build_page_index(scope: str, generation: int) -> dict:
+    pages = [
+        {"title": title, "slug": slug, "url": reverse('wiki:wiki_page', kwargs={'slug': slug})}
+        for title, slug in _page_index_pages(scope).order_by('title').values_list('title', 'slug')
+    ]
+    payload = json.dumps(pages, separators=(',', ':')).encode()
+    page_index = {
+        'version': hashlib.sha256(payload).hexdigest()[:16],
+        'json': payload,
+        'gzip': gzip.compress(payload, compresslevel=9, mtime=0),
+        'br': brotli.compress(payload) if brotli else None,
+    }
+    cache.set(f'{_page_index_key(scope, generation)}:version', page_index['version'], timeout=DERIVED_DATA_TIMEOUT)
+    return page_index
+
+
+def get_page_index(scope: str, generation: int) -> dict:
+    """
+    Returns the page index of a scope: its content-hash `version`, the `json` body and
+    pre-compressed `gzip` and `br` (None without brotli) variants of it.
+    """
+    return caching.get_or_build(_page_index_key(scope, generation), lambda: _build_page_index(scope, generation), timeout=DERIVED_DATA_TIMEOUT)
 
-    final_markdown = "".join(processed_parts)
-    
-    return markdown2.markdown(final_markdown, extras=["fenced-code-blocks", "tables", "nofollow", "header-ids", "break-on-newline", "html-classes"])
\ No newline at end of file
+
+def get_page_index_version(scope: str, generation: int) -> str:
+    """The current version of a page index, without fetching the index itself from the cache."""
+    version = cache.get(f'{_page_index_key(scope, generation)}:version')
+    if version is None:
+        version = get_page_index(scope, generation)['version']
+    return version
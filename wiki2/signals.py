@@ -1,10 +1,14 @@
-# wiki2/signals.py
 import os
 import shutil
+from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from .models import Profile, WikiPage, WikiFile
+from . import services
+from . import fulltext
+from . import jobs
 
 @receiver(post_save, sender=User)
 def create_or_update_user_profile(sender, instance, created, **kwargs):
@@ -16,11 +20,80 @@ def create_or_update_user_profile(sender, instance, created, **kwargs):
 @receiver(post_delete, sender=WikiFile)
 def delete_file_on_disk(sender, instance, **kwargs):
     if instance.file:
-        if os.path.isfile(instance.file.path):
-            os.remove(instance.file.path)
+        # Other attachments may share the blob; it goes once the last reference is committed away.
+        name = instance.file.name
+        transaction.on_commit(lambda: services.release_blobs([name]))
+    services.remove_image_derivatives(instance)
 
 @receiver(post_delete, sender=WikiPage)
 def delete_page_media_directory(sender, instance, **kwargs):
     page_media_dir = instance.get_media_directory_path()
     if page_media_dir and os.path.exists(page_media_dir) and os.path.isdir(page_media_dir):
-        shutil.rmtree(page_media_dir, ignore_errors=True)
\ No newline at end of file
+        shutil.rmtree(page_media_dir, ignore_errors=True)
+
+
+# --- Link graph and rendered page cache ---
+# The edges are rows and roll back with the save; the cache isn't, so renders are only
+# invalidated once the change is committed: before that, a concurrent request would
+# re-render from the old rows and cache the result under the new version.
+
+@receiver(post_save, sender=WikiPage)
+def update_link_graph_on_page_save(sender, instance, **kwargs):
+    services.update_page_links(instance)
+    stale_page_ids = services.refresh_links_to_page(instance)
+    transaction.on_commit(lambda: services.invalidate_rendered_pages(stale_page_ids))
+
+@receiver(post_delete, sender=WikiPage)
+def update_link_graph_on_page_delete(sender, instance, **kwargs):
+    stale_page_ids = services.refresh_links_to_page(instance, deleted=True)
+    transaction.on_commit(lambda: services.invalidate_rendered_pages(stale_page_ids))
+
+@receiver(post_save, sender=WikiPage)
+@receiver(post_delete, sender=WikiPage)
+def bump_wiki_generation_on_page_change(sender, instance, **kwargs):
+    # After commit, or the menu and page index could be rebuilt from the old rows under the new generation.
+    transaction.on_commit(services.bump_generation)
+
+@receiver(post_save, sender=WikiFile)
+@receiver(post_delete, sender=WikiFile)
+def update_link_graph_on_file_change(sender, instance, **kwargs):
+    services.refresh_file_links(instance.page_id)
+    page_id = instance.page_id
+    transaction.on_commit(lambda: services.invalidate_rendered_pages([page_id]))
+
+
+
+# --- Full-text search index ---
+
+@receiver(post_save, sender=WikiPage)
+def update_search_index_on_page_save(sender, instance, **kwargs):
+    fulltext.index_page(instance)
+
+@receiver(post_delete, sender=WikiPage)
+def update_search_index_on_page_delete(sender, instance, **kwargs):
+    fulltext.remove_page(instance.pk)
+
+
+
+# --- Archive member index ---
+
+@receiver(post_save, sender=WikiFile)
+def index_archive_on_upload(sender, instance, **kwargs):
+    if instance.archive_index is None:
+        services.ensure_archive_index(instance)
+
+
+# --- Image derivatives ---
+
+@receiver(post_save, sender=WikiFile)
+def prune_stale_image_derivatives(sender, instance, created, **kwargs):
+    if not created:
+        services.remove_image_derivatives(instance, stale_only=True)
+
+
+# --- Background media jobs ---
+
+@receiver(post_save, sender=WikiFile)
+def enqueue_media_jobs_on_upload(sender, instance, **kwargs):
+    if settings.WIKI_MEDIA_WORKER_ENABLED:
+        transaction.on_commit(lambda: jobs.enqueue_for_upload(instance))
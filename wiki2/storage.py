@@ -0,0 +1,158 @@
+# wiki2/storage.py
+"""
+Content-addressed attachment storage.
+
+Attachment bytes are stored once under `wiki_blobs/<ab>/<cd>/<sha256><ext>`, whatever page
+or name they were uploaded under: the same photo archive on three pages takes up the space
+of one, and renaming a page or attachment never moves a file. The name a FileField asks
+for only contributes its extension. Several WikiFile rows can point at one blob, so blobs
+are only deleted when no row references them any more (see `services.release_blobs`).
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.utils.deconstruct import deconstructible
+
+BLOB_DIRECTORY = 'wiki_blobs'
+CHUNK_SIZE = 1024 * 1024
+BLOB_NAME_RE = re.compile(rf'^{BLOB_DIRECTORY}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(\.[^/]*)?$')
+
+
+def blob_name(digest: str, ext: str = '') -> str:
+    return f"{BLOB_DIRECTORY}/{digest[:2]}/{digest[2:4]}/{digest}{ext.lower()}"
+
+
+def blob_digest(name: str) -> str | None:
+    """The SHA-256 of a stored attachment, read from its name; None for files stored before the blob layout."""
+    match = BLOB_NAME_RE.match(name or '')
+    return match.group(1) if match else None
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file_obj:
+        while chunk := file_obj.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@deconstructible(path='wiki2.storage.ContentAddressedStorage')
+class ContentAddressedStorage(FileSystemStorage):
+    """A FileSystemStorage that names every file after the SHA-256 of its bytes."""
+
+    def get_available_name(self, name, max_length=None):
+        # Identical bytes share one blob, so a taken name is never a conflict.
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        # Uploads were hashed while streaming in (see the upload handlers below).
+        digest = getattr(content, 'sha256', None)
+
+        if hasattr(content, 'temporary_file_path'):
+            source_path = content.temporary_file_path()
+            digest = digest or hash_file(source_path)
+            final_name = blob_name(digest, ext)
+            if not self._keep_alive(final_name):
+                self._make_parent(final_name)
+                file_move_safe(source_path, self.path(final_name), allow_overwrite=True)
+                self._set_permissions(final_name)
+            return final_name
+
+        if digest and self._keep_alive(blob_name(digest, ext)):
+            return blob_name(digest, ext)
+
+        # Copy into a temp file next to the blobs, hashing in the same pass, then rename.
+        temp_directory = self.path(BLOB_DIRECTORY)
+        os.makedirs(temp_directory, exist_ok=True)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile('wb', dir=temp_directory, prefix='.', suffix='.tmp', delete=False) as temp_file:
+            try:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks(CHUNK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    sha256.update(chunk)
+                    temp_file.write(chunk)
+            except BaseException:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+        final_name = blob_name(sha256.hexdigest(), ext)
+        if self._keep_alive(final_name):
+            os.remove(temp_file.name)
+        else:
+            self._make_parent(final_name)
+            os.replace(temp_file.name, self.path(final_name))
+            self._set_permissions(final_name)
+        return final_name
+
+    def _keep_alive(self, name) -> bool:
+        """Returns whether the blob exists, marking it as recently used for `services.release_blobs`."""
+        try:
+            os.utime(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _make_parent(self, name):
+        directory = os.path.dirname(self.path(name))
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def _set_permissions(self, name):
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(name), self.file_permissions_mode)
+
+
+attachment_storage = ContentAddressedStorage()
+
+
+# --- Upload handlers (settings.FILE_UPLOAD_HANDLERS) ---
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    """Hashes small uploads while they stream in, so storing them needs no second pass."""
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Hashes large uploads while they are written to their temporary file."""
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.sha256.hexdigest()
+        return file
@@ -1,3 +1,179 @@
-from django.test import TestCase
+import io
+import json
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from . import constants, inverted_index, services, utils
+from .models import WikiPage, WikiFile
+
+
+def _png_bytes(size=(40, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+# Markdown whose HTML must not change whichever way it is pre-processed. The single-pass
+# tokenizer has to reproduce the pattern-by-pattern pipeline exactly, quirks included.
+GOLDEN_CORPUS = [
+    constants.DEFAULT_ROOT_PAGE_CONTENT,
+    "See [[Existing Page]], [[Shown text|existing page]] and [[Missing Page]].",
+    "[Linked](existing-page), [Spaced](Existing Page \"t\"), [to a file](diagram.png) and [gone](nowhere 'title').",
+    "External: [site](https://example.com \"Example\"), [root](/search/), [proto](//cdn.example.com/x) [httpd](httpd).",
+    "![Diagram](diagram.png) ![Titled](diagram.png \"A title\") ![Missing](nope.png) ![remote](https://example.com/a.png)",
+    "![Manual](manual.pdf \"page=2&zoom=50\") ![Photos](photos.zip) [Manual](manual)",
+    "Code `[[Existing Page]]` and ``[x](y)`` stay as they are.\n\n```\n[[Existing Page]] ![a](diagram.png)\n```\n\n~~~python\n[x](y)\n~~~\nAfter [[Existing Page]].",
+    "Unclosed `code with [[Existing Page]] and [x](diagram.png)",
+    "Lines\n[[Existing\nPage]] [multi\nline](existing-page) ![a\nb](diagram.png)",
+    "[see [[Existing Page]]](existing-page) and [[a|b|c]] and [[x]]]",
+    "![alt [[Existing Page]] more](diagram.png) ![a](b [[Missing Page]] \"t)",
+    "[a ![Diagram](diagram.png) b](existing-page) ![[x](y)](diagram.png)",
+    "[[Existing [Page]]] [a [b](c)](d) ![a]b](diagram.png) [x](`y`) [[`code`]]",
+    "Text with [brackets] and (parens) around [[Existing Page]] (see also [Linked](existing-page)).",
+    "![a](diagram.png)[b](existing-page)!![c](diagram.png)\\[[Existing Page]]",
+    "",
+]
+
+# HTML the renderer produced before the single-pass tokenizer (baseline e3b7826), frozen so
+# both code paths are checked against it and not just against each other. The corpus avoids
+# the attached files, whose URLs and markup have changed since.
+FROZEN_RENDERS = json.loads((Path(__file__).parent / 'testdata' / 'markup_golden.json').read_text())
+
+
+class MarkupExpansionGoldenTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.page = WikiPage.objects.create(title='Current Page', content='')
+        WikiPage.objects.create(title='Existing Page', content='')
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('one.png', _png_bytes())
+            zf.writestr('two [b](c).png', _png_bytes((20, 20)))
+        for name, data in (('diagram.png', _png_bytes()), ('manual.pdf', b'%PDF-1.4\n'), ('photos.zip', archive.getvalue())):
+            wiki_file = WikiFile(page=self.page, filename_slug=name.rsplit('.', 1)[0])
+            wiki_file.file.save(name, ContentFile(data), save=False)
+            wiki_file.save()
+
+    def test_single_pass_matches_pattern_pipeline(self):
+        for markdown_text in GOLDEN_CORPUS:
+            with self.subTest(markdown_text=markdown_text[:60]):
+                self.assertEqual(
+                    services._expand_markup(markdown_text, self.page),
+                    services._expand_markup(markdown_text, self.page, single_pass=False),
+                )
+
+    def test_link_targets_match_outside_code(self):
+        markdown_text = GOLDEN_CORPUS[1] + GOLDEN_CORPUS[2] + GOLDEN_CORPUS[4]
+        self.assertEqual(
+            services._collect_link_targets(markdown_text),
+            services._collect_link_targets_by_pattern(markdown_text),
+        )
+
+    def test_default_page_is_tokenized_in_one_pass(self):
+        self.assertIsNotNone(services._tokenize_markup(constants.DEFAULT_ROOT_PAGE_CONTENT))
+
+    def test_frozen_renders(self):
+        for case in FROZEN_RENDERS:
+            for single_pass in (True, False):
+                with self.subTest(markdown_text=case['markdown'][:60], single_pass=single_pass):
+                    expanded = services._expand_markup(case['markdown'], self.page, single_pass=single_pass)
+                    with mock.patch.object(services, '_expand_markup', return_value=expanded):
+                        self.assertEqual(services.render_markdown_to_html(case['markdown'], self.page), case['html'])
+
+    def test_nested_markup_falls_back_to_pattern_pipeline(self):
+        markdown_text = "[see [[Existing Page]]](existing-page)"
+        self.assertIsNone(services._tokenize_markup(markdown_text))
+        with self.assertLogs(services.logger, 'DEBUG') as logs:
+            expanded = services._expand_markup(markdown_text, self.page)
+        self.assertEqual(expanded, services._expand_markup(markdown_text, self.page, single_pass=False))
+        self.assertIn('Nested or overlapping markup', logs.output[0])
+
+    def test_bracket_in_expanded_html_falls_back_to_pattern_pipeline(self):
+        # The archive's member names end up in the gallery HTML, one of them with a "[".
+        with mock.patch.object(services, '_expand_markup', wraps=services._expand_markup) as expand, \
+                self.assertLogs(services.logger, 'DEBUG') as logs:
+            services._expand_markup("![Photos](photos.zip) [Linked](existing-page)", self.page)
+        self.assertEqual(expand.call_args.kwargs, {'single_pass': False})
+        self.assertIn('contains', logs.output[0])
+
+    def test_golden_output(self):
+        expanded = services._expand_markup(
+            "[[Existing Page]] [[Missing Page]] [x](https://example.com) `[[Existing Page]]`", self.page
+        )
+        self.assertEqual(
+            expanded,
+            '<a href="/existing-page/" class="wikilink">Existing Page</a> '
+            '<a href="/create/?initial_title_str=Missing%20Page" class="wikilink-missing" '
+            'title="Create page: Missing Page">Missing Page (create)</a> '
+            '[x](https://example.com) `[[Existing Page]]`',
+        )
+
+
+class SlugAllocationTests(TestCase):
+    def test_long_titles_get_distinct_slugs(self):
+        max_length = WikiPage._meta.get_field('slug').max_length
+        titles = ['b' * max_length, 'B' * max_length, 'b' * (max_length - 1) + 'B']
+        slugs = [WikiPage.objects.create(title=title).slug for title in titles]
+        self.assertEqual(slugs, ['b' * max_length, 'b' * (max_length - 2) + '-1', 'b' * (max_length - 2) + '-2'])
+
+    def test_suffix_longer_than_reserve(self):
+        max_length = WikiPage._meta.get_field('slug').max_length
+        slugs = ['b' * max_length] + [f"{'b' * (max_length - len(f'-{n}'))}-{n}" for n in range(1, 11)]
+        WikiPage.objects.bulk_create([WikiPage(title=slug, slug=slug) for slug in slugs])
+        with mock.patch.object(utils, 'SLUG_SUFFIX_RESERVE', len('-9')):
+            page = WikiPage.objects.create(title='B' * max_length)
+        self.assertEqual(page.slug, 'b' * (max_length - 3) + '-11')
+
+
+class InvertedIndexLogTests(TestCase):
+    def test_replayed_log_matches_direct_updates(self):
+        direct = inverted_index.InvertedIndex()
+        direct.add_document(1, 'Zebra crossing', 'zebra stripes and more zebra')
+        direct.add_document(2, 'Other', 'stripes')
+        direct.remove_document(2)
+        log = (
+            inverted_index.encode_record(1, inverted_index.document_postings('Zebra crossing', 'zebra stripes and more zebra'))
+            + inverted_index.encode_record(2, inverted_index.document_postings('Other', 'stripes'))
+            + inverted_index.encode_record(2, None)
+        )
+        replayed = inverted_index.InvertedIndex()
+        # A record cut short at the end of the log is left for the next read.
+        self.assertEqual(inverted_index.apply_records(replayed, log + log[:5]), len(log))
+        self.assertEqual(replayed.to_bytes(), direct.to_bytes())
+
+    def test_ranked_results_skip_deleted_pages(self):
+        kept = WikiPage.objects.create(title='Kept', content='')
+        deleted = WikiPage.objects.create(title='Deleted', content='')
+        results = inverted_index.RankedResults([(deleted.pk, 2.0), (kept.pk, 1.0)], WikiPage.objects.all())
+        self.assertEqual(results.count(), 2)
+        deleted.delete()
+        self.assertEqual(results[0:2], [kept])
+
+
+class RenderCacheTests(TestCase):
+    def test_evicted_version_key_is_not_a_match(self):
+        page = WikiPage.objects.create(title='Cached', content='[[Later Page]]')
+        self.assertIn('wikilink-missing', services.get_rendered_page_html(page))
+        WikiPage.objects.create(title='Later Page', content='')
+        cache.delete(services._render_version_key(page.pk))
+        self.assertNotIn('wikilink-missing', services.get_rendered_page_html(page))
@@ -0,0 +1,172 @@
+# wiki2/uploads.py
+"""
+Chunked, resumable attachment uploads.
+
+The editor starts an UploadSession, PUTs the file in fixed-size chunks (several at a time,
+in any order) and then finalizes it. Every chunk is written at its offset into a staging
+file and checked against the SHA-256 the client sent along, so each request is short and a
+dropped connection only costs the chunks in flight. On finalize the checksum over all chunk
+digests is verified and the staging file is moved into the blob store as a WikiFile.
+"""
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from .models import WikiFile, UploadSession, UploadChunk
+from . import services
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """The request doesn't fit the upload session; the message is shown to the user."""
+
+
+class StagedFile(File):
+    """A finished staging file. Storage moves it into place instead of copying it."""
+
+    def __init__(self, path: str, name: str):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def staging_path(session: UploadSession) -> str:
+    return os.path.join(settings.WIKI_UPLOAD_STAGING_DIR, str(session.pk))
+
+
+def combined_checksum(chunk_digests) -> str:
+    """The upload's checksum: the SHA-256 over the raw SHA-256 digests of its chunks, in order."""
+    hasher = hashlib.sha256()
+    for digest in chunk_digests:
+        hasher.update(bytes.fromhex(digest))
+    return hasher.hexdigest()
+
+
+# --- Sessions ---
+
+def start(page, user, filename: str, size: int, filename_slug: str = '') -> UploadSession:
+    """Creates the session and its staging file, sized up front so chunks can land in any order."""
+    discard_stale()
+    session = UploadSession.objects.create(
+        page=page,
+        uploaded_by=user,
+        filename=os.path.basename(filename),
+        filename_slug=filename_slug,
+        size=size,
+        chunk_size=settings.WIKI_UPLOAD_CHUNK_SIZE,
+    )
+    os.makedirs(settings.WIKI_UPLOAD_STAGING_DIR, exist_ok=True)
+    with open(staging_path(session), 'wb') as staging_file:
+        staging_file.truncate(size)
+    return session
+
+
+def received_chunks(session: UploadSession) -> list[int]:
+    return list(session.chunks.order_by('index').values_list('index', flat=True))
+
+
+def discard(session: UploadSession):
+    try:
+        os.remove(staging_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
+
+
+def discard_stale():
+    """Removes sessions nobody resumed within WIKI_UPLOAD_SESSION_MAX_AGE."""
+    cutoff = timezone.now() - timedelta(seconds=settings.WIKI_UPLOAD_SESSION_MAX_AGE)
+    for session in UploadSession.objects.filter(created_at__lt=cutoff).only('pk'):
+        discard(session)
+
+
+# --- Chunks ---
+
+def write_chunk(session: UploadSession, offset: int, stream, length: int, sha256: str) -> UploadChunk:
+    """
+    Writes one chunk from `stream` at `offset`. The chunk is spooled and checked against
+    `sha256` first: a bad one (or a bad resend of a chunk already recorded) never touches
+    the staging file, and the client simply sends it again.
+    """
+    if offset < 0 or offset % session.chunk_size or offset >= max(session.size, 1):
+        raise UploadError(f"Offset {offset} is not the start of a chunk.")
+    expected_length = min(session.chunk_size, session.size - offset)
+    if length != expected_length:
+        raise UploadError(f"The chunk at offset {offset} must be {expected_length} bytes, got {length}.")
+    if not os.path.isfile(staging_path(session)):
+        raise UploadError("The upload expired, start it again.")
+
+    hasher = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, dir=settings.WIKI_UPLOAD_STAGING_DIR) as spool:
+        remaining = length
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                raise UploadError(f"The chunk at offset {offset} was cut short.")
+            hasher.update(data)
+            spool.write(data)
+            remaining -= len(data)
+
+        digest = hasher.hexdigest()
+        if digest != sha256.lower():
+            raise UploadError(f"Checksum mismatch for the chunk at offset {offset}.")
+
+        spool.seek(0)
+        try:
+            fd = os.open(staging_path(session), os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadError("The upload expired, start it again.")
+        try:
+            position = offset
+            while data := spool.read(READ_SIZE):
+                os.pwrite(fd, data, position)
+                position += len(data)
+        finally:
+            os.close(fd)
+
+    try:
+        chunk, _created = UploadChunk.objects.update_or_create(session=session, index=offset // session.chunk_size, defaults={'sha256': digest})
+    except IntegrityError:
+        # The same chunk was retried while its first attempt was still being recorded.
+        chunk = UploadChunk.objects.get(session=session, index=offset // session.chunk_size)
+    return chunk
+
+
+def finalize(session: UploadSession, checksum: str) -> WikiFile:
+    """Verifies the upload and turns it into a WikiFile. The staging file is moved, not copied."""
+    digests = list(session.chunks.order_by('index').values_list('sha256', flat=True))
+    if len(digests) != session.chunk_count:
+        raise UploadError(f"{session.chunk_count - len(digests)} chunk(s) still missing.")
+    path = staging_path(session)
+    if not os.path.isfile(path) or os.path.getsize(path) != session.size:
+        raise UploadError("The upload expired, start it again.")
+    if combined_checksum(digests) != checksum.lower():
+        raise UploadError("Checksum mismatch, the file was not stored.")
+
+    wiki_file = WikiFile(page=session.page, uploaded_by=session.uploaded_by, filename_slug=session.filename_slug)
+    staged_file = StagedFile(path, session.filename)
+    wiki_file.file = staged_file
+    try:
+        with transaction.atomic():
+            wiki_file.save()
+            session.delete()
+    except BaseException:
+        # The row was rolled back; don't leave the moved file behind.
+        if wiki_file.file.name != session.filename:
+            services.release_blobs([wiki_file.file.name])
+        raise
+    finally:
+        staged_file.close()
+    # Identical bytes were already stored, so the staging file wasn't needed.
+    if os.path.exists(path):
+        os.remove(path)
+    return wiki_file
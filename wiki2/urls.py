@@ -11,14 +11,23 @@ urlpatterns = [
     path('profile/', views.profile, name='profile'),
     # path('logout/', views.logout_view, name='logout'),
     path('all/', views.all_wiki_pages, name='all_pages'),
+    path('page-index/<str:scope>/<str:version>.json', views.page_index, name='page_index'),
+    path('qr/<str:version>/<slug:slug>.svg', views.page_qr, name='page_qr'),
     path('create/', views.page_create, name='page_create'),
 
     path('files/view-in-archive/<int:file_id>/', views.view_image_in_archive, name='view_image_in_archive'),
+    path('files/<int:file_id>/derivatives/<str:version>/<str:derivative>', views.image_derivative, name='image_derivative'),
+    path('files/<int:file_id>/<str:filename>', views.serve_protected_file, name='protected_file'),
+    path('files/<int:file_id>/<str:version>/<str:filename>', views.serve_versioned_file, name='versioned_file'),
     
     path('<slug:slug>/', views.wiki_page, name='wiki_page'),
     path('<slug:slug>/edit/', views.page_edit, name='page_edit'),
+    path('<slug:slug>/backlinks/', views.page_backlinks, name='page_backlinks'),
     path('<slug:slug>/delete/', views.page_delete, name='page_delete'),
     path('<slug:slug>/upload/', views.page_upload_file, name='page_upload_file'),
+    path('<slug:slug>/upload/chunked/', views.page_upload_start, name='page_upload_start'),
+    path('<slug:slug>/upload/chunked/<uuid:upload_id>/', views.page_upload_session, name='page_upload_session'),
+    path('<slug:slug>/upload/chunked/<uuid:upload_id>/finalize/', views.page_upload_finalize, name='page_upload_finalize'),
     path('<slug:slug>/delete_file/<int:file_id>/', views.page_delete_file, name='page_delete_file'),
     path('<slug:slug>/download_file/<int:file_id>/', views.page_download_file, name='page_download_file'),
 ]
\ No newline at end of file
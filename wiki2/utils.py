@@ -1,15 +1,58 @@
 # wiki2/utils.py
+import re
 import qrcode
-import base64
+import qrcode.image.svg
 from io import BytesIO
 
-def qr_img(request):
-    current_url = request.build_absolute_uri()
-    qr = qrcode.QRCode(box_size=5, border=0, error_correction=qrcode.constants.ERROR_CORRECT_M)
-    qr.add_data(current_url)
+def qr_svg(data: str) -> bytes:
+    """Renders `data` as a QR code in SVG, a few KB of vector paths instead of a PNG."""
+    qr = qrcode.QRCode(
+        box_size=5, border=0, error_correction=qrcode.constants.ERROR_CORRECT_M,
+        image_factory=qrcode.image.svg.SvgPathFillImage,
+    )
+    qr.add_data(data)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
     buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    img_base64 = base64.b64encode(buffer.getvalue()).decode()
-    return img_base64
\ No newline at end of file
+    qr.make_image().save(buffer)
+    return buffer.getvalue()
+
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    """Splits text into lowercase word tokens, the unit every search backend indexes."""
+    return [token.lower() for token in TOKEN_RE.findall(text)]
+
+
+def next_free_slug(base_slug: str, taken: set[str], max_length: int) -> str:
+    """Returns `base_slug`, or `base_slug-N` with the lowest N, whichever isn't in `taken`."""
+    if base_slug[:max_length] not in taken:
+        return base_slug[:max_length]
+    counter = 1
+    while True:
+        suffix = f"-{counter}"
+        candidate = f"{base_slug[:max_length - len(suffix)]}{suffix}"
+        if candidate not in taken:
+            return candidate
+        counter += 1
+
+
+# Room a "-N" suffix may take from a slug at its maximum length, see `allocate_slug`.
+SLUG_SUFFIX_RESERVE = len('-9999')
+
+
+def allocate_slug(queryset, field: str, base_slug: str, max_length: int) -> str:
+    """
+    Returns the next free slug for `base_slug` among the values of `field` in `queryset`.
+    All candidates are fetched in a single query.
+    """
+    # A suffixed candidate truncates the base to make room, so look up by the shortest stem.
+    # Should the counter need more digits than reserved, look again with a shorter stem.
+    reserve = SLUG_SUFFIX_RESERVE
+    while True:
+        stem = base_slug[:max_length - reserve]
+        taken = set(queryset.filter(**{f"{field}__startswith": stem}).values_list(field, flat=True))
+        slug = next_free_slug(base_slug, taken, max_length)
+        if slug.startswith(stem):
+            return slug
+        reserve += 1
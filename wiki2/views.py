@@ -3,11 +3,16 @@ import os
 import mimetypes
 import hashlib
 
-from .models import WikiPage, WikiFile
-from .forms import WikiPageForm, WikiFileForm, UserUpdateForm, ProfileUpdateForm
+from .models import WikiPage, WikiFile, MediaJob, UploadSession
+from .forms import WikiPageForm, WikiFileForm, UserUpdateForm, ProfileUpdateForm, UploadSessionForm
 from . import constants
 from . import utils
 from . import services
+from . import fulltext
+from . import media
+from . import jobs
+from . import caching
+from . import uploads
 
 from django.conf import settings
 from django.urls import reverse
@@ -17,7 +22,9 @@ from django.db.models import Q
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
-from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils.cache import patch_cache_control, patch_vary_headers, add_never_cache_headers, get_conditional_response
+from django.utils.http import quote_etag
 from django.utils.text import slugify
 from urllib.parse import urlencode
 
@@ -63,17 +70,57 @@ def search(request):
     if exact_match:
         return redirect(exact_match.get_absolute_url())
 
-    results = visible_pages.filter(
-        Q(title__icontains=query)
-    ).distinct().order_by('-updated_at')
+    results = fulltext.search_pages(query, visible_pages)
+    paginator = Paginator(results, settings.WIKI_SEARCH_RESULTS_PER_PAGE)
 
-    if results.exists():
-        if results.count() == 1:
-            return redirect(results.first().get_absolute_url())
-        return render(request, 'wiki/pages/wiki_list.html', {'pages': results, 'is_search': True, 'query': query})
-    else:
+    if paginator.count == 0:
         messages.warning(request, f"No results found for '{query}'.")
         return redirect('wiki:wiki')
+    if paginator.count == 1:
+        return redirect(results.first().get_absolute_url())
+
+    page_obj = paginator.get_page(request.GET.get('page'))
+    fulltext.attach_snippets(page_obj, query)
+    return render(request, 'wiki/pages/wiki_list.html', {
+        'pages': page_obj, 'page_obj': page_obj, 'is_search': True, 'query': query,
+    })
+
+
+def page_index(request, scope, version):
+    """The versioned JSON list of pages the menu's quick search filters on."""
+    generation = services.get_generation()
+    if scope != services.get_page_index_scope(request.user, generation):
+        raise Http404("Page index not found.")
+
+    page_index = services.get_page_index(scope, generation)
+    etag = quote_etag(page_index['version'])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        accepted_encodings = {
+            encoding.split(';')[0].strip() for encoding in request.headers.get('Accept-Encoding', '').split(',')
+        }
+        response = HttpResponse(content_type='application/json')
+        if page_index['br'] is not None and 'br' in accepted_encodings:
+            response.content = page_index['br']
+            response['Content-Encoding'] = 'br'
+        elif 'gzip' in accepted_encodings:
+            response.content = page_index['gzip']
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response.content = page_index['json']
+    response['ETag'] = etag
+    patch_vary_headers(response, ['Accept-Encoding'])
+
+    if scope == 'anonymous':
+        patch_cache_control(response, public=True)
+    else:
+        patch_cache_control(response, private=True)
+    if version == page_index['version']:
+        patch_cache_control(response, max_age=settings.WIKI_IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        # Requested by a page rendered before the index changed: the current data, revalidated next time.
+        patch_cache_control(response, no_cache=True)
+    return response
 
 
 def wiki(request):
@@ -97,15 +144,14 @@ def wiki_page(request, slug):
             return redirect_to_login(request.get_full_path())
         
         
-        html_content = services.render_markdown_to_html(page.content, current_page=page)
+        html_content = services.get_rendered_page_html(page)
         
-        qr = utils.qr_img(request)
         page_files = page.files.all().order_by('-uploaded_at')
 
         return render(request, 'wiki/pages/wiki_page.html', {
             'page': page,
             'html_content': html_content,
-            'qrcode': qr,
+            'qrcode_url': page_qr_url(request, page.slug),
             'page_files': page_files,
         })
 
@@ -118,6 +164,42 @@ def wiki_page(request, slug):
         return redirect('wiki:wiki')
 
 
+def _page_qr_data(request, slug):
+    """The absolute page URL the QR code encodes, and a short hash of it for the versioned URL."""
+    page_url = request.build_absolute_uri(reverse('wiki:wiki_page', kwargs={'slug': slug}))
+    return page_url, hashlib.sha256(page_url.encode()).hexdigest()[:12]
+
+
+def page_qr_url(request, slug):
+    _page_url, version = _page_qr_data(request, slug)
+    return reverse('wiki:page_qr', kwargs={'version': version, 'slug': slug})
+
+
+def page_qr(request, version, slug):
+    """An SVG QR code linking to a page, for pages the user may see (so made-up slugs can't fill the cache)."""
+    page = get_object_or_404(get_visible_pages(request.user), slug=slug)
+    page_url, current_version = _page_qr_data(request, page.slug)
+    svg = caching.get_or_build(f"wiki_qr_svg:{current_version}", lambda: utils.qr_svg(page_url), timeout=settings.WIKI_IMMUTABLE_MAX_AGE)
+    response = HttpResponse(svg, content_type='image/svg+xml')
+    audience = {'public': True} if page.visibility == WikiPage.Visibility.PUBLIC else {'private': True}
+    if version == current_version:
+        patch_cache_control(response, **audience, max_age=settings.WIKI_IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, **audience, no_cache=True)
+    return response
+
+
+def page_backlinks(request, slug):
+    visible_pages = get_visible_pages(request.user)
+    page = get_object_or_404(visible_pages, slug=slug)
+
+    linking_pages = visible_pages.filter(outgoing_links__target_page=page).distinct().order_by('title')
+    return render(request, 'wiki/pages/wiki_list.html', {
+        'pages': linking_pages,
+        'list_title': f"Pages linking to '{page.title}'",
+    })
+
+
 @login_required
 def page_create(request):
     if request.method == 'POST':
@@ -199,17 +281,83 @@ def page_upload_file(request, slug):
             wiki_file.page = page
             wiki_file.uploaded_by = request.user
             wiki_file.save()
-            file_data = {
-                'id': wiki_file.id,
-                'url': wiki_file.file.url,
-                'name': wiki_file.filename_display,
-                'delete_url': reverse('wiki:page_delete_file', kwargs={'slug': page.slug, 'file_id': wiki_file.id})
-            }
-            return JsonResponse({'status': 'success', 'file': file_data})
+            return _uploaded_file_response(page, wiki_file)
         return JsonResponse({'status': 'error', 'errors': form.errors}, status=400)
     return HttpResponseBadRequest("Invalid request method")
 
 
+def _uploaded_file_response(page, wiki_file):
+    file_data = {
+        'id': wiki_file.id,
+        'url': wiki_file.get_serving_url(),
+        'name': wiki_file.filename_display,
+        'delete_url': reverse('wiki:page_delete_file', kwargs={'slug': page.slug, 'file_id': wiki_file.id})
+    }
+    return JsonResponse({'status': 'success', 'file': file_data})
+
+
+# --- Chunked uploads (see uploads.py) ---
+
+@login_required
+def page_upload_start(request, slug):
+    page = get_object_or_404(WikiPage, slug=slug)
+    if request.method != 'POST':
+        return HttpResponseBadRequest("Invalid request method")
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'status': 'error', 'errors': form.errors}, status=400)
+    session = uploads.start(page, request.user, form.cleaned_data['filename'], form.cleaned_data['size'], form.cleaned_data['filename_slug'])
+    return JsonResponse({
+        'status': 'success',
+        'upload_id': str(session.pk),
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'url': reverse('wiki:page_upload_session', kwargs={'slug': page.slug, 'upload_id': session.pk}),
+        'finalize_url': reverse('wiki:page_upload_finalize', kwargs={'slug': page.slug, 'upload_id': session.pk}),
+    })
+
+
+@login_required
+def page_upload_session(request, slug, upload_id):
+    """GET: the chunks received so far (to resume), PUT ?offset=: one chunk, DELETE: abort."""
+    session = get_object_or_404(UploadSession, pk=upload_id, page__slug=slug, uploaded_by=request.user)
+    if request.method == 'GET':
+        return JsonResponse({
+            'status': 'success',
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'received': uploads.received_chunks(session),
+        })
+    if request.method == 'DELETE':
+        uploads.discard(session)
+        return JsonResponse({'status': 'success'})
+    if request.method != 'PUT':
+        return HttpResponseBadRequest("Invalid request method")
+
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': "A numeric offset is required."}, status=400)
+    try:
+        chunk = uploads.write_chunk(session, offset, request, length, request.headers.get('X-Chunk-SHA256', ''))
+    except uploads.UploadError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'index': chunk.index})
+
+
+@login_required
+def page_upload_finalize(request, slug, upload_id):
+    session = get_object_or_404(UploadSession.objects.select_related('page'), pk=upload_id, page__slug=slug, uploaded_by=request.user)
+    if request.method != 'POST':
+        return HttpResponseBadRequest("Invalid request method")
+    try:
+        wiki_file = uploads.finalize(session, request.POST.get('checksum', ''))
+    except uploads.UploadError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return _uploaded_file_response(session.page, wiki_file)
+
+
 @login_required
 def page_delete_file(request, slug, file_id):
     if request.method != 'POST':
@@ -220,62 +368,165 @@ def page_delete_file(request, slug, file_id):
     file_to_delete.delete()
     return JsonResponse({'status': 'success', 'message': f"File '{filename}' deleted successfully."})
 
+def _check_file_access(request, page):
+    """
+    The permission rule for everything served from a page's attachments. Returns None if
+    access is allowed, a login redirect for anonymous users on a non-public page, and
+    raises Http404 otherwise.
+    """
+    if WikiPage.objects.get_visible_by_user(request.user).filter(pk=page.pk).exists():
+        return None
+    if page.visibility != WikiPage.Visibility.PUBLIC and not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    raise Http404("You do not have permission to access this file.")
+
+
 def page_download_file(request, slug, file_id):
     wiki_file = get_object_or_404(WikiFile, id=file_id, page__slug=slug)
     page = wiki_file.page
 
-    if not WikiPage.objects.get_visible_by_user(request.user).filter(pk=page.pk).exists():
-        if page.visibility != WikiPage.Visibility.PUBLIC and not request.user.is_authenticated:
-            return redirect_to_login(request.get_full_path())
-        raise Http404("You do not have permission to access this file.")
+    denied = _check_file_access(request, page)
+    if denied:
+        return denied
 
-    file_path = wiki_file.file.path
-    if not os.path.exists(file_path):
-        raise Http404("File does not exist on the server.")
+    return media.serve_wiki_file(request, wiki_file, as_attachment=True)
 
-    mime_type, _ = mimetypes.guess_type(file_path)
-    try:
-        response = HttpResponse(wiki_file.file.read(), content_type=mime_type or 'application/octet-stream')
-        response['Content-Disposition'] = f'attachment; filename="{wiki_file.filename_display}"'
+
+def serve_protected_file(request, file_id, filename):
+    """Attachment URLs from before content versions: sent on to the versioned URL, which checks access."""
+    wiki_file = get_object_or_404(WikiFile, pk=file_id)
+    response = redirect(wiki_file.get_serving_url())
+    add_never_cache_headers(response)
+    return response
+
+
+def _cache_versioned_media(response, page):
+    """
+    Browsers may keep a response whose URL carries the content version for good. Shared
+    caches only get it briefly, and only for public pages: the version follows the bytes,
+    not the page's visibility, which can still change.
+    """
+    if page.visibility == WikiPage.Visibility.PUBLIC:
+        patch_cache_control(
+            response, public=True, max_age=settings.WIKI_IMMUTABLE_MAX_AGE,
+            s_maxage=settings.WIKI_SHARED_CACHE_MAX_AGE, immutable=True,
+        )
+    else:
+        patch_cache_control(response, private=True, max_age=settings.WIKI_IMMUTABLE_MAX_AGE, immutable=True)
+
+
+def serve_versioned_file(request, file_id, version, filename):
+    wiki_file = get_object_or_404(WikiFile.objects.select_related('page'), pk=file_id)
+    page = wiki_file.page
+
+    denied = _check_file_access(request, page)
+    if denied:
+        return denied
+
+    # The version is part of the URL so responses can be cached forever. A link to a replaced
+    # version (e.g. from a page cached before the upload) is sent on to the current bytes.
+    if version != wiki_file.content_version:
+        response = redirect(wiki_file.get_serving_url())
+        add_never_cache_headers(response)
         return response
-    except IOError:
-        raise Http404("Error reading file.")
+
+    response = media.serve_wiki_file(request, wiki_file)
+    _cache_versioned_media(response, page)
+    return response
+
+
+def image_derivative(request, file_id, version, derivative):
+    wiki_file = get_object_or_404(WikiFile.objects.select_related('page'), pk=file_id)
+    page = wiki_file.page
+
+    denied = _check_file_access(request, page)
+    if denied:
+        return denied
+
+    variant, _, fmt = derivative.partition('.')
+    if variant not in constants.IMAGE_DERIVATIVE_SIZES or fmt not in services.get_derivative_formats():
+        raise Http404("Unknown image size or format.")
+    # The version is part of the URL so responses can be cached forever; old versions are gone.
+    if version != services.get_file_version(wiki_file):
+        raise Http404("This version of the file no longer exists.")
+
+    image_path = request.GET.get('path')
+    if image_path is not None and (not image_path or '..' in image_path or image_path.startswith('/')):
+        return HttpResponseBadRequest("Invalid 'path' parameter.")
+
+    derivative_path = services.ensure_image_derivative(wiki_file, variant, fmt, image_path)
+    if derivative_path is None:
+        raise Http404("No resized version can be made of this file.")
+
+    response = media.serve_file(
+        request,
+        derivative_path,
+        os.path.relpath(derivative_path, settings.MEDIA_ROOT),
+        os.path.basename(derivative_path),
+        content_type=services.DERIVATIVE_CONTENT_TYPES[fmt],
+    )
+    _cache_versioned_media(response, page)
+    return response
 
 
 def view_image_in_archive(request, file_id):
     wiki_file = get_object_or_404(WikiFile, pk=file_id)
     page = wiki_file.page
 
-    if not WikiPage.objects.get_visible_by_user(request.user).filter(pk=page.pk).exists():
-        if page.visibility != WikiPage.Visibility.PUBLIC and not request.user.is_authenticated:
-            return redirect_to_login(request.get_full_path())
-        raise Http404("You do not have permission to view this image.")
+    denied = _check_file_access(request, page)
+    if denied:
+        return denied
 
     image_path = request.GET.get('path')
 
     if not image_path or '..' in image_path or image_path.startswith('/'):
         return HttpResponseBadRequest("Invalid or missing 'path' parameter.")
 
-    _root, image_ext = os.path.splitext(image_path)
-    is_heic = image_ext.lower() in ['.heic', '.heif']
-
+    is_heic = jobs.is_heic(image_path)
     if is_heic:
-        cache_key = f"heic-png:{wiki_file.id}:{hashlib.md5(image_path.encode()).hexdigest()}"
-        cached_png_bytes = cache.get(cache_key)
-        if cached_png_bytes:
-            return HttpResponse(cached_png_bytes, content_type='image/png')
-    
-    image_bytes = services.get_image_bytes_from_archive(wiki_file, image_path)
-    if not image_bytes:
-        raise Http404(f"Image '{image_path}' not found in archive or archive is invalid.")
-    
+        heic_content_type = services.HEIC_OUTPUT_CONTENT_TYPES[settings.WIKI_HEIC_OUTPUT_FORMAT]
+
+    if is_heic and settings.WIKI_MEDIA_WORKER_ENABLED:
+        converted_path = services.get_converted_image_path(wiki_file, image_path)
+        if os.path.exists(converted_path):
+            return media.serve_file(
+                request,
+                converted_path,
+                os.path.relpath(converted_path, settings.MEDIA_ROOT),
+                os.path.splitext(os.path.basename(image_path))[0] + '.' + settings.WIKI_HEIC_OUTPUT_FORMAT,
+                content_type=heic_content_type,
+            )
+        archive_index = services.ensure_archive_index(wiki_file)
+        if archive_index is not None and image_path not in archive_index['members']:
+            raise Http404(f"Image '{image_path}' not found in archive or archive is invalid.")
+        job = jobs.enqueue(MediaJob.Kind.CONVERT_HEIC, wiki_file, image_path)
+        if job.status == MediaJob.Status.DONE:
+            # Done, yet the output is gone (page renamed, output format changed, pruned): convert again.
+            job = jobs.enqueue(MediaJob.Kind.CONVERT_HEIC, wiki_file, image_path, restart=True)
+        if job.status == MediaJob.Status.FAILED:
+            raise Http404(f"Failed to convert HEIC image: {job.error}")
+        response = HttpResponse(constants.PENDING_IMAGE_SVG, status=202, content_type='image/svg+xml')
+        response['Retry-After'] = str(constants.PENDING_IMAGE_RETRY_AFTER)
+        add_never_cache_headers(response)
+        return response
+
     if is_heic:
+        cache_key = f"heic-{settings.WIKI_HEIC_OUTPUT_FORMAT}:{wiki_file.id}:{services.get_file_version(wiki_file)}:{hashlib.md5(image_path.encode()).hexdigest()}"
+
+        def convert():
+            heic_bytes = services.get_image_bytes_from_archive(wiki_file, image_path)
+            return services.convert_heic_bytes(heic_bytes) if heic_bytes else None
+
         try:
-            png_bytes = services.convert_heic_to_png_bytes(image_bytes)
-            cache.set(cache_key, png_bytes, timeout=settings.HEIC_CACHE_DURATION)
-            return HttpResponse(png_bytes, content_type='image/png')
+            converted_bytes = caching.get_or_build(cache_key, convert, timeout=settings.HEIC_CACHE_DURATION)
         except Exception as e:
             raise Http404(f"Failed to convert HEIC image: {e}")
-    else:
-        content_type, _ = mimetypes.guess_type(image_path)
-        return HttpResponse(image_bytes, content_type=content_type or 'application/octet-stream')
\ No newline at end of file
+        if converted_bytes is None:
+            raise Http404(f"Image '{image_path}' not found in archive or archive is invalid.")
+        return HttpResponse(converted_bytes, content_type=heic_content_type)
+
+    image_bytes = services.get_image_bytes_from_archive(wiki_file, image_path)
+    if not image_bytes:
+        raise Http404(f"Image '{image_path}' not found in archive or archive is invalid.")
+    content_type, _ = mimetypes.guess_type(image_path)
+    return HttpResponse(image_bytes, content_type=content_type or 'application/octet-stream')
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -52,6 +53,12 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 11811160064 # 11 GB
 FILE_UPLOAD_PERMISSIONS = 0o644
 # For directories: owner can read/write/execute, group can read/execute, others can read/execute. (755)
 FILE_UPLOAD_DIRECTORY_PERMISSIONS = 0o755
+# Attachments are stored under the SHA-256 of their bytes (see wiki2/storage.py); these
+# handlers hash uploads while they stream in, so storing them needs no second read.
+FILE_UPLOAD_HANDLERS = [
+    'wiki2.storage.HashingMemoryFileUploadHandler',
+    'wiki2.storage.HashingTemporaryFileUploadHandler',
+]
 
 
 # INFO: Application definition
@@ -144,9 +151,27 @@ else:
         }
     }
 
-# Custom setting for HEIC to PNG conversion cache duration
+# Custom setting for the HEIC conversion cache duration
 # Default is 7 days (60 seconds * 60 minutes * 24 hours * 7 days)
-HEIC_CACHE_DURATION = os.environ.get('HEIC_CACHE_DURATION', 7 * 60 * 60 * 24)
+HEIC_CACHE_DURATION = int(os.environ.get('HEIC_CACHE_DURATION', 7 * 60 * 60 * 24))
+# What HEIC images are converted to for browsers: 'webp' (default, a fraction of the size
+# of PNG in the cache), 'jpeg' or 'png'. The quality applies to webp and jpeg.
+WIKI_HEIC_OUTPUT_FORMAT = os.environ.get('WIKI_HEIC_OUTPUT_FORMAT', 'webp').lower()
+if WIKI_HEIC_OUTPUT_FORMAT not in ('webp', 'jpeg', 'png'):
+    raise ImproperlyConfigured(f"WIKI_HEIC_OUTPUT_FORMAT must be 'webp', 'jpeg' or 'png', not {WIKI_HEIC_OUTPUT_FORMAT!r}.")
+WIKI_HEIC_OUTPUT_QUALITY = int(os.environ.get('WIKI_HEIC_OUTPUT_QUALITY', 85))
+
+# Full-text search backend: 'auto' picks postgres (tsvector) or SQLite FTS5 from the
+# database in use and falls back to the in-process 'inverted' index; 'basic' forces
+# plain substring matching.
+WIKI_SEARCH_BACKEND = os.environ.get('WIKI_SEARCH_BACKEND', 'auto')
+# Where the 'inverted' backend persists its index. Must be shared by all workers.
+WIKI_SEARCH_INDEX_PATH = os.environ.get('WIKI_SEARCH_INDEX_PATH', BASE_DIR / 'search_index.bin')
+WIKI_SEARCH_RESULTS_PER_PAGE = 20
+
+# Rendered page HTML is invalidated explicitly (content edits and link/attachment changes),
+# so the timeout only bounds how long unused entries linger. Default is 7 days.
+RENDER_CACHE_DURATION = int(os.environ.get('RENDER_CACHE_DURATION', 7 * 60 * 60 * 24))
 
 
 # INFO: Password validation
@@ -201,6 +226,34 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = '/app/media'
 
+# Attachments are only linked through a view that checks the page's visibility; nginx
+# refuses direct requests for them (see nginx/default.conf).
+# After the permission check, let nginx send attachment bytes through an X-Accel-Redirect
+# to this internal location instead of streaming them from a gunicorn worker.
+# Without nginx in front (runserver), Django streams the file itself.
+WIKI_MEDIA_ACCEL_REDIRECT = os.environ.get('WIKI_MEDIA_ACCEL_REDIRECT', str(not DEBUG)) == 'True'
+WIKI_MEDIA_ACCEL_PREFIX = os.environ.get('WIKI_MEDIA_ACCEL_PREFIX', '/protected-media/')
+# Responses with a content version in their URL (resized images, the page index) never
+# change, so browsers may keep them for a year.
+WIKI_IMMUTABLE_MAX_AGE = int(os.environ.get('WIKI_IMMUTABLE_MAX_AGE', 60 * 60 * 24 * 365))
+# How long shared caches (proxies, CDNs) may keep versioned attachments of public pages.
+# Kept short: a page can stop being public, and a proxy doesn't know.
+WIKI_SHARED_CACHE_MAX_AGE = int(os.environ.get('WIKI_SHARED_CACHE_MAX_AGE', 60 * 5))
+
+# Background media jobs (see `manage.py run_media_worker`). When disabled, HEIC images are
+# converted inside the request as before and nothing is precomputed at upload time.
+WIKI_MEDIA_WORKER_ENABLED = os.environ.get('WIKI_MEDIA_WORKER_ENABLED', str(not DEBUG)) == 'True'
+WIKI_MEDIA_WORKER_PROCESSES = int(os.environ.get('WIKI_MEDIA_WORKER_PROCESSES', 0))  # 0: one per available core
+WIKI_MEDIA_WORKER_POLL_INTERVAL = float(os.environ.get('WIKI_MEDIA_WORKER_POLL_INTERVAL', 2))
+WIKI_MEDIA_JOB_TIMEOUT = int(os.environ.get('WIKI_MEDIA_JOB_TIMEOUT', 10 * 60))  # Running longer than this: the worker died
+
+# Chunked, resumable attachment uploads: the editor sends files in chunks of this size,
+# several at a time, into a staging file on the media volume (hidden, so nginx refuses it).
+WIKI_UPLOAD_CHUNK_SIZE = int(os.environ.get('WIKI_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+WIKI_UPLOAD_STAGING_DIR = os.environ.get('WIKI_UPLOAD_STAGING_DIR', os.path.join(MEDIA_ROOT, '.upload_staging'))
+# Unfinished uploads older than this are discarded; until then they can be resumed.
+WIKI_UPLOAD_SESSION_MAX_AGE = int(os.environ.get('WIKI_UPLOAD_SESSION_MAX_AGE', 60 * 60 * 24))
+
 
 # INFO:Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field